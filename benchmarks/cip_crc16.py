@@ -0,0 +1,34 @@
+"""
+Microbenchmark of cip_crc16 on structure definition sized data.
+
+The legacy CRC below is the bit by bit loop cip_crc16 used before it was table driven.
+Run with PYTHONPATH=src python benchmarks/cip_crc16.py
+"""
+import random
+import timeit
+from aphyt.cip.cip import cip_crc16
+
+
+def legacy_cip_crc16(data: bytes, poly=0xa001) -> bytes:
+    data = bytearray(data)
+    crc = 0x0000
+    for byte in data:
+        crc = crc ^ byte
+        for _ in range(0, 8):
+            carry = crc & 1
+            crc >>= 1
+            if carry:
+                crc = crc ^ poly
+    return crc.to_bytes(2, 'little')
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    definitions = [random.randbytes(random.randint(16, 256)) for _ in range(2000)]
+    total_bytes = sum(len(definition) for definition in definitions)
+    assert all(legacy_cip_crc16(definition) == cip_crc16(definition) for definition in definitions)
+    for name, function in (('legacy', lambda: [legacy_cip_crc16(definition) for definition in definitions]),
+                           ('table', lambda: [cip_crc16(definition) for definition in definitions])):
+        seconds = min(timeit.repeat(function, number=5, repeat=3)) / 5
+        print(f'{len(definitions)} definitions  {name:10s}  {seconds * 1e3:8.2f} ms  '
+              f'{total_bytes / seconds / 1e6:6.2f} MB/s')
@@ -0,0 +1,70 @@
+"""
+Microbenchmark of decoding and encoding a CIPStructure with 150 members.
+
+The legacy codec below is the member by member layout walk CIPStructure used before its layout was compiled.
+value() only replaces the data since members are decoded when used, so reading every member is timed as well.
+Run with PYTHONPATH=src python benchmarks/cip_structure_codec.py
+"""
+import timeit
+from aphyt.cip.cip_datatypes import CIPStructure, CIPBoolean, CIPInteger, CIPReal, CIPLongReal, CIPDoubleInteger
+
+
+def structure(number_of_members: int = 150) -> CIPStructure:
+    cip_structure = CIPStructure()
+    cip_structure.variable_type_name = 'BenchmarkType'
+    cip_structure.crc_code = b'\x12\x34'
+    member_types = (CIPBoolean, CIPInteger, CIPReal, CIPLongReal, CIPDoubleInteger)
+    for index in range(number_of_members):
+        cip_structure.add_member('Member%d' % index, member_types[index % len(member_types)]())
+    cip_structure.from_value(cip_structure)
+    return cip_structure
+
+
+def legacy_value(cip_structure: CIPStructure):
+    offset = 0
+    prev_member_value_type = None
+    structure_data = cip_structure.data
+    for member in cip_structure.members:
+        member_value = cip_structure.members[member]
+        if member_value.alignment != 0 and offset % member_value.alignment != 0:
+            offset += (member_value.alignment - offset % member_value.alignment)
+        elif prev_member_value_type != type(member_value) and offset % 2 != 0:
+            offset += 1
+        end_byte = offset + member_value.size
+        member_value.data = structure_data[offset:end_byte]
+        member_value.value()
+        prev_member_value_type = type(member_value)
+        offset = end_byte
+    return cip_structure
+
+
+def legacy_from_value(cip_structure: CIPStructure, value: CIPStructure):
+    offset = 0
+    prev_member_value_type = None
+    mutable_data = bytearray(cip_structure.data)
+    for member_key in value.members:
+        member = value.members.get(member_key)
+        if member.alignment != 0 and offset % member.alignment != 0:
+            offset += (member.alignment - offset % member.alignment)
+        elif prev_member_value_type != type(member) and offset % 2 != 0:
+            offset += 1
+        end_byte = offset + member.size
+        mutable_data[offset:offset + member.size] = member.data
+        prev_member_value_type = type(member)
+        offset = end_byte
+    cip_structure.data = bytes(mutable_data)
+    legacy_value(cip_structure)
+
+
+if __name__ == '__main__':
+    cip_structure = structure()
+    data = cip_structure.data
+    for name, function in (('legacy value', lambda: legacy_value(cip_structure)),
+                           ('value', cip_structure.value),
+                           ('value, one member', lambda: cip_structure.value()['Member75']),
+                           ('value, all members', lambda: cip_structure.value().members),
+                           ('legacy from_value', lambda: legacy_from_value(cip_structure, cip_structure)),
+                           ('compiled from_value', lambda: cip_structure.from_value(cip_structure))):
+        seconds = min(timeit.repeat(function, number=2000, repeat=5)) / 2000
+        assert cip_structure.data == data
+        print(f'{len(cip_structure.members)} members  {name:20s}  {seconds * 1e6:7.2f} us')
@@ -0,0 +1,84 @@
+"""
+Microbenchmark of decoding a send_unit_data reply frame into a CIPReply.
+
+The legacy decode below is the slicing the frame model used before it parsed with memoryviews, every layer
+copied the rest of the frame. Run with PYTHONPATH=src python benchmarks/eip_frame_decode.py
+"""
+import timeit
+import tracemalloc
+from aphyt.cip.cip import CIPReply
+from aphyt.eip.eip import EIPMessage, CommandSpecificData, CommonPacketFormat, DataAndAddressItem, \
+    ConnectedMessagingMixin
+
+
+def reply_frame(reply_data_length: int) -> bytes:
+    cip_reply = b'\xcc\x00\x00\x00' + bytes(reply_data_length)
+    packets = [DataAndAddressItem(DataAndAddressItem.CONNECTED_ADDRESS_ITEM, b'\x01\x02\x03\x04'),
+               DataAndAddressItem(DataAndAddressItem.CONNECTED_TRANSPORT_PACKET, b'\x01\x00' + cip_reply)]
+    command_specific_data = CommandSpecificData(timeout=b'\x00\x00',
+                                                encapsulated_packet=CommonPacketFormat(packets).bytes())
+    return EIPMessage(b'\x70\x00', command_specific_data.bytes(), b'\x01\x02\x03\x04').bytes()
+
+
+class LegacyLayer:
+    """Stands in for the frame classes before __slots__, which kept their fields in an instance __dict__"""
+    pass
+
+
+def legacy_decode(frame: bytes) -> CIPReply:
+    """The decode path before memoryviews, every layer sliced a copy of the rest of the frame"""
+    message = LegacyLayer()
+    message.command = frame[0:2]
+    message.length = frame[2:4]
+    message.session_handle_id = frame[4:8]
+    message.status = frame[8:12]
+    message.sender_context_data = frame[12:20]
+    message.command_options = frame[20:24]
+    message.command_data = frame[24:]
+    command_specific_data = LegacyLayer()
+    command_specific_data.interface_handle = message.command_data[0:4]
+    command_specific_data.timeout = message.command_data[4:6]
+    command_specific_data.encapsulated_packet = message.command_data[6:]
+    common_packet_format = LegacyLayer()
+    common_packet_format.item_count = int.from_bytes(command_specific_data.encapsulated_packet[0:2], 'little')
+    common_packet_format.packet_bytes = command_specific_data.encapsulated_packet[2:]
+    common_packet_format.packets = [None, None]
+    packet_bytes = common_packet_format.packet_bytes
+    packet_offset = 0
+    packet_index = 0
+    while packet_offset < len(packet_bytes):
+        item = LegacyLayer()
+        item.type_id = packet_bytes[packet_offset:packet_offset + 2]
+        item.length = packet_bytes[packet_offset + 2:packet_offset + 4]
+        length = int.from_bytes(item.length, 'little')
+        item.data = packet_bytes[packet_offset + 4:packet_offset + length + 4]
+        common_packet_format.packets[packet_index] = item
+        packet_offset = packet_offset + length + 4
+        packet_index = packet_index + 1
+    return CIPReply(common_packet_format.packets[1].data[2:])
+
+
+def decode(frame: bytes) -> CIPReply:
+    reply = EIPMessage()
+    reply.from_bytes(frame)
+    reply_packet = ConnectedMessagingMixin._common_packet_format_from_reply(reply)
+    return ConnectedMessagingMixin._cip_reply_from_packet(reply_packet)
+
+
+def peak_allocation(function, frame: bytes) -> int:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    function(frame)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == '__main__':
+    for reply_data_length in (64, 496, 3996):
+        frame = reply_frame(reply_data_length)
+        assert legacy_decode(frame).reply_data == decode(frame).reply_data
+        for name, function in (('legacy', legacy_decode), ('memoryview', decode)):
+            peak = peak_allocation(function, frame)
+            seconds = min(timeit.repeat(lambda: function(frame), number=10000, repeat=5)) / 10000
+            print(f'{reply_data_length:5d} byte reply  {name:10s}  peak {peak:6d} bytes  {seconds * 1e6:6.2f} us')
@@ -0,0 +1,35 @@
+"""
+Microbenchmark of building the send_rr_data frame for a Read Tag request, with the DataAndAddressItem,
+CommonPacketFormat, CommandSpecificData and EIPMessage chain and with a cached EIPRequestTemplate.
+Run with PYTHONPATH=src python benchmarks/eip_request_encode.py
+"""
+import timeit
+from aphyt.cip.cip import CIPRequest, CIPService, variable_request_path_segment
+from aphyt.eip.eip import EIPMessage, EIPRequestTemplate, ConnectedMessagingMixin
+
+SESSION_HANDLE_ID = b'\x01\x02\x03\x04'
+
+
+def chain_encode(request: CIPRequest) -> bytes:
+    command_specific_data = ConnectedMessagingMixin._unconnected_command_specific_data(request)
+    eip_message = EIPMessage(b'\x6f\x00', command_specific_data, SESSION_HANDLE_ID)
+    eip_message.set_context(7)
+    return eip_message.bytes()
+
+
+TEMPLATE = EIPRequestTemplate(EIPRequestTemplate.SEND_RR_DATA, SESSION_HANDLE_ID)
+
+
+def template_encode(request: CIPRequest) -> bytearray:
+    frame = TEMPLATE.request(request.bytes)
+    frame.set_context(7)
+    return frame.bytes()
+
+
+if __name__ == '__main__':
+    request = CIPRequest(CIPService.READ_TAG_SERVICE, variable_request_path_segment('Line1.Station4.Count'),
+                         b'\x01\x00')
+    assert chain_encode(request) == template_encode(request)
+    for name, function in (('chain', chain_encode), ('template', template_encode)):
+        seconds = min(timeit.repeat(lambda: function(request), number=20000, repeat=5)) / 20000
+        print(f'{name:10s} {seconds * 1e6:6.2f} us per request')
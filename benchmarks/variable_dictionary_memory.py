@@ -0,0 +1,42 @@
+"""
+Memory of a variable dictionary of 5,000 structure variables of four types with 30 members each.
+
+The legacy dictionary below gives every variable its own copy of the members of its type, which is what building
+every variable from its Variable Type Objects did before structure types were shared with new_instance.
+Run with PYTHONPATH=src python benchmarks/variable_dictionary_memory.py
+"""
+import copy
+import tracemalloc
+from aphyt.cip.cip_datatypes import CIPStructure, CIPBoolean, CIPInteger, CIPReal, CIPLongReal, CIPDoubleInteger, \
+    CIPArray
+
+
+def structure_type(type_number: int, number_of_members: int = 30) -> CIPStructure:
+    cip_structure = CIPStructure()
+    cip_structure.variable_type_name = 'BenchmarkType%d' % type_number
+    cip_structure.crc_code = type_number.to_bytes(2, 'little')
+    member_types = (CIPBoolean, CIPInteger, CIPReal, CIPLongReal, CIPDoubleInteger)
+    for index in range(number_of_members - 1):
+        cip_structure.add_member('Member%d' % index, member_types[index % len(member_types)]())
+    cip_array = CIPArray()
+    cip_array.from_instance(CIPReal(), 4, 1, [10], [0])
+    cip_structure.add_member('Array', cip_array)
+    cip_structure.from_value(cip_structure)
+    cip_structure.size = len(cip_structure.data)
+    return cip_structure
+
+
+def dictionary_size(new_variable, number_of_variables: int = 5000) -> int:
+    prototypes = [structure_type(type_number) for type_number in range(4)]
+    tracemalloc.start()
+    variables = {}
+    for index in range(number_of_variables):
+        variables['Variable%d' % index] = new_variable(prototypes[index % len(prototypes)])
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+if __name__ == '__main__':
+    for name, new_variable in (('legacy copies', copy.deepcopy), ('shared types', CIPStructure.new_instance)):
+        print(f'{name:14s}  {dictionary_size(new_variable) / 1e6:6.2f} MB')
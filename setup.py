@@ -21,4 +21,5 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.10',
+    extras_require={"numpy": ["numpy"]},
 )
@@ -3,22 +3,37 @@ __license__ = "GPLv2"
 __maintainer__ = "Joseph Ryan"
 __email__ = "jr@aphyt.com"
 
+import asyncio
 from abc import ABC, abstractmethod
-from aphyt.cip.cip_attributes import CIPAttribute
 import binascii
+import functools
+import random
 import re
+import struct
+from typing import List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # cip_attributes imports this module, so CIPAttribute is only imported for type checking
+    from aphyt.cip.cip_attributes import CIPAttribute
 
 cip_status_dictionary = {
     b'\x00': ('SUCCESS',''),
+    b'\x01': ('CONNECTION_FAILURE','A connection related service failed. The extended status describes the reason'),
     b'\x02': ('RESOURCE_UNAVAILABLE','This is generally causes by too many coroutines exhausting PLC Ethernet/IP'
                                      ' processing resources. Decrease the number of coroutines using a semaphore'),
     b'\x04': ('PATH_SEGMENT_ERROR','This is generally caused by the variable not existing or not being published'
                                    ' in the global variable table'),
     b'\x05': ('PATH_DESTINATION_UNKNOWN',''),
+    b'\x08': ('SERVICE_NOT_SUPPORTED',''),
+    b'\x0a': ('ATTRIBUTE_LIST_ERROR','One or more attributes of a Get Attribute List request could not be read.'
+                                     ' Check the status of each attribute'),
     b'\x0c': ('OBJECT_STATE_CONFLICT',''),
     b'\x11': ('REPLY_DATA_TOO_LARGE',''),
     b'\x13': ('NOT_ENOUGH_DATA',''),
+    b'\x14': ('ATTRIBUTE_NOT_SUPPORTED',''),
     b'\x15': ('TOO_MUCH_DATA',''),
+    b'\x1e': ('EMBEDDED_SERVICE_ERROR','One or more services in a Multiple Service Packet failed. Check the'
+                                       ' status of each reply'),
     b'\x1f': ('VENDOR_SPECIFIC_ERROR',''),
     b'\x20': ('INVALID_PARAMETER',''),
     b'\x10\x80': ('Downloading, starting up',''),
@@ -45,17 +60,52 @@ cip_status_dictionary = {
                   'is specified. An attempt was made to write an undefined value to an enumeration variable.',''),
 }
 
-def cip_crc16(data: bytes, poly=0xa001) -> bytes:
-    data = bytearray(data)
-    crc = 0x0000
-    for byte in data:
-        crc = crc ^ byte
+CIP_CRC16_POLYNOMIAL = 0xa001
+
+
+@functools.lru_cache(maxsize=None)
+def _cip_crc16_table(poly: int = CIP_CRC16_POLYNOMIAL) -> tuple:
+    """
+    CRC of every byte value, so the CRC is updated a byte at a time instead of a bit at a time
+    :param poly: Reflected polynomial
+    :return:
+    """
+    table = []
+    for byte in range(256):
+        crc = byte
         for _ in range(0, 8):
             carry = crc & 1
             crc >>= 1
             if carry:
                 crc = crc ^ poly
-    return crc.to_bytes(2, 'little')
+        table.append(crc)
+    return tuple(table)
+
+
+class CIPCRC16:
+    """
+    CRC-16 that is updated chunk by chunk, for data such as a structure definition that arrives in segments
+    """
+
+    def __init__(self, data: bytes = b'', poly=CIP_CRC16_POLYNOMIAL):
+        self.table = _cip_crc16_table(poly)
+        self.crc = 0x0000
+        self.update(data)
+
+    def update(self, data: bytes) -> "CIPCRC16":
+        table = self.table
+        crc = self.crc
+        for byte in data:
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+        self.crc = crc
+        return self
+
+    def digest(self) -> bytes:
+        return self.crc.to_bytes(2, 'little')
+
+
+def cip_crc16(data: bytes, poly=CIP_CRC16_POLYNOMIAL) -> bytes:
+    return CIPCRC16(data, poly).digest()
 
 
 class CIPService:
@@ -71,24 +121,34 @@ class CIPService:
     # w506_nx_nj - series_cpu_unit_built - in_ethernet_ip_port_users_manual_en.pdf
     # 303 of 570 CIP Object Services
     GET_ATTRIBUTE_ALL = b'\x01'
+    GET_ATTRIBUTE_LIST = b'\x03'
     GET_ATTRIBUTE_SINGLE = b'\x0e'
     RESET = b'\x05'
     SET_ATTRIBUTE_SINGLE = b'\x10'
     GET_INSTANCE_LIST_EX2 = b'\x5f'
+    # Message Router Object services
+    MULTIPLE_SERVICE_PACKET = b'\x0a'
+    # Connection Manager Object services
+    FORWARD_CLOSE = b'\x4e'
+    FORWARD_OPEN = b'\x54'
+    LARGE_FORWARD_OPEN = b'\x5b'
 
     def __init__(self, cip_dispatcher: "CIPDispatcher", **kwargs):
         self.cip_dispatcher = cip_dispatcher
 
 
 class CIPException(Exception):
-    def __init__(self, status: bytes, extended_status: bytes):
+    def __init__(self, status: bytes, extended_status: bytes, reply: "CIPReply" = None):
         self.status = status
         self.extended_status = extended_status
+        # The reply that carried the error status, if there was one
+        self.reply = reply
         super().__init__(self.get_message())
 
     def get_message(self):
+        status_description = cip_status_dictionary.get(self.status, ('UNKNOWN_STATUS', ''))
         message = (f"\nCIP reply contained a general status code {binascii.hexlify(self.status).decode('utf-8')}\n"
-               f"{cip_status_dictionary[self.status][0]}\n{cip_status_dictionary[self.status][1]}\n")
+               f"{status_description[0]}\n{status_description[1]}\n")
 
         value = cip_status_dictionary.get(self.extended_status)
         if self.extended_status != b'':
@@ -137,21 +197,70 @@ class CIPRequest:
 class CIPReply:
     """
     Class for parsing CIP replies
+
+    The reply keeps the buffer it was made from, usually a memoryview over the received frame, and only decodes
+    a field when it is read
     """
+    __slots__ = ('_reply_bytes', '_view', '_data_offset', '_reply_data')
+    # Elementary types used to decode reply fields
+    USINT = struct.Struct('<B')
+    UINT = struct.Struct('<H')
+    UDINT = struct.Struct('<L')
 
     def __init__(self, reply_bytes: bytes):
         """
 
         :param reply_bytes:
         """
-        self.reply_service = reply_bytes[0:1]
-        self.reserved = reply_bytes[1:2]
-        self.general_status = reply_bytes[2:3]
-        self.extended_status_size = reply_bytes[3:4]
+        self._reply_bytes = reply_bytes
+        self._view = memoryview(reply_bytes)
         # Research replies that use this. It's usually zero, so I am guessing it is in words (like the request)
-        extended_status_byte_size = int.from_bytes(self.extended_status_size, 'little') * 2
-        self.extended_status = reply_bytes[4:4 + extended_status_byte_size]
-        self.reply_data = reply_bytes[4 + extended_status_byte_size:]
+        self._data_offset = 4 + self.USINT.unpack_from(self._view, 3)[0] * 2
+        self._reply_data = None
+
+    def __reduce__(self):
+        # A memoryview can not be pickled, so the reply is rebuilt from its bytes
+        return self.__class__, (self.bytes,)
+
+    @property
+    def reply_service(self) -> bytes:
+        return self._view[0:1].tobytes()
+
+    @property
+    def reserved(self) -> bytes:
+        return self._view[1:2].tobytes()
+
+    @property
+    def general_status(self) -> bytes:
+        return self._view[2:3].tobytes()
+
+    @property
+    def extended_status_size(self) -> bytes:
+        return self._view[3:4].tobytes()
+
+    @property
+    def extended_status(self) -> bytes:
+        return self._view[4:self._data_offset].tobytes()
+
+    @property
+    def reply_data(self) -> bytes:
+        if self._reply_data is None:
+            self._reply_data = self._view[self._data_offset:].tobytes()
+        return self._reply_data
+
+    @property
+    def reply_data_view(self) -> memoryview:
+        """
+        The reply data without copying it
+        :return:
+        """
+        return self._view[self._data_offset:]
+
+    def _unpack_reply_data(self, structure: struct.Struct, offset: int):
+        return structure.unpack_from(self._view, self._data_offset + offset)[0]
+
+    def _reply_data_bytes(self, start: int, end: int) -> bytes:
+        return self._view[self._data_offset + start:self._data_offset + end].tobytes()
 
     @property
     def bytes(self) -> bytes:
@@ -159,9 +268,171 @@ class CIPReply:
         The bytes in the CIP reply
         :return:
         """
-        return \
-                self.reply_service + self.reserved + self.general_status + \
-                self.extended_status_size + self.extended_status + self.reply_data
+        if not isinstance(self._reply_bytes, bytes):
+            self._reply_bytes = self._view.tobytes()
+        return self._reply_bytes
+
+
+class ForwardOpenRequest:
+    """
+    Request data for the Forward Open (0x54) and Large Forward Open (0x5B) services of the Connection Manager
+    Object. Large Forward Open uses 32-bit network connection parameters, allowing connection sizes up to
+    65535 bytes instead of 511
+
+    EIP-CIP-V1 3-5.5.2 Forward Open
+    """
+    CONNECTION_MANAGER_PATH = b'\x20\x06\x24\x01'
+    MESSAGE_ROUTER_PATH = b'\x20\x02\x24\x01'
+    # Network connection types and priorities used in the network connection parameters
+    NULL = 0
+    MULTICAST = 1
+    POINT_TO_POINT = 2
+    LOW_PRIORITY = 0
+    HIGH_PRIORITY = 1
+    SCHEDULED_PRIORITY = 2
+    # Transport class and trigger byte, server transport class 3 with application object trigger
+    CLASS_3_APPLICATION_TRIGGER = 0xa3
+    # Transport class and trigger byte, client transport class 1 with cyclic trigger
+    CLASS_1_CYCLIC = 0x01
+    ORIGINATOR_VENDOR_ID = 0x1337
+
+    def __init__(self,
+                 connection_size: int,
+                 large: bool = False,
+                 connection_path: bytes = MESSAGE_ROUTER_PATH,
+                 transport_class_trigger: int = CLASS_3_APPLICATION_TRIGGER,
+                 o_t_rpi: int = 2000000,
+                 t_o_rpi: int = 2000000,
+                 o_t_connection_type: int = POINT_TO_POINT,
+                 t_o_connection_type: int = POINT_TO_POINT,
+                 priority: int = LOW_PRIORITY,
+                 variable_size: bool = True,
+                 t_o_connection_size: int = None,
+                 connection_timeout_multiplier: int = 3,
+                 originator_serial_number: int = None):
+        """
+        :param connection_size: O->T connection size in bytes
+        :param large: Use Large Forward Open
+        :param connection_path: Padded EPATH of the connection target
+        :param transport_class_trigger:
+        :param o_t_rpi: Requested packet interval originator to target in microseconds
+        :param t_o_rpi: Requested packet interval target to originator in microseconds
+        :param o_t_connection_type:
+        :param t_o_connection_type:
+        :param priority:
+        :param variable_size:
+        :param t_o_connection_size: T->O connection size in bytes, the O->T size when None
+        :param connection_timeout_multiplier: The connection times out after RPI * 4 << multiplier
+        :param originator_serial_number:
+        """
+        self.large = large
+        self.connection_size = connection_size
+        self.t_o_connection_size = connection_size if t_o_connection_size is None else t_o_connection_size
+        self.connection_path = connection_path
+        self.transport_class_trigger = transport_class_trigger
+        self.o_t_rpi = o_t_rpi
+        self.t_o_rpi = t_o_rpi
+        self.o_t_connection_type = o_t_connection_type
+        self.t_o_connection_type = t_o_connection_type
+        self.priority = priority
+        self.variable_size = variable_size
+        self.connection_timeout_multiplier = connection_timeout_multiplier
+        self.priority_time_tick = 0x0a
+        self.timeout_ticks = 0x0e
+        self.t_o_connection_id = random.getrandbits(32)
+        self.connection_serial_number = random.getrandbits(16)
+        self.originator_vendor_id = self.ORIGINATOR_VENDOR_ID
+        if originator_serial_number is None:
+            originator_serial_number = random.getrandbits(32)
+        self.originator_serial_number = originator_serial_number
+
+    @property
+    def service(self) -> bytes:
+        if self.large:
+            return CIPService.LARGE_FORWARD_OPEN
+        return CIPService.FORWARD_OPEN
+
+    def network_connection_parameters(self, connection_size: int, connection_type: int) -> int:
+        """
+        Pack the connection type, priority, fixed or variable flag and size into the 16-bit, or for
+        Large Forward Open the 32-bit, network connection parameters
+        :param connection_size:
+        :param connection_type:
+        :return:
+        """
+        shift = 16 if self.large else 0
+        parameters = (connection_type << 13 | self.priority << 10 | int(self.variable_size) << 9) << shift
+        if self.large:
+            return parameters | (connection_size & 0xffff)
+        return parameters | (connection_size & 0x01ff)
+
+    def bytes(self) -> bytes:
+        parameter_format = 'L' if self.large else 'H'
+        request_data = struct.pack(
+            '<BBLLHHLB3xL' + parameter_format + 'L' + parameter_format + 'BB',
+            self.priority_time_tick,
+            self.timeout_ticks,
+            0,
+            self.t_o_connection_id,
+            self.connection_serial_number,
+            self.originator_vendor_id,
+            self.originator_serial_number,
+            self.connection_timeout_multiplier,
+            self.o_t_rpi,
+            self.network_connection_parameters(self.connection_size, self.o_t_connection_type),
+            self.t_o_rpi,
+            self.network_connection_parameters(self.t_o_connection_size, self.t_o_connection_type),
+            self.transport_class_trigger,
+            len(self.connection_path) // 2)
+        return request_data + self.connection_path
+
+    def cip_request(self) -> "CIPRequest":
+        return CIPRequest(self.service, self.CONNECTION_MANAGER_PATH, self.bytes())
+
+    def forward_close_request(self) -> "CIPRequest":
+        """
+        The Forward Close request that closes the connection opened by this request
+        :return:
+        """
+        request_data = struct.pack('<BBHHLBx', self.priority_time_tick, self.timeout_ticks,
+                                   self.connection_serial_number, self.originator_vendor_id,
+                                   self.originator_serial_number, len(self.connection_path) // 2)
+        return CIPRequest(CIPService.FORWARD_CLOSE, self.CONNECTION_MANAGER_PATH,
+                          request_data + self.connection_path)
+
+
+class ForwardOpenReply(CIPReply):
+    """
+    CIP Reply from a successful Forward Open or Large Forward Open service
+    """
+    __slots__ = ()
+
+    def __init__(self, reply_bytes: bytes):
+        super().__init__(reply_bytes=reply_bytes)
+
+    @property
+    def o_t_connection_id(self) -> bytes:
+        """Connection ID the originator uses for the messages it sends"""
+        return self._reply_data_bytes(0, 4)
+
+    @property
+    def t_o_connection_id(self) -> bytes:
+        """Connection ID the target uses for the messages it sends"""
+        return self._reply_data_bytes(4, 8)
+
+    @property
+    def connection_serial_number(self) -> int:
+        return self._unpack_reply_data(self.UINT, 8)
+
+    @property
+    def o_t_api(self) -> int:
+        """Actual packet interval originator to target in microseconds"""
+        return self._unpack_reply_data(self.UDINT, 16)
+
+    @property
+    def t_o_api(self) -> int:
+        """Actual packet interval target to originator in microseconds"""
+        return self._unpack_reply_data(self.UDINT, 20)
 
 
 class CIPCommonFormat:
@@ -190,6 +461,239 @@ class CIPCommonFormat:
         self.data = bytes_cip_common_format[2 + self.additional_info_length:]
 
 
+def write_tag_request(tag_request_path: bytes, request_service_data: CIPCommonFormat,
+                      number_of_elements=1) -> CIPRequest:
+    data = request_service_data.data_type + \
+           int(request_service_data.additional_info_length).to_bytes(1, 'little') + \
+           request_service_data.additional_info + number_of_elements.to_bytes(2, 'little') + \
+           request_service_data.data
+    return CIPRequest(CIPService.WRITE_TAG_SERVICE, tag_request_path, data)
+
+
+def read_modify_write_tag_request(tag_request_path: bytes, or_mask: bytes, and_mask: bytes) -> CIPRequest:
+    """
+    Request that the target changes bits of a tag in place. Bits that are 1 in or_mask are set and bits that are 0
+    in and_mask are cleared, the other bits keep the value they have in the target
+    :param tag_request_path:
+    :param or_mask: Mask low byte first, 1, 2, 4, 8 or 12 bytes long
+    :param and_mask: Mask the same size as or_mask
+    :return:
+    """
+    if len(or_mask) != len(and_mask):
+        raise ValueError('The OR mask and the AND mask must be the same size')
+    data = len(or_mask).to_bytes(2, 'little') + or_mask + and_mask
+    return CIPRequest(CIPService.READ_MODIFY_WRITE_TAG_SERVICE, tag_request_path, data)
+
+
+class MultipleServicePacket:
+    """
+    Request and reply formatting for the Multiple Service Packet service (0x0A) of the Message Router Object,
+    which carries several CIP requests in one message and returns their replies in one reply
+
+    Request data and reply data::
+        |-Number of Services
+        |-Offset of each Service, from the start of the Number of Services
+        |-Services
+    """
+    MESSAGE_ROUTER_PATH = b'\x20\x02\x24\x01'
+    # Service, path size and message router path of the request
+    REQUEST_OVERHEAD = 6
+    # Service, reserved, general status and extended status size of the reply
+    REPLY_OVERHEAD = 4
+    # General statuses of a refused packet that mean it or its reply was too large, so it is sent in halves:
+    # reply data too large, not enough data and too much data
+    SIZE_STATUSES = (b'\x11', b'\x13', b'\x15')
+    # General status of a target that does not support the Multiple Service Packet service
+    SERVICE_NOT_SUPPORTED = b'\x08'
+
+    def __init__(self, requests: List[CIPRequest]):
+        self.requests = requests
+
+    def cip_request(self) -> CIPRequest:
+        request_bytes = [request.bytes for request in self.requests]
+        offset = 2 + 2 * len(request_bytes)
+        offsets = []
+        for service_bytes in request_bytes:
+            offsets.append(offset)
+            offset += len(service_bytes)
+        request_data = struct.pack('<%dH' % (len(offsets) + 1), len(offsets), *offsets) + b''.join(request_bytes)
+        return CIPRequest(CIPService.MULTIPLE_SERVICE_PACKET, self.MESSAGE_ROUTER_PATH, request_data)
+
+    @staticmethod
+    def replies(reply: CIPReply) -> List[CIPReply]:
+        """
+        Split the reply to a Multiple Service Packet into the reply to each request, each with its own status
+        :param reply:
+        :return:
+        """
+        reply_data = reply.reply_data_view
+        number_of_replies = struct.unpack_from('<H', reply_data, 0)[0]
+        offsets = list(struct.unpack_from('<%dH' % number_of_replies, reply_data, 2)) + [len(reply_data)]
+        return [CIPReply(reply_data[offsets[index]:offsets[index + 1]]) for index in range(number_of_replies)]
+
+    @classmethod
+    def batches(cls, requests: List[CIPRequest], maximum_length: int,
+                reply_lengths: List[int] = None) -> List[List[CIPRequest]]:
+        """
+        Group the requests into packets whose request, and reply when reply_lengths is given, fit in
+        maximum_length. A request that does not fit in a packet with others is in a batch of its own
+        :param requests:
+        :param maximum_length: Largest message the connection allows
+        :param reply_lengths: Expected length of the reply data of each request
+        :return:
+        """
+        batches = []
+        batch = []
+        request_length = cls.REQUEST_OVERHEAD + 2
+        reply_length = cls.REPLY_OVERHEAD + 2
+        for index, request in enumerate(requests):
+            item_request_length = 2 + len(request.bytes)
+            item_reply_length = 2 + cls.REPLY_OVERHEAD + (reply_lengths[index] if reply_lengths is not None else 0)
+            if batch and (request_length + item_request_length > maximum_length or
+                          reply_length + item_reply_length > maximum_length):
+                batches.append(batch)
+                batch = []
+                request_length = cls.REQUEST_OVERHEAD + 2
+                reply_length = cls.REPLY_OVERHEAD + 2
+            batch.append(request)
+            request_length += item_request_length
+            reply_length += item_reply_length
+        if batch:
+            batches.append(batch)
+        return batches
+
+
+class GetAttributeList:
+    """
+    Request and reply formatting for the Get Attribute List service (0x03), which reads several attributes of
+    one instance in one request and decodes them into the data type of each CIPAttribute
+
+    Request data::
+        |-Attribute Count
+        |-Attribute IDs
+
+    Reply data::
+        |-Attribute Count
+        |-For each attribute
+          |-Attribute ID
+          |-Status
+          |-Attribute Data, only when the status is success
+    """
+    UINT = struct.Struct('<H')
+    REPLY_ITEM = struct.Struct('<HH')
+
+    def __init__(self, cip_attributes: List["CIPAttribute"]):
+        """
+        :param cip_attributes: Attributes of one instance
+        """
+        if len({(cip_attribute.class_id, cip_attribute.instance_id) for cip_attribute in cip_attributes}) > 1:
+            raise ValueError('Get Attribute List reads the attributes of a single instance')
+        self.cip_attributes = cip_attributes
+
+    @staticmethod
+    def attribute_id_integer(cip_attribute: "CIPAttribute") -> int:
+        return int.from_bytes(cip_attribute.attribute_id, 'little')
+
+    def cip_request(self) -> CIPRequest:
+        request_path = address_request_path_segment(self.cip_attributes[0].class_id,
+                                                    self.cip_attributes[0].instance_id)
+        request_data = struct.pack('<%dH' % (len(self.cip_attributes) + 1), len(self.cip_attributes),
+                                   *[self.attribute_id_integer(cip_attribute)
+                                     for cip_attribute in self.cip_attributes])
+        return CIPRequest(CIPService.GET_ATTRIBUTE_LIST, request_path, request_data)
+
+    def single_requests(self) -> List[CIPRequest]:
+        """
+        Get Attribute Single requests for the same attributes, for devices that do not support Get Attribute List
+        :return:
+        """
+        return [CIPRequest(CIPService.GET_ATTRIBUTE_SINGLE, cip_attribute.request_path)
+                for cip_attribute in self.cip_attributes]
+
+    @classmethod
+    def data_size(cls, data_type, data: memoryview, offset: int) -> int:
+        """
+        Number of bytes the value of data_type takes in a reply, strings are a UINT length and the characters
+        :param data_type:
+        :param data:
+        :param offset:
+        :return:
+        """
+        if data_type.data_type_code() == b'\xd0':
+            return 2 + cls.UINT.unpack_from(data, offset)[0]
+        if data_type.data_type_code() == b'\xa2':
+            size = 0
+            previous_member_type = None
+            for member in data_type.member_types().values():
+                # Member layout of CIPStructure.value
+                if member.alignment != 0 and size % member.alignment != 0:
+                    size += member.alignment - size % member.alignment
+                elif previous_member_type != type(member) and size % 2 != 0:
+                    size += 1
+                size += cls.data_size(member, data, offset + size)
+                previous_member_type = type(member)
+            return size
+        return data_type.size
+
+    @classmethod
+    def decode_attribute(cls, cip_attribute: "CIPAttribute", data: memoryview, offset: int = 0) -> int:
+        """
+        Copy the value of an attribute into its data type
+        :param cip_attribute:
+        :param data:
+        :param offset:
+        :return: Offset after the value
+        """
+        data_type = cip_attribute.data_type
+        size = cls.data_size(data_type, data, offset)
+        if data_type.data_type_code() == b'\xd0':
+            data_type.data = data[offset + 2:offset + size].tobytes()
+            data_type.size = len(data_type.data)
+        else:
+            data_type.data = data[offset:offset + size].tobytes()
+            data_type.value()
+        return offset + size
+
+    def decode(self, reply: CIPReply) -> List["CIPAttribute"]:
+        """
+        Decode a Get Attribute List reply, which can have the attribute list error status when some of the
+        attributes could not be read
+        :param reply:
+        :return:
+        """
+        attributes_by_id = {self.attribute_id_integer(cip_attribute): cip_attribute
+                            for cip_attribute in self.cip_attributes}
+        data = reply.reply_data_view
+        offset = 2
+        for _ in range(self.UINT.unpack_from(data, 0)[0]):
+            attribute_id, status = self.REPLY_ITEM.unpack_from(data, offset)
+            offset += self.REPLY_ITEM.size
+            cip_attribute = attributes_by_id[attribute_id]
+            cip_attribute.status = status.to_bytes(1, 'little')
+            if status == 0:
+                offset = self.decode_attribute(cip_attribute, data, offset)
+        return self.cip_attributes
+
+    def decode_single_replies(self, replies: List[CIPReply]) -> List["CIPAttribute"]:
+        for cip_attribute, reply in zip(self.cip_attributes, replies):
+            cip_attribute.status = reply.general_status
+            if reply.general_status == b'\x00':
+                self.decode_attribute(cip_attribute, reply.reply_data_view)
+        return self.cip_attributes
+
+    @staticmethod
+    def instances(cip_attributes: List["CIPAttribute"]) -> List["GetAttributeList"]:
+        """
+        Group attributes by the instance they belong to
+        :param cip_attributes:
+        :return:
+        """
+        instances = {}
+        for cip_attribute in cip_attributes:
+            instances.setdefault((cip_attribute.class_id, cip_attribute.instance_id), []).append(cip_attribute)
+        return [GetAttributeList(instance_attributes) for instance_attributes in instances.values()]
+
+
 class CIPDispatcher(ABC):
     """
     CIPDispatcher is an abstract base class that has the basic methods and data required
@@ -218,12 +722,10 @@ class CIPDispatcher(ABC):
         return self.execute_cip_command(read_tag_request)
 
     def write_tag_service(self, tag_request_path, request_service_data: CIPCommonFormat, number_of_elements=1):
-        data = request_service_data.data_type + \
-               int(request_service_data.additional_info_length).to_bytes(1, 'little') + \
-               request_service_data.additional_info + number_of_elements.to_bytes(2, 'little') + \
-               request_service_data.data
-        write_tag_request = CIPRequest(CIPService.WRITE_TAG_SERVICE, tag_request_path, data)
-        return self.execute_cip_command(write_tag_request)
+        return self.execute_cip_command(write_tag_request(tag_request_path, request_service_data, number_of_elements))
+
+    def read_modify_write_tag_service(self, tag_request_path, or_mask: bytes, and_mask: bytes):
+        return self.execute_cip_command(read_modify_write_tag_request(tag_request_path, or_mask, and_mask))
 
     def read_tag_fragmented_service(self, tag_request_path, offset, number_of_elements):
         data = tag_request_path + number_of_elements.to_bytes(2, 'little') + offset.to_bytes(4, 'little')
@@ -264,6 +766,98 @@ class CIPDispatcher(ABC):
         get_instance_list_request = CIPRequest(CIPService.GET_INSTANCE_LIST_EX2, path, request_data)
         return self.execute_cip_command(get_instance_list_request)
 
+    @property
+    def maximum_message_length(self) -> int:
+        """
+        Largest CIP message the dispatcher can send, the unconnected (UCMM) limit unless a connection allows more
+        :return:
+        """
+        return 502
+
+    def execute_multiple_service(self, requests: List[CIPRequest], reply_lengths: List[int] = None) -> List[CIPReply]:
+        """
+        Send the requests in as few Multiple Service Packets as the maximum message length allows and return
+        the reply to each request in order. Failed requests do not raise, check the status of each reply. A packet
+        the target refuses for a reason other than its size raises CIPException
+        :param requests:
+        :param reply_lengths: Expected length of the reply data of each request, used to keep replies in size
+        :return:
+        """
+        replies = []
+        for batch in MultipleServicePacket.batches(requests, self.maximum_message_length, reply_lengths):
+            replies.extend(self._execute_multiple_service_batch(batch))
+        return replies
+
+    def _execute_multiple_service_batch(self, requests: List[CIPRequest]) -> List[CIPReply]:
+        if len(requests) == 1:
+            try:
+                return [self.execute_cip_command(requests[0])]
+            except CIPException as err:
+                if err.reply is None:
+                    raise err
+                return [err.reply]
+        try:
+            reply = self.execute_cip_command(MultipleServicePacket(requests).cip_request())
+        except CIPException as err:
+            if err.status == b'\x1e' and err.reply is not None:
+                return MultipleServicePacket.replies(err.reply)
+            if err.status == MultipleServicePacket.SERVICE_NOT_SUPPORTED:
+                return [reply for request in requests for reply in self._execute_multiple_service_batch([request])]
+            if err.status not in MultipleServicePacket.SIZE_STATUSES:
+                raise err
+            # The packet or its reply did not fit, so it is split
+            half = len(requests) // 2
+            return self._execute_multiple_service_batch(requests[:half]) + \
+                self._execute_multiple_service_batch(requests[half:])
+        return MultipleServicePacket.replies(reply)
+
+    def read_tags(self, tag_request_paths: List[bytes], number_of_elements=1,
+                  reply_lengths: List[int] = None) -> List[CIPReply]:
+        """
+        Read Tag Service for many tags using Multiple Service Packets
+        :param tag_request_paths:
+        :param number_of_elements:
+        :param reply_lengths:
+        :return:
+        """
+        requests = [CIPRequest(CIPService.READ_TAG_SERVICE, tag_request_path, number_of_elements.to_bytes(2, 'little'))
+                    for tag_request_path in tag_request_paths]
+        return self.execute_multiple_service(requests, reply_lengths)
+
+    def write_tags(self, tag_request_paths: List[bytes], request_service_data: List[CIPCommonFormat],
+                   number_of_elements=1) -> List[CIPReply]:
+        """
+        Write Tag Service for many tags using Multiple Service Packets
+        :param tag_request_paths:
+        :param request_service_data: The data to write to each tag
+        :param number_of_elements:
+        :return:
+        """
+        requests = [write_tag_request(tag_request_path, service_data, number_of_elements)
+                    for tag_request_path, service_data in zip(tag_request_paths, request_service_data)]
+        return self.execute_multiple_service(requests, [0] * len(requests))
+
+    def get_attribute_list(self, cip_attributes: List["CIPAttribute"]) -> List["CIPAttribute"]:
+        """
+        Read the attributes with one Get Attribute List request per instance, or with Get Attribute Single
+        requests in Multiple Service Packets when the device does not support Get Attribute List. The status
+        of each attribute is set on it
+        :param cip_attributes:
+        :return:
+        """
+        for get_attribute_list in GetAttributeList.instances(cip_attributes):
+            try:
+                get_attribute_list.decode(self.execute_cip_command(get_attribute_list.cip_request()))
+            except CIPException as err:
+                if err.status == b'\x0a' and err.reply is not None:
+                    get_attribute_list.decode(err.reply)
+                elif err.status == b'\x08':
+                    get_attribute_list.decode_single_replies(
+                        self.execute_multiple_service(get_attribute_list.single_requests()))
+                else:
+                    raise err
+        return cip_attributes
+
 
 class AsyncCIPDispatcher(ABC):
     """
@@ -293,12 +887,11 @@ class AsyncCIPDispatcher(ABC):
         return await self.execute_cip_command(read_tag_request)
 
     async def write_tag_service(self, tag_request_path, request_service_data: CIPCommonFormat, number_of_elements=1):
-        data = request_service_data.data_type + \
-               int(request_service_data.additional_info_length).to_bytes(1, 'little') + \
-               request_service_data.additional_info + number_of_elements.to_bytes(2, 'little') + \
-               request_service_data.data
-        write_tag_request = CIPRequest(CIPService.WRITE_TAG_SERVICE, tag_request_path, data)
-        return await self.execute_cip_command(write_tag_request)
+        return await self.execute_cip_command(
+            write_tag_request(tag_request_path, request_service_data, number_of_elements))
+
+    async def read_modify_write_tag_service(self, tag_request_path, or_mask: bytes, and_mask: bytes):
+        return await self.execute_cip_command(read_modify_write_tag_request(tag_request_path, or_mask, and_mask))
 
     async def read_tag_fragmented_service(self, tag_request_path, offset, number_of_elements):
         data = tag_request_path + number_of_elements.to_bytes(2, 'little') + offset.to_bytes(4, 'little')
@@ -339,6 +932,203 @@ class AsyncCIPDispatcher(ABC):
         get_instance_list_request = CIPRequest(CIPService.GET_INSTANCE_LIST_EX2, path, request_data)
         return await self.execute_cip_command(get_instance_list_request)
 
+    @property
+    def maximum_message_length(self) -> int:
+        """
+        Largest CIP message the dispatcher can send, the unconnected (UCMM) limit unless a connection allows more
+        :return:
+        """
+        return 502
+
+    async def execute_multiple_service(self, requests: List[CIPRequest],
+                                       reply_lengths: List[int] = None) -> List[CIPReply]:
+        """
+        Send the requests in as few Multiple Service Packets as the maximum message length allows and return
+        the reply to each request in order. Failed requests do not raise, check the status of each reply. A packet
+        the target refuses for a reason other than its size raises CIPException
+        :param requests:
+        :param reply_lengths: Expected length of the reply data of each request, used to keep replies in size
+        :return:
+        """
+        batches = MultipleServicePacket.batches(requests, self.maximum_message_length, reply_lengths)
+        batch_replies = await asyncio.gather(*[self._execute_multiple_service_batch(batch) for batch in batches])
+        return [reply for replies in batch_replies for reply in replies]
+
+    async def _execute_multiple_service_batch(self, requests: List[CIPRequest]) -> List[CIPReply]:
+        if len(requests) == 1:
+            try:
+                return [await self.execute_cip_command(requests[0])]
+            except CIPException as err:
+                if err.reply is None:
+                    raise err
+                return [err.reply]
+        try:
+            reply = await self.execute_cip_command(MultipleServicePacket(requests).cip_request())
+        except CIPException as err:
+            if err.status == b'\x1e' and err.reply is not None:
+                return MultipleServicePacket.replies(err.reply)
+            if err.status == MultipleServicePacket.SERVICE_NOT_SUPPORTED:
+                single_replies = await asyncio.gather(*[self._execute_multiple_service_batch([request])
+                                                        for request in requests])
+                return [reply for replies in single_replies for reply in replies]
+            if err.status not in MultipleServicePacket.SIZE_STATUSES:
+                raise err
+            # The packet or its reply did not fit, so it is split
+            half = len(requests) // 2
+            return await self._execute_multiple_service_batch(requests[:half]) + \
+                await self._execute_multiple_service_batch(requests[half:])
+        return MultipleServicePacket.replies(reply)
+
+    async def read_tags(self, tag_request_paths: List[bytes], number_of_elements=1,
+                        reply_lengths: List[int] = None) -> List[CIPReply]:
+        """
+        Read Tag Service for many tags using Multiple Service Packets
+        :param tag_request_paths:
+        :param number_of_elements:
+        :param reply_lengths:
+        :return:
+        """
+        requests = [CIPRequest(CIPService.READ_TAG_SERVICE, tag_request_path, number_of_elements.to_bytes(2, 'little'))
+                    for tag_request_path in tag_request_paths]
+        return await self.execute_multiple_service(requests, reply_lengths)
+
+    async def write_tags(self, tag_request_paths: List[bytes], request_service_data: List[CIPCommonFormat],
+                         number_of_elements=1) -> List[CIPReply]:
+        """
+        Write Tag Service for many tags using Multiple Service Packets
+        :param tag_request_paths:
+        :param request_service_data: The data to write to each tag
+        :param number_of_elements:
+        :return:
+        """
+        requests = [write_tag_request(tag_request_path, service_data, number_of_elements)
+                    for tag_request_path, service_data in zip(tag_request_paths, request_service_data)]
+        return await self.execute_multiple_service(requests, [0] * len(requests))
+
+    async def get_attribute_list(self, cip_attributes: List["CIPAttribute"]) -> List["CIPAttribute"]:
+        """
+        Read the attributes with one Get Attribute List request per instance, or with Get Attribute Single
+        requests in Multiple Service Packets when the device does not support Get Attribute List. The status
+        of each attribute is set on it
+        :param cip_attributes:
+        :return:
+        """
+        for get_attribute_list in GetAttributeList.instances(cip_attributes):
+            try:
+                get_attribute_list.decode(await self.execute_cip_command(get_attribute_list.cip_request()))
+            except CIPException as err:
+                if err.status == b'\x0a' and err.reply is not None:
+                    get_attribute_list.decode(err.reply)
+                elif err.status == b'\x08':
+                    get_attribute_list.decode_single_replies(
+                        await self.execute_multiple_service(get_attribute_list.single_requests()))
+                else:
+                    raise err
+        return cip_attributes
+
+
+class AsyncReadTagCoalescer:
+    """
+    Collects the Read Tag requests that coroutines make within a short window of each other and sends them
+    together in a Multiple Service Packet, handing each caller its own reply. A read of a tag that is already
+    waiting or in flight shares that request's reply instead of being sent again.
+
+    The window starts with the first request after a packet was sent. The packet is sent early if the next
+    request, or its expected reply, would make the packet or its reply larger than the maximum message length
+    of the dispatcher
+    """
+    DEFAULT_WINDOW = 0.001
+
+    def __init__(self, cip_dispatcher: AsyncCIPDispatcher, window: float = DEFAULT_WINDOW):
+        """
+        :param cip_dispatcher:
+        :param window: Seconds to collect requests before sending them
+        """
+        self.cip_dispatcher = cip_dispatcher
+        self.window = window
+        self._replies = {}
+        self._requests = []
+        self._request_length = MultipleServicePacket.REQUEST_OVERHEAD + 2
+        self._reply_length = MultipleServicePacket.REPLY_OVERHEAD + 2
+        self._timer = None
+        self._tasks = set()
+
+    async def read_tag_service(self, tag_request_path: bytes, number_of_elements=1,
+                               reply_length: int = 0) -> CIPReply:
+        """
+        Read Tag Service sent together with the other reads made within the window
+        :param tag_request_path:
+        :param number_of_elements:
+        :param reply_length: Expected length of the reply data, used to keep the reply in size
+        :return:
+        """
+        key = (bytes(tag_request_path), number_of_elements)
+        reply_future = self._replies.get(key)
+        if reply_future is None:
+            loop = asyncio.get_running_loop()
+            request = CIPRequest(CIPService.READ_TAG_SERVICE, tag_request_path,
+                                 number_of_elements.to_bytes(2, 'little'))
+            item_length = 2 + len(request.bytes)
+            item_reply_length = 2 + MultipleServicePacket.REPLY_OVERHEAD + reply_length
+            maximum_length = self.cip_dispatcher.maximum_message_length
+            if self._requests and (self._request_length + item_length > maximum_length or
+                                   self._reply_length + item_reply_length > maximum_length):
+                self.flush()
+            reply_future = loop.create_future()
+            self._replies[key] = reply_future
+            self._requests.append((key, request, reply_length, reply_future))
+            self._request_length += item_length
+            self._reply_length += item_reply_length
+            if self._timer is None:
+                self._timer = loop.call_later(self.window, self.flush)
+        reply = await asyncio.shield(reply_future)
+        if reply.general_status != b'\x00':
+            raise CIPException(reply.general_status, reply.extended_status, reply)
+        return reply
+
+    def invalidate(self, tag_request_path: bytes):
+        """
+        Stop sharing waiting or in flight reads of the tag, so that reads made after a write see the new value
+        :param tag_request_path:
+        :return:
+        """
+        tag_request_path = bytes(tag_request_path)
+        for key in [key for key in self._replies if key[0] == tag_request_path]:
+            del self._replies[key]
+
+    def flush(self):
+        """
+        Send the collected requests now
+        :return:
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._requests:
+            return
+        requests = self._requests
+        self._requests = []
+        self._request_length = MultipleServicePacket.REQUEST_OVERHEAD + 2
+        self._reply_length = MultipleServicePacket.REPLY_OVERHEAD + 2
+        task = asyncio.get_running_loop().create_task(self._send(requests))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, requests: list):
+        try:
+            replies = await self.cip_dispatcher.execute_multiple_service(
+                [request for _, request, _, _ in requests], [reply_length for _, _, reply_length, _ in requests])
+        except Exception as err:
+            replies = None
+            for _, _, _, reply_future in requests:
+                if not reply_future.done():
+                    reply_future.set_exception(err)
+        for index, (key, _, _, reply_future) in enumerate(requests):
+            if self._replies.get(key) is reply_future:
+                del self._replies[key]
+            if replies is not None and not reply_future.done():
+                reply_future.set_result(replies[index])
+
 
 class ReadTagServiceMixin(CIPService):
     def __init__(self, cip_dispatcher: CIPDispatcher):
@@ -390,7 +1180,7 @@ class GetAttributeSingleMixin(CIPService):
             CIPRequest(service_code, tag_request_path)
         return self.cip_dispatcher.execute_cip_command(get_attribute_single_request)
 
-    def get_attribute_single(self, cip_attribute: CIPAttribute) -> CIPAttribute:
+    def get_attribute_single(self, cip_attribute: "CIPAttribute") -> "CIPAttribute":
         reply = self.get_attribute_single_from_path(cip_attribute.request_path)
         cip_attribute.data_type.data = reply.reply_data
         return cip_attribute
@@ -405,7 +1195,7 @@ class SetAttributeSingleMixin(CIPService):
         set_attribute_single_request = CIPRequest(service_code, tag_request_path, data)
         return self.cip_dispatcher.execute_cip_command(set_attribute_single_request)
 
-    def set_attribute_single(self, cip_attribute: CIPAttribute):
+    def set_attribute_single(self, cip_attribute: "CIPAttribute"):
         assert (cip_attribute.writeable is True)
         self.set_attribute_single_from_path(cip_attribute.request_path, data=cip_attribute.data_type.data)
 
@@ -441,11 +1231,13 @@ def address_request_path_segment(class_id: bytes = None, instance_id: bytes = No
         elif len(class_id) == 2:
             request_path_bytes += b'\x21\x00' + class_id
     if instance_id is not None:
-        # 8-bit id uses b'\x24' 16-bit uses b'\x25'
+        # 8-bit id uses b'\x24' 16-bit uses b'\x25' 32-bit uses b'\x26'
         if len(instance_id) == 1:
             request_path_bytes += b'\x24' + instance_id
         elif len(instance_id) == 2:
             request_path_bytes += b'\x25\x00' + instance_id
+        elif len(instance_id) == 4:
+            request_path_bytes += b'\x26\x00' + instance_id
     if attribute_id is not None:
         # 8-bit id uses b'\x30' 16-bit uses b'\x31'
         if len(attribute_id) == 1:
@@ -463,10 +1255,18 @@ def address_request_path_segment(class_id: bytes = None, instance_id: bytes = No
     return request_path_bytes
 
 
+# Number of variable names whose request paths are kept by variable_request_path_segment
+REQUEST_PATH_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=REQUEST_PATH_CACHE_SIZE)
 def variable_request_path_segment(variable_name: str) -> bytes:
     """
     This function is to create a request path using the variable name of the data that the programmer will access
 
+    Request paths are cached per variable name, variable_request_path_segment.cache_info() reports the hits
+    and misses of the cache
+
     :param variable_name: The name of the variable for the request path
     :return: Request path as a bytes object
     """
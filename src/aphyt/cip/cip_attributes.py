@@ -6,11 +6,39 @@ __email__ = "jr@aphyt.com"
 
 from aphyt.cip.cip_datatypes import *
 from aphyt.cip.cip import *
+from typing import List
 
 
 class CIPObject:
-    def __init__(self, class_id: bytes, **kwargs):
+    """
+    Base class for CIP objects. Subclasses declare their attributes as CIPAttribute members that carry the
+    attribute id and data type, and any of them can be read together with get_attribute_list
+    """
+    def __init__(self, class_id: bytes, cip_dispatcher=None, **kwargs):
+        """
+        :param class_id:
+        :param cip_dispatcher: Dispatcher the attributes are read through
+        """
         self.class_id = class_id
+        self.cip_dispatcher = cip_dispatcher
+
+    def cip_attributes(self) -> List["CIPAttribute"]:
+        """
+        The attributes declared by the object
+        :return:
+        """
+        return [member for member in vars(self).values() if isinstance(member, CIPAttribute)]
+
+    def get_attribute_list(self, cip_attributes: List["CIPAttribute"] = None):
+        """
+        Read attributes with one Get Attribute List request per instance, all of the declared attributes if
+        none are given. With an asynchronous dispatcher the result has to be awaited
+        :param cip_attributes:
+        :return:
+        """
+        if cip_attributes is None:
+            cip_attributes = self.cip_attributes()
+        return self.cip_dispatcher.get_attribute_list(cip_attributes)
 
 
 class CIPAttribute:
@@ -25,6 +53,8 @@ class CIPAttribute:
         self.attribute_id = attribute_id
         self.data_type = data_type
         self.writeable = writeable
+        # General status of the last read of the attribute
+        self.status = None
         self.request_path = address_request_path_segment(self.class_id,
                                                          self.instance_id,
                                                          self.attribute_id)
@@ -3,12 +3,20 @@ __license__ = "GPLv2"
 __maintainer__ = "Joseph Ryan"
 __email__ = "jr@aphyt.com"
 
-import collections
+import collections.abc
+import itertools
+import math
 import struct
 import copy
 from abc import ABC, abstractmethod
 import binascii
 
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, it is only needed for the NumPy mode of CIPArray
+    numpy = None
+
 
 def test_bit(int_type, offset):
     mask = 1 << offset
@@ -31,12 +39,75 @@ def toggle_bit(int_type, offset):
 
 
 def flatten(x):
-    if isinstance(x, collections.Iterable):
+    if isinstance(x, collections.abc.Iterable):
         return [a for i in x for a in flatten(i)]
     else:
         return [x]
 
 
+# Bits of every byte value, least significant bit first, to unpack Boolean arrays without NumPy
+_BYTE_BITS = [tuple(bool(byte >> bit & 1) for bit in range(8)) for byte in range(256)]
+_BIT_CHARACTERS = bytes.maketrans(b'\x00\x01', b'01')
+
+
+def unpack_bits(data: bytes, count: int) -> list:
+    """
+    Unpack the first count bits of packed Boolean data, least significant bit of the first byte first
+    :param data:
+    :param count: Number of bits, missing bits are False
+    :return: List of bool
+    """
+    if numpy is not None:
+        return numpy.unpackbits(
+            numpy.frombuffer(data, numpy.uint8), count=count, bitorder='little').astype(bool).tolist()
+    bits = list(itertools.chain.from_iterable(map(_BYTE_BITS.__getitem__, data[0:(count + 7) // 8])))
+    return bits[0:count] + [False] * (count - len(bits))
+
+
+def pack_bits(bits, size: int) -> bytes:
+    """
+    Pack Boolean values into size bytes, least significant bit of the first byte first, padding with zeros
+    :param bits: Flat iterable of values, or a NumPy array of any shape
+    :param size:
+    :return:
+    """
+    if numpy is not None:
+        data = numpy.packbits(numpy.asarray(bits, dtype=bool).ravel(), bitorder='little').tobytes()
+    else:
+        bit_string = bytes(map(bool, bits)).translate(_BIT_CHARACTERS)
+        data = int(bit_string[::-1] or b'0', 2).to_bytes((len(bit_string) + 7) // 8, 'little')
+    if len(data) > size:
+        raise ValueError('%d Boolean values do not fit in %d bytes' % (len(bits), size))
+    return data + bytes(size - len(data))
+
+
+def _merge_ranges(ranges) -> list:
+    """
+    Sort (start, end) byte ranges and merge the ones that overlap or are adjacent
+    :param ranges:
+    :return:
+    """
+    merged_ranges = []
+    for start, end in sorted(ranges):
+        if merged_ranges and start <= merged_ranges[-1][1]:
+            merged_ranges[-1] = (merged_ranges[-1][0], max(end, merged_ranges[-1][1]))
+        else:
+            merged_ranges.append((start, end))
+    return merged_ranges
+
+
+def _nested_list(flat_list: list, number_of_elements: list) -> list:
+    """
+    Split a flat list into lists nested to the dimensions of an array
+    :param flat_list:
+    :param number_of_elements:
+    :return:
+    """
+    for number in reversed(number_of_elements[1:]):
+        flat_list = [flat_list[index:index + number] for index in range(0, len(flat_list), number)]
+    return flat_list
+
+
 class CIPDataType(ABC):
     """
     Abstract Base Class for CIP Data Types. The subclasses will be added to a data type dictionary and
@@ -433,15 +504,184 @@ class CIPAbbreviatedStructure(CIPDataType):
         self.data = value
 
 
+class CIPStructureLayout:
+    """
+    Member layout of a CIPStructure compiled into one struct.Struct, each member a fixed size bytes field with
+    the alignment padding between them, so the data of every member is unpacked or packed in one call. Members
+    that are structures or arrays still decode their own members or elements from their data
+    """
+    __slots__ = ('member_names', 'structure', 'derived_member_names', 'size', 'member_offsets')
+
+    def __init__(self, cip_structure: "CIPStructure"):
+        format_string = '<'
+        offset = 0
+        prev_member_type = None
+        derived_member_names = []
+        member_offsets = {}
+        members = cip_structure.member_types()
+        for member_name, member in members.items():
+            padding = 0
+            if member.alignment != 0 and offset % member.alignment != 0:
+                padding = member.alignment - offset % member.alignment
+            elif prev_member_type != type(member) and offset % 2 != 0:
+                # Make start offset even on member type change
+                padding = 1
+            if padding:
+                format_string += '%dx' % padding
+            format_string += '%ds' % member.size
+            member_offsets[member_name] = offset + padding
+            offset += padding + member.size
+            if isinstance(member, (CIPStructure, CIPArray)):
+                derived_member_names.append(member_name)
+            prev_member_type = type(member)
+        self.member_names = tuple(members)
+        self.structure = struct.Struct(format_string)
+        self.derived_member_names = tuple(derived_member_names)
+        self.size = self.structure.size
+        self.member_offsets = member_offsets
+
+
+# Compiled layouts of structure types, by CRC code and type name
+_structure_layouts = {}
+
+
+def compile_structure_layout(cip_structure: "CIPStructure") -> CIPStructureLayout:
+    """
+    Compile the layout of a structure, structures of a type with a CRC code share one layout. The members are
+    part of the key, as structures with the same CRC code and type name can come from different controllers or
+    be built by hand
+    :param cip_structure:
+    :return:
+    """
+    if not cip_structure.crc_code:
+        return CIPStructureLayout(cip_structure)
+    members = tuple((member_name, type(member), member.size, member.alignment)
+                    for member_name, member in cip_structure.member_types().items())
+    key = (bytes(cip_structure.crc_code), cip_structure.variable_type_name, members)
+    layout = _structure_layouts.get(key)
+    if layout is None:
+        layout = CIPStructureLayout(cip_structure)
+        _structure_layouts[key] = layout
+    return layout
+
+
 class CIPStructure(CIPDataType):
     def __init__(self):
         super().__init__()
         self.variable_type_name = ''
-        self.members = {}
+        self._members = {}
+        self._prototype = None
         self._alignment = 0
         self.crc_code = b''
         self.callback = None
         self.callback_arg = None
+        self._layout = None
+        self._dirty_ranges = []
+        # Data as it was last read from or written to the controller
+        self._synchronized_data = None
+        # Names of the members whose data is up to date with the data of the structure, None when all are
+        self._current_members = None
+        # Names of the members handed out, which are brought up to date as soon as the data changes because
+        # the caller may keep them, None when all are
+        self._used_members = set()
+
+    def __getstate__(self):
+        # The compiled layout holds a struct.Struct, which can not be pickled or copied, and a copy has its own
+        # members instead of sharing the type of its prototype
+        members = self._up_to_date_members()
+        state = self.__dict__.copy()
+        state['_members'] = members
+        if state['_used_members'] is not None:
+            state['_used_members'] = set(state['_used_members'])
+        state['_prototype'] = None
+        state['_layout'] = None
+        if isinstance(self.data, memoryview):
+            # Nested structures are views of the data of their parent
+            state['data'] = bytes(self.data)
+        return state
+
+    def __setstate__(self, state):
+        if 'members' in state:
+            # Structures pickled before members were created from a shared prototype
+            state['_members'] = state.pop('members')
+        # Structures pickled before changed members were tracked or decoded when used
+        state.setdefault('_dirty_ranges', [])
+        state.setdefault('_synchronized_data', None)
+        state.setdefault('_current_members', None)
+        state.setdefault('_used_members', None)
+        self.__dict__.update(state)
+        # Structures pickled before layouts were compiled have no layout attribute
+        self._prototype = None
+        self._layout = None
+
+    @property
+    def members(self) -> dict:
+        # The caller may keep any of the members
+        self._used_members = None
+        return self._up_to_date_members()
+
+    def _up_to_date_members(self) -> dict:
+        """
+        The members with their data up to date with the data of the structure, without handing them out
+        :return:
+        """
+        members = self.member_types()
+        if self._current_members is not None:
+            self._update_members(members)
+        return members
+
+    def member_types(self) -> dict:
+        """
+        The members without bringing their data up to date with the data of the structure, for the
+        member types, sizes and alignments
+        :return:
+        """
+        if self._members is None:
+            self._members = self._members_from_prototype()
+        return self._members
+
+    @members.setter
+    def members(self, members: dict):
+        self._members = members
+        self._prototype = None
+        self._layout = None
+
+    def new_instance(self) -> "CIPStructure":
+        """
+        A structure of the same type that shares the name, CRC code, size, alignment and compiled layout of this
+        structure instead of copying them. Its members are only created from the members of this structure the
+        first time they are used, so a dictionary of many variables of the same type holds one set of members
+        for each variable that has been used instead of one for every variable
+        :return:
+        """
+        cip_structure = CIPStructure()
+        cip_structure.variable_type_name = self.variable_type_name
+        cip_structure.instance_id = self.instance_id
+        cip_structure.crc_code = self.crc_code
+        cip_structure.size = self.size
+        cip_structure._alignment = self._alignment
+        cip_structure._layout = self.layout()
+        cip_structure._members = None
+        cip_structure._prototype = self
+        return cip_structure
+
+    def _members_from_prototype(self) -> dict:
+        """
+        Create the members of a structure made by new_instance, nested structures share the type of their
+        prototype as well
+        :return:
+        """
+        members = {}
+        for member_name, prototype_member in self._prototype._up_to_date_members().items():
+            if isinstance(prototype_member, CIPStructure):
+                member = prototype_member.new_instance()
+                member.callback = self.from_value
+                member.callback_arg = self
+            else:
+                member = copy.deepcopy(prototype_member)
+            members[member_name] = member
+        self._prototype = None
+        return members
 
     @staticmethod
     def data_type_code():
@@ -456,68 +696,262 @@ class CIPStructure(CIPDataType):
         self._alignment = new_alignment
 
     def __setitem__(self, key, value):
-        current_type = self.members.get(key)
+        current_type = self[key]
         current_type.from_value(value)
-        self.members[key] = current_type
+        offset = self.layout().member_offsets[key]
+        self._dirty_ranges.append((offset, offset + current_type.size))
         self.from_value(self)
 
+    def dirty_ranges(self) -> list:
+        """
+        Byte ranges of the members changed with __setitem__ since the structure was last read or written, as
+        sorted (start, end) tuples with overlapping and adjacent ranges merged
+        :return:
+        """
+        return _merge_ranges(self._dirty_ranges)
+
+    def clear_dirty_ranges(self):
+        """
+        Forget the changed ranges and keep the data as what the controller has, after it was read or written
+        :return:
+        """
+        self._dirty_ranges = []
+        self._synchronized_data = bytes(self.data)
+
+    def write_ranges(self) -> list:
+        """
+        Byte ranges to write to bring the controller up to date with the data. The ranges changed with
+        __setitem__ when nothing else changed since the structure was last read or written, otherwise also
+        every member whose data differs from what was last read or written. The whole structure when it was
+        never read or written, or nothing changed
+        :return:
+        """
+        synchronized_data = self._synchronized_data
+        if synchronized_data is None or len(synchronized_data) != len(self.data):
+            return [(0, self.size)]
+        dirty_ranges = self.dirty_ranges()
+        expected_data = bytearray(self.data)
+        for start, end in dirty_ranges:
+            expected_data[start:end] = synchronized_data[start:end]
+        if expected_data != synchronized_data:
+            # Members were changed some other way than __setitem__
+            layout = self.layout()
+            members = self.member_types()
+            for member_name in layout.member_names:
+                start = layout.member_offsets[member_name]
+                end = start + members[member_name].size
+                if self.data[start:end] != synchronized_data[start:end]:
+                    dirty_ranges.append((start, end))
+            dirty_ranges = _merge_ranges(dirty_ranges)
+        return dirty_ranges or [(0, self.size)]
+
     def __getitem__(self, item):
-        return self.members[item]
+        member = self.member_types()[item]
+        if self._current_members is not None and item not in self._current_members:
+            self._update_member(item, member)
+        if self._used_members is not None:
+            self._used_members.add(item)
+        return member
 
     def __repr__(self):
-        return '%s { type: %s | members: %s }' % (self.variable_name, self.variable_type_name, self.members)
+        return '%s { type: %s | members: %s }' % (self.variable_name, self.variable_type_name,
+                                                  self._up_to_date_members())
 
     def add_member(self, member_name: str, member: CIPDataType):
-        self.members[member_name] = member
+        self._up_to_date_members()[member_name] = member
+        if self._used_members is not None:
+            # The caller still has the member
+            self._used_members.add(member_name)
+        self._layout = None
         if member.alignment > self.alignment:
             self.alignment = member.alignment
 
+    def layout(self) -> CIPStructureLayout:
+        """
+        The compiled member layout, compiled the first time it is needed
+        :return:
+        """
+        if self._layout is not None and self._members is None:
+            # Members of a new instance are created from its prototype, which has the same layout
+            return self._layout
+        if self._layout is None or len(self._layout.member_names) != len(self._members):
+            # Members are also added to the members dictionary directly
+            self._layout = compile_structure_layout(self)
+        return self._layout
+
     def value(self):
-        offset = 0
-        prev_member_value_type = None
+        """
+        Members are decoded from the data when they are used, with __getitem__ or members, so reading a large
+        structure only replaces its data. Members that were already handed out, and nested structures, are
+        brought up to date right away, so references kept to them stay up to date
+        :return:
+        """
+        layout = self.layout()
+        if len(self.data) < layout.size:
+            return self._value_by_member()
+        self._current_members = set()
+        if self._members is not None:
+            if self._used_members is None:
+                self._update_members(self._members)
+                return self
+            for member_name in layout.derived_member_names:
+                member = self._members[member_name]
+                if isinstance(member, CIPStructure):
+                    self._update_member(member_name, member)
+            for member_name in self._used_members:
+                if member_name not in self._current_members:
+                    self._update_member(member_name, self._members[member_name])
+        return self
+
+    def _member_changed(self, member: CIPDataType):
+        """
+        Called by a nested structure before it calls back with its new data, so the data of the nested
+        structure is packed instead of decoded again from the old data of this structure
+        :param member:
+        :return:
+        """
+        if self._current_members is None or self._members is None:
+            return
+        for member_name in self.layout().derived_member_names:
+            if self._members[member_name] is member:
+                self._current_members.add(member_name)
+
+    def _update_member(self, member_name: str, member: CIPDataType):
+        """
+        Bring the data of one member up to date with the data of the structure
+        :param member_name:
+        :param member:
+        :return:
+        """
+        offset = self.layout().member_offsets[member_name]
+        if isinstance(member, CIPStructure):
+            # Nested structures are views of the data, their members are decoded when they are used
+            member.data = memoryview(self.data)[offset:offset + member.size]
+        else:
+            member.data = bytes(self.data[offset:offset + member.size])
+        if isinstance(member, (CIPStructure, CIPArray)):
+            member.value()
+        self._current_members.add(member_name)
+
+    def _update_members(self, members: dict):
+        """
+        Bring the data of the members not used since the data changed up to date, all in one unpack
+        :param members:
+        :return:
+        """
+        layout = self.layout()
+        if len(self.data) < layout.size:
+            # Members were added since the data was read
+            self._value_by_member()
+            return
+        current_members = self._current_members
+        for member_name, member_data in zip(layout.member_names, layout.structure.unpack_from(self.data)):
+            if member_name not in current_members:
+                members[member_name].data = member_data
+        for member_name in layout.derived_member_names:
+            if member_name not in current_members:
+                # Call value to handle nested structures
+                members[member_name].value()
+        self._current_members = None
+
+    def numpy_dtype(self):
+        """
+        NumPy structured dtype with a field for every member at its offset in the data, so an array of these
+        structures decodes with one numpy.frombuffer. Members NumPy has no type for are raw bytes fields
+        :return:
+        """
+        if numpy is None:
+            return None
+        layout = self.layout()
+        members = self.member_types()
+        return numpy.dtype({
+            'names': list(layout.member_names),
+            'formats': [_numpy_member_dtype(members[member_name]) for member_name in layout.member_names],
+            'offsets': [layout.member_offsets[member_name] for member_name in layout.member_names],
+            'itemsize': max(self.size, layout.size)})
+
+    def _collect_member_dirty_ranges(self):
+        """
+        Move the changed ranges of nested structures to this structure, at the offset of the nested structure
+        :return:
+        """
+        if self._members is None:
+            return
+        layout = self.layout()
+        for member_name in layout.derived_member_names:
+            member = self._members[member_name]
+            if isinstance(member, CIPStructure) and member._dirty_ranges:
+                offset = layout.member_offsets[member_name]
+                self._dirty_ranges.extend((offset + start, offset + end) for start, end in member._dirty_ranges)
+                member._dirty_ranges = []
+
+    def _value_by_member(self):
+        """
+        Decode the members one at a time, for data that is shorter than the layout. Members that do not fit in
+        the data, such as members added since the data was read, keep their data
+        :return:
+        """
+        layout = self.layout()
         structure_data = self.data
-        for member in self.members:
-            member_value = self.members[member]
-            if member_value.alignment != 0 and offset % member_value.alignment != 0:
-                offset += (member_value.alignment - offset % member_value.alignment)
-            elif prev_member_value_type != type(member_value) and offset % 2 != 0:
-                # Make start offset even on member type change
-                offset += 1
+        members = self.member_types()
+        self._current_members = None
+        for member_name in layout.member_names:
+            member_value = members[member_name]
+            offset = layout.member_offsets[member_name]
             end_byte = offset + member_value.size
+            if end_byte > len(structure_data):
+                break
             member_value.data = structure_data[offset:end_byte]
             # Call value to handle nested structures
             member_value.value()
-            prev_member_value_type = type(member_value)
-            offset = end_byte
         return self
 
     def from_value(self, value):
         # ToDo lookup data check
-        offset = 0
+        if value is self:
+            self._collect_member_dirty_ranges()
+        else:
+            # Every member may have changed
+            self._dirty_ranges = []
         self.crc_code = value.crc_code
-        prev_member_value_type = None
+        layout = value.layout()
         mutable_data = bytearray(self.data)
-        for member_key in value.members:
-            member = value.members.get(member_key)
-            if member.alignment != 0 and offset % member.alignment != 0:
-                offset += (member.alignment - offset % member.alignment)
-            elif prev_member_value_type != type(member) and offset % 2 != 0:
-                # Make start offset even on member type change
-                offset += 1
-            end_byte = offset + member.size
-            mutable_data[offset:offset+member.size] = member.data
-            prev_member_value_type = type(member)
-            offset = end_byte
+        if len(mutable_data) < layout.size:
+            mutable_data.extend(bytes(layout.size - len(mutable_data)))
+        members = value._up_to_date_members()
+        layout.structure.pack_into(mutable_data, 0, *[bytes(members[member_name].data)
+                                                      for member_name in layout.member_names])
         self.data = bytes(mutable_data)
         if self.callback is not None:
+            if isinstance(self.callback_arg, CIPStructure):
+                self.callback_arg._member_changed(self)
             self.callback(self.callback_arg)
         self.value()
 
 
 class CIPArray(CIPDataType):
     # ToDo arrays of Boolean data types are a special case as they can pack 16 bits in their alignment
-    def __init__(self):
+    # Little endian NumPy dtype of each primitive array data type
+    NUMPY_DTYPES = {
+        b'\xc2': '<i1', b'\xc3': '<i2', b'\xc4': '<i4', b'\xc5': '<i8',
+        b'\xc6': '<u1', b'\xc7': '<u2', b'\xc8': '<u4', b'\xc9': '<u8',
+        b'\xca': '<f4', b'\xcb': '<f8',
+    }
+
+    def __init__(self, use_numpy: bool = False, lazy: bool = False, element_cache_size: int = 0):
+        """
+        :param use_numpy: Decode primitive arrays into a NumPy ndarray instead of nested lists
+        :param lazy: Decode elements from the data when they are used instead of every time the data changes,
+        value() returns the array itself and materialize() decodes every element
+        :param element_cache_size: Number of decoded elements a lazy array keeps until the data changes
+        """
         super().__init__()
+        if use_numpy and numpy is None:
+            raise ImportError('NumPy mode of CIPArray requires numpy, install aphyt[numpy]')
+        self.use_numpy = use_numpy
+        self.lazy = lazy
+        self.element_cache_size = element_cache_size
+        self._element_cache = {}
         self.array_data_type = b''
         self.array_data_type_size = 0
         self.member_instance_id = None
@@ -530,17 +964,123 @@ class CIPArray(CIPDataType):
         self._alignment = 0
         self.data = b''
 
+    def __setstate__(self, state):
+        # Arrays pickled before the NumPy and lazy modes existed
+        state.setdefault('use_numpy', False)
+        state.setdefault('lazy', False)
+        state.setdefault('element_cache_size', 0)
+        state.setdefault('_element_cache', {})
+        self.__dict__.update(state)
+
     def __getitem__(self, i):
-        return self.list_representation[i]
+        if not self.lazy:
+            return self.list_representation[i]
+        if isinstance(i, slice):
+            return [self._element(index) for index in range(*i.indices(len(self)))]
+        return self._element(self._index(i))
 
     def __setitem__(self, i, value):
-        self.list_representation[i] = value
+        if not self.lazy:
+            self.list_representation[i] = value
+            return
+        if isinstance(i, slice):
+            indexes = range(*i.indices(len(self)))
+            if len(value) != len(indexes):
+                raise ValueError('The size of a CIPArray can not change')
+            for index, element_value in zip(indexes, value):
+                self._set_element(index, element_value)
+            return
+        self._set_element(self._index(i), value)
+
+    def __iter__(self):
+        if not self.lazy:
+            return iter(self.list_representation)
+        return (self._element(index) for index in range(len(self)))
 
     def __len__(self):
-        return len(self.list_representation)
+        if not self.lazy:
+            return len(self.list_representation)
+        return self.number_of_elements[0] if self.number_of_elements else 0
 
     def __eq__(self, other):
-        return other == self.list_representation
+        if not self.lazy:
+            return other == self.list_representation
+        return other == list(self)
+
+    def _index(self, i: int) -> int:
+        length = len(self)
+        if i < 0:
+            i += length
+        if not 0 <= i < length:
+            raise IndexError('CIPArray index out of range')
+        return i
+
+    def _elements_per_index(self) -> int:
+        return math.prod(self.number_of_elements[1:])
+
+    def _bits(self, start: int, count: int) -> list:
+        return [bool(self.data[bit // 8] >> bit % 8 & 1) for bit in range(start, start + count)]
+
+    def _element(self, index: int):
+        """
+        Decode the element at an index of the first dimension, a nested list when the array has more dimensions
+        :param index:
+        :return:
+        """
+        if index in self._element_cache:
+            return self._element_cache[index]
+        elements_per_index = self._elements_per_index()
+        if self.array_data_type == b'\xc1':
+            element = self._bits(index * elements_per_index, elements_per_index)
+            element = _nested_list(element, self.number_of_elements[1:]) if self.array_dimensions > 1 else element[0]
+        elif self.array_dimensions > 1:
+            element = self._recursive_data_to_array(1, index * elements_per_index)
+        else:
+            element_data_type = self.local_cip_data_type_object
+            if isinstance(element_data_type, CIPStructure):
+                element_data_type = element_data_type.new_instance()
+            elif isinstance(element_data_type, CIPArray):
+                element_data_type = copy.deepcopy(element_data_type)
+            start_bytes = index * self.array_data_type_size
+            element_data_type.data = bytes(self.data[start_bytes:start_bytes + self.array_data_type_size])
+            element = element_data_type.value()
+        if self.element_cache_size:
+            if len(self._element_cache) >= self.element_cache_size:
+                del self._element_cache[next(iter(self._element_cache))]
+            self._element_cache[index] = element
+        return element
+
+    def _set_element(self, index: int, value):
+        """
+        Encode the element at an index of the first dimension into the data
+        :param index:
+        :param value:
+        :return:
+        """
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+        self._element_cache.pop(index, None)
+        elements_per_index = self._elements_per_index()
+        if self.array_data_type == b'\xc1':
+            bits = flatten(value) if self.array_dimensions > 1 else [value]
+            if len(bits) != elements_per_index:
+                raise ValueError('%d Boolean values do not fit in %d elements' % (len(bits), elements_per_index))
+            for bit, bit_value in enumerate(bits, index * elements_per_index):
+                if bit_value:
+                    self.data[bit // 8] |= 1 << bit % 8
+                else:
+                    self.data[bit // 8] &= ~(1 << bit % 8) & 0xff
+            return
+        if self.array_dimensions > 1:
+            element_data = self._recursive_array_to_data(self.array_dimensions - 1, value)
+        else:
+            self.local_cip_data_type_object.from_value(value)
+            element_data = self.local_cip_data_type_object.data
+        start_bytes = index * elements_per_index * self.array_data_type_size
+        if len(element_data) != elements_per_index * self.array_data_type_size:
+            raise ValueError('%d bytes do not fit in %d bytes' %
+                             (len(element_data), elements_per_index * self.array_data_type_size))
+        self.data[start_bytes:start_bytes + len(element_data)] = element_data
 
     @property
     def alignment(self) -> int:
@@ -604,17 +1144,9 @@ class CIPArray(CIPDataType):
         if dimension == self.array_dimensions - 1:
             temp_array = []
             for element in range(self.number_of_elements[dimension]):
-                if self.array_data_type == b'\xc1':
-                    start_bit = (position + element)
-                    if test_bit(int.from_bytes(self.data, 'little'), start_bit):
-                        integer_bool = 1
-                    else:
-                        integer_bool = 0
-                    self.local_cip_data_type_object.data = integer_bool.to_bytes(2, 'little')
-                else:
-                    start_bytes = (position + element) * self.array_data_type_size
-                    self.local_cip_data_type_object.data = \
-                        self.data[start_bytes:start_bytes + self.array_data_type_size]
+                start_bytes = (position + element) * self.array_data_type_size
+                self.local_cip_data_type_object.data = \
+                    self.data[start_bytes:start_bytes + self.array_data_type_size]
                 temp_value = copy.deepcopy(self.local_cip_data_type_object)
                 temp_array.append(temp_value.value())
             return temp_array
@@ -645,23 +1177,104 @@ class CIPArray(CIPDataType):
     def data_type_code():
         return b'\xa3'  # (1-byte signed binary) signed char
 
+    def numpy_dtype(self):
+        """
+        NumPy dtype of the elements, None when the elements are not a primitive type NumPy can represent
+        :return:
+        """
+        if numpy is None:
+            return None
+        if isinstance(self.local_cip_data_type_object, CIPStructure):
+            dtype = self.local_cip_data_type_object.numpy_dtype()
+            return dtype if dtype.itemsize == self.array_data_type_size else None
+        dtype = self.NUMPY_DTYPES.get(self.array_data_type)
+        if dtype is None or numpy.dtype(dtype).itemsize != self.array_data_type_size:
+            return None
+        return numpy.dtype(dtype)
+
+    def _boolean_value(self, use_numpy: bool):
+        """
+        Boolean arrays pack one element per bit, padded to 16 bits, so they are unpacked all at once
+        :param use_numpy:
+        :return:
+        """
+        count = math.prod(self.number_of_elements)
+        if use_numpy:
+            return numpy.unpackbits(numpy.frombuffer(self.data, numpy.uint8), count=count,
+                                    bitorder='little').astype(bool).reshape(self.number_of_elements)
+        return _nested_list(unpack_bits(self.data, count), self.number_of_elements)
+
     def value(self):
+        if self.lazy:
+            # Elements are decoded from the data when they are used
+            self._element_cache = {}
+            return self
+        return self.materialize()
+
+    def materialize(self):
+        """
+        Decode every element into list_representation, nested lists or a NumPy ndarray
+        :return:
+        """
+        use_numpy = self.use_numpy
+        if self.array_data_type == b'\xc1':
+            self.list_representation = self._boolean_value(use_numpy)
+            return self.list_representation
+        dtype = self.numpy_dtype() if use_numpy else None
+        if dtype is not None and len(self.data) >= self.size:
+            self.list_representation = \
+                numpy.frombuffer(self.data, dtype, self.size // dtype.itemsize).reshape(self.number_of_elements).copy()
+            return self.list_representation
         self.list_representation = self._recursive_data_to_array()
         return self.list_representation
 
     def from_value(self, value):
+        if value is self and self.lazy:
+            # Elements set on a lazy array are already encoded in the data
+            return
+        if numpy is not None and isinstance(value, numpy.ndarray) and self.numpy_dtype() is not None:
+            dtype = self.numpy_dtype()
+            if dtype.names is None:
+                data = numpy.ascontiguousarray(value, dtype=dtype).tobytes()
+            else:
+                # Copies of structured arrays leave padding undefined, so the fields are copied into zeros
+                encoded = numpy.zeros(value.shape, dtype)
+                encoded[...] = value
+                data = encoded.tobytes()
+            if len(data) != self.size:
+                raise ValueError('Array of %d bytes does not fit in %d bytes' % (len(data), self.size))
+            self.data = data
+            self.value()
+            return
         if self.array_data_type == b'\xc1':
-            flat_list = flatten(self.list_representation)
-            data_int = 0
-            offset = 0
-            for item in flat_list:
-                if item:
-                    data_int = set_bit(data_int, offset)
-                else:
-                    data_int = clear_bit(data_int, offset)
-                offset = offset + 1
-            self.data = data_int.to_bytes(self.size, 'little')
+            if numpy is None or not isinstance(value, numpy.ndarray):
+                for _ in range(self.array_dimensions - 1):
+                    value = list(itertools.chain.from_iterable(value))
+            self.data = pack_bits(value, self.size)
         else:
             self.data = self._recursive_array_to_data(self.array_dimensions, value)
         # Call value to run the recursive data to array
         self.value()
+
+
+def _numpy_member_dtype(member: CIPDataType):
+    """
+    NumPy dtype of a structure member, raw bytes when NumPy has no type for it
+    :param member:
+    :return:
+    """
+    if isinstance(member, CIPArray):
+        dtype = member.numpy_dtype()
+        if dtype is not None:
+            return numpy.dtype((dtype, tuple(member.number_of_elements)))
+    elif isinstance(member, CIPStructure):
+        return member.numpy_dtype()
+    elif isinstance(member, CIPBoolean):
+        return numpy.dtype('?')
+    elif isinstance(member, CIPString):
+        return numpy.dtype('S%d' % member.size)
+    else:
+        dtype = CIPArray.NUMPY_DTYPES.get(member.data_type_code())
+        if dtype is not None and numpy.dtype(dtype).itemsize == member.size:
+            return numpy.dtype(dtype)
+    return numpy.dtype('V%d' % member.size)
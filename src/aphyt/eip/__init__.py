@@ -5,3 +5,6 @@ __email__ = "jr@aphyt.com"
 
 from .eip import *
 # from .cip_objects.tcp_interface import *
+from .implicit import *
+from .session_pool import *
+from .discovery import *
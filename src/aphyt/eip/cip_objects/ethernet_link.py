@@ -0,0 +1,24 @@
+__author__ = 'Joseph Ryan'
+__license__ = "GPLv2"
+__maintainer__ = "Joseph Ryan"
+__email__ = "jr@aphyt.com"
+
+from aphyt.cip.cip_attributes import CIPObject, CIPAttribute
+from aphyt.cip.cip_datatypes import *
+
+
+class EthernetLinkObject(CIPObject):
+    """
+    Ethernet Link Object, class code 0xF6, with the required attributes of the first Ethernet port
+    """
+    def __init__(self, cip_dispatcher=None, instance_id: bytes = b'\x01'):
+        super().__init__(b'\xf6', cip_dispatcher)
+        self.instance_id = instance_id
+        self.interface_speed = CIPAttribute(class_id=self.class_id, instance_id=self.instance_id,
+                                            attribute_id=b'\x01', data_type=CIPUnsignedDoubleInteger())
+        self.interface_flags = CIPAttribute(class_id=self.class_id, instance_id=self.instance_id,
+                                            attribute_id=b'\x02', data_type=CIPDoubleWord())
+        physical_address = CIPArray()
+        physical_address.from_items(CIPUnsignedShortInteger.data_type_code(), 1, 1, [6], [0])
+        self.physical_address = CIPAttribute(class_id=self.class_id, instance_id=self.instance_id,
+                                             attribute_id=b'\x03', data_type=physical_address)
@@ -0,0 +1,33 @@
+__author__ = 'Joseph Ryan'
+__license__ = "GPLv2"
+__maintainer__ = "Joseph Ryan"
+__email__ = "jr@aphyt.com"
+
+from aphyt.cip.cip_attributes import CIPObject, CIPAttribute
+from aphyt.cip.cip_datatypes import *
+
+
+class IdentityObject(CIPObject):
+    """
+    Identity Object, class code 0x01, that every CIP device has. The product name attribute is a SHORT_STRING,
+    which has no CIP datatype here, so it is not declared
+    """
+    def __init__(self, cip_dispatcher=None):
+        super().__init__(b'\x01', cip_dispatcher)
+        self.instance_id = b'\x01'
+        self.vendor_id = CIPAttribute(class_id=self.class_id, instance_id=self.instance_id,
+                                      attribute_id=b'\x01', data_type=CIPUnsignedInteger())
+        self.device_type = CIPAttribute(class_id=self.class_id, instance_id=self.instance_id,
+                                        attribute_id=b'\x02', data_type=CIPUnsignedInteger())
+        self.product_code = CIPAttribute(class_id=self.class_id, instance_id=self.instance_id,
+                                         attribute_id=b'\x03', data_type=CIPUnsignedInteger())
+        revision = CIPStructure()
+        revision.variable_name = "Revision"
+        revision.add_member('Major Revision', CIPUnsignedShortInteger())
+        revision.add_member('Minor Revision', CIPUnsignedShortInteger())
+        self.revision = CIPAttribute(class_id=self.class_id, instance_id=self.instance_id,
+                                     attribute_id=b'\x04', data_type=revision)
+        self.device_status = CIPAttribute(class_id=self.class_id, instance_id=self.instance_id,
+                                          attribute_id=b'\x05', data_type=CIPWord())
+        self.serial_number = CIPAttribute(class_id=self.class_id, instance_id=self.instance_id,
+                                          attribute_id=b'\x06', data_type=CIPUnsignedDoubleInteger())
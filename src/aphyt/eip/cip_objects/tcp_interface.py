@@ -4,16 +4,15 @@ __maintainer__ = "Joseph Ryan"
 __email__ = "jr@aphyt.com"
 
 from ..eip import *
-from aphyt.cip.cip_attributes import CIPObject, address_request_path_segment
-from aphyt.cip.cip import GetAttributeAllMixin, SetAttributeSingleMixin, GetAttributeSingleMixin, CIPAttribute
+from aphyt.cip.cip_attributes import CIPObject, CIPAttribute, address_request_path_segment
+from aphyt.cip.cip import GetAttributeAllMixin, SetAttributeSingleMixin, GetAttributeSingleMixin
 from aphyt.cip.cip_datatypes import *
 
 
 class TCPInterfaceObject(CIPObject, GetAttributeSingleMixin, SetAttributeSingleMixin, GetAttributeAllMixin):
     def __init__(self, cip_dispatcher: EIPConnectedCIPDispatcher):
-        super().__init__(b'\xf5')
+        super().__init__(b'\xf5', cip_dispatcher)
         self.instance_id = b'\x01'
-        self.cip_dispatcher = cip_dispatcher
         self.revision = CIPAttribute(class_id=self.class_id, instance_id=b'\x00',
                                      attribute_id=b'\x01', data_type=CIPUnsignedInteger())
         self.interface_configuration_status = CIPAttribute(class_id=self.class_id, instance_id=b'\x01',
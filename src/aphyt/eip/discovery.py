@@ -0,0 +1,186 @@
+__author__ = 'Joseph Ryan'
+__license__ = "GPLv2"
+__maintainer__ = "Joseph Ryan"
+__email__ = "jr@aphyt.com"
+
+import asyncio
+import ipaddress
+import socket
+import struct
+from typing import Dict, List, Tuple
+from aphyt.eip.eip import EIPMessage
+
+
+class IdentityRecord:
+    """
+    Identity of a device parsed from the CIP Identity item of a ListIdentity reply
+
+    CIP Identity Item::
+        |-Item Type Code (0x0C)
+        |-Item Length
+        |-Encapsulation Protocol Version
+        |-Socket Address (big endian sin_family, sin_port, sin_addr, sin_zero)
+        |-Vendor ID
+        |-Device Type
+        |-Product Code
+        |-Revision (major, minor)
+        |-Status
+        |-Serial Number
+        |-Product Name (SHORT_STRING)
+        |-State
+    """
+    CIP_IDENTITY_ITEM = b'\x0c\x00'
+
+    def __init__(self, item_data: bytes, sender_address: str = ''):
+        """
+        :param item_data: Data of the CIP Identity item, after the type code and length
+        :param sender_address: Address the reply came from, used when the socket address is not filled in
+        """
+        (self.encapsulation_version, _, self.port, socket_address, self.vendor_id, self.device_type,
+         self.product_code, self.revision_major, self.revision_minor, self.status, self.serial_number,
+         name_length) = struct.unpack_from('<HH', item_data, 0) + struct.unpack_from('>H4s', item_data, 4) + \
+            struct.unpack_from('<HHHBBHLB', item_data, 18)
+        self.product_name = item_data[33:33 + name_length].decode('utf-8', errors='replace')
+        state = item_data[33 + name_length:34 + name_length]
+        self.state = state[0] if state else None
+        self.ip_address = socket.inet_ntoa(socket_address)
+        if self.ip_address == '0.0.0.0' and sender_address:
+            self.ip_address = sender_address
+
+    def __repr__(self):
+        return '%s { vendor: %d | product code: %d | revision: %d.%d | serial: %08x | ip: %s }' % (
+            self.product_name, self.vendor_id, self.product_code, self.revision_major, self.revision_minor,
+            self.serial_number, self.ip_address)
+
+    @property
+    def revision(self) -> str:
+        return '%d.%d' % (self.revision_major, self.revision_minor)
+
+    @staticmethod
+    def from_list_identity_reply(command_data: bytes, sender_address: str = '') -> List["IdentityRecord"]:
+        """
+        Parse every CIP Identity item in the command data of a ListIdentity reply
+        :param command_data:
+        :param sender_address:
+        :return:
+        """
+        records = []
+        item_count = struct.unpack_from('<H', command_data, 0)[0]
+        offset = 2
+        for _ in range(item_count):
+            type_id = command_data[offset:offset + 2]
+            length = struct.unpack_from('<H', command_data, offset + 2)[0]
+            if type_id == IdentityRecord.CIP_IDENTITY_ITEM:
+                records.append(IdentityRecord(command_data[offset + 4:offset + 4 + length], sender_address))
+            offset = offset + 4 + length
+        return records
+
+
+class ListIdentityProtocol(asyncio.DatagramProtocol):
+    """
+    Collects the identity records in the ListIdentity replies received on a datagram endpoint
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.records = []
+        self.waiters = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        reply = EIPMessage()
+        try:
+            reply.from_bytes(data)
+            if reply.command != b'\x63\x00':
+                return
+            records = IdentityRecord.from_list_identity_reply(bytes(reply.command_data), addr[0])
+        except (struct.error, IndexError, OSError):
+            return
+        self.records.extend(records)
+        waiter = self.waiters.pop(addr[0], None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(records)
+
+    def error_received(self, exc):
+        # ICMP port unreachable from hosts without a listener, the probe to them will time out
+        pass
+
+
+class EIPDiscovery:
+    """
+    Find Ethernet/IP devices with the ListIdentity command, either with a broadcast that collects every reply
+    received within a time window, or by probing every address of a subnet with a bounded number of probes
+    in flight
+    """
+    explicit_message_port = 44818
+    MAXIMUM_CONCURRENT_PROBES = 64
+
+    def __init__(self, port: int = explicit_message_port):
+        self.port = port
+
+    async def _open_endpoint(self, local_address: str = '0.0.0.0') -> ListIdentityProtocol:
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_datagram_endpoint(
+            ListIdentityProtocol, local_addr=(local_address, 0), allow_broadcast=True)
+        return protocol
+
+    @staticmethod
+    def _unique_records(records: List[IdentityRecord]) -> List[IdentityRecord]:
+        unique_records: Dict[Tuple[str, int], IdentityRecord] = {}
+        for record in records:
+            unique_records.setdefault((record.ip_address, record.serial_number), record)
+        return list(unique_records.values())
+
+    async def broadcast_list_identity(self, broadcast_address: str = '255.255.255.255', timeout: float = 1.0,
+                                      local_address: str = '0.0.0.0') -> List[IdentityRecord]:
+        """
+        Broadcast ListIdentity and collect the replies that arrive within timeout seconds
+        :param broadcast_address: Broadcast address of the subnet, for example 192.168.250.255
+        :param timeout:
+        :param local_address: Address of the interface to send from
+        :return:
+        """
+        protocol = await self._open_endpoint(local_address)
+        try:
+            protocol.transport.sendto(EIPMessage(b'\x63\x00').bytes(), (broadcast_address, self.port))
+            await asyncio.sleep(timeout)
+        finally:
+            protocol.transport.close()
+        return self._unique_records(protocol.records)
+
+    async def sweep_list_identity(self, network: str, timeout: float = 0.5,
+                                  maximum_concurrent_probes: int = MAXIMUM_CONCURRENT_PROBES,
+                                  local_address: str = '0.0.0.0') -> List[IdentityRecord]:
+        """
+        Send ListIdentity to every host address of a network, for example '192.168.250.0/24', keeping at most
+        maximum_concurrent_probes unanswered at any time
+        :param network: Network in CIDR notation
+        :param timeout: Seconds to wait for each host to reply
+        :param maximum_concurrent_probes:
+        :param local_address:
+        :return:
+        """
+        protocol = await self._open_endpoint(local_address)
+        semaphore = asyncio.Semaphore(maximum_concurrent_probes)
+        list_identity_bytes = EIPMessage(b'\x63\x00').bytes()
+        loop = asyncio.get_running_loop()
+
+        async def probe(host: str):
+            async with semaphore:
+                waiter = loop.create_future()
+                protocol.waiters[host] = waiter
+                protocol.transport.sendto(list_identity_bytes, (host, self.port))
+                try:
+                    await asyncio.wait_for(waiter, timeout)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    protocol.waiters.pop(host, None)
+
+        try:
+            await asyncio.gather(*[probe(str(host)) for host in ipaddress.ip_network(network, strict=False).hosts()])
+        finally:
+            protocol.transport.close()
+        return self._unique_records(protocol.records)
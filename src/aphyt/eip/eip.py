@@ -5,7 +5,8 @@ __email__ = "jr@aphyt.com"
 
 import asyncio
 from abc import ABC, abstractmethod
-from aphyt.cip.cip import CIPReply, CIPRequest, AsyncCIPDispatcher, CIPDispatcher, CIPException
+from aphyt.cip.cip import CIPReply, CIPRequest, AsyncCIPDispatcher, CIPDispatcher, CIPException, \
+    ForwardOpenRequest, ForwardOpenReply
 import struct
 import binascii
 import socket
@@ -14,12 +15,37 @@ from typing import List, Tuple
 from aphyt.cip import *
 
 
+class EIPException(Exception):
+    """
+    Ethernet/IP encapsulation error, for a reply whose header status is not success
+    """
+    encapsulation_status_dictionary = {
+        0x0001: 'Invalid or unsupported encapsulation command',
+        0x0002: 'Insufficient memory in the target to handle the command',
+        0x0003: 'Poorly formed or incorrect data in the command data',
+        0x0064: 'Invalid session handle',
+        0x0065: 'Invalid length',
+        0x0069: 'Unsupported encapsulation protocol revision',
+    }
+
+    def __init__(self, status: bytes, reply: "EIPMessage" = None):
+        self.status = status
+        self.reply = reply
+        status_code = int.from_bytes(status, 'little')
+        super().__init__(f'Ethernet/IP reply contained an encapsulation status of {status_code:#06x}, '
+                         f'{self.encapsulation_status_dictionary.get(status_code, "unknown status")}')
+
+
 class DataAndAddressItem:
     """
     Data and address items store the data used in common packet format
     EIP-CIP-V2-1.0.pdf Table 2-7.2 – Data and Address item format
+
+    The data of items parsed from a reply is a memoryview over the received frame
     """
+    __slots__ = ('type_id', 'length', 'data')
     NULL_ADDRESS_ITEM = b'\x00\x00'
+    CONNECTED_ADDRESS_ITEM = b'\xa1\x00'
     CONNECTED_TRANSPORT_PACKET = b'\xb1\x00'
     UNCONNECTED_MESSAGE = b'\xb2\x00'
     LIST_SERVICES_RESPONSE = b'\x00\x01'
@@ -33,18 +59,22 @@ class DataAndAddressItem:
         self.data = data
 
     def from_bytes(self, bytes_data_address_item: bytes):
-        self.type_id = bytes_data_address_item[0:2]
-        self.length = bytes_data_address_item[2:4]
-        self.data = bytes_data_address_item[4:]
+        item_view = memoryview(bytes_data_address_item)
+        self.type_id = bytes(item_view[0:2])
+        self.length = bytes(item_view[2:4])
+        self.data = item_view[4:]
 
     def bytes(self):
-        return self.type_id + self.length + self.data
+        return b''.join((self.type_id, self.length, self.data))
 
 
 class CommonPacketFormat:
     """
     Common Packet Format stores the Data and Address packets. Used in both requests and replies.
     """
+    __slots__ = ('packets', 'item_count', 'packet_bytes')
+    # Type id and length of a data and address item
+    ITEM_HEADER = struct.Struct('<2sH')
 
     def __init__(self, packets: List[DataAndAddressItem]):
         self.packets = [DataAndAddressItem(DataAndAddressItem.NULL_ADDRESS_ITEM, b''),
@@ -56,22 +86,35 @@ class CommonPacketFormat:
         else:
             self.packets = packets
         self.item_count = len(self.packets)
-        self.packet_bytes = b''
-        for packet in self.packets:
-            self.packet_bytes += packet.bytes()
+        self.packet_bytes = b''.join([packet.bytes() for packet in self.packets])
+
+    @classmethod
+    def parse(cls, bytes_common_packet_format: bytes) -> "CommonPacketFormat":
+        """
+        Create a common packet format from received bytes without first building the default null items
+        :param bytes_common_packet_format:
+        :return:
+        """
+        common_packet_format = cls.__new__(cls)
+        common_packet_format.from_bytes(bytes_common_packet_format)
+        return common_packet_format
 
     def from_bytes(self, bytes_common_packet_format: bytes):
-        self.item_count = int.from_bytes(bytes_common_packet_format[0:2], 'little')
-        self.packet_bytes = bytes_common_packet_format[2:]
-        packet_offset = 0
-        packet_index = 0
-        while packet_offset < len(self.packet_bytes):
-            data_address_item_id = self.packet_bytes[packet_offset: packet_offset + 2]
-            data_address_item_length = int.from_bytes(self.packet_bytes[packet_offset + 2: packet_offset + 4], 'little')
-            data_address_item_data = self.packet_bytes[packet_offset + 4: packet_offset + data_address_item_length + 4]
-            self.packets[packet_index] = DataAndAddressItem(data_address_item_id, data_address_item_data)
+        """
+        Parse the items without copying their data, each item's data is a memoryview slice
+        :param bytes_common_packet_format:
+        :return:
+        """
+        packet_view = memoryview(bytes_common_packet_format)
+        self.item_count = struct.unpack_from('<H', packet_view, 0)[0]
+        self.packet_bytes = packet_view[2:]
+        self.packets = []
+        packet_offset = 2
+        while packet_offset < len(packet_view):
+            data_address_item_id, data_address_item_length = self.ITEM_HEADER.unpack_from(packet_view, packet_offset)
+            data_address_item_data = packet_view[packet_offset + 4:packet_offset + data_address_item_length + 4]
+            self.packets.append(DataAndAddressItem(data_address_item_id, data_address_item_data))
             packet_offset = packet_offset + data_address_item_length + 4
-            packet_index = packet_index + 1
 
     def bytes(self):
         return self.item_count.to_bytes(2, 'little') + self.packet_bytes
@@ -81,6 +124,9 @@ class CommandSpecificData:
     """
     Command Specific Data is sent in an EIP send rr command
     """
+    __slots__ = ('interface_handle', 'timeout', 'encapsulated_packet')
+    # Interface handle and timeout
+    HEADER = struct.Struct('<4s2s')
 
     def __init__(self, interface_handle: bytes = b'\x00\x00\x00\x00',
                  timeout: bytes = b'\x08\x00',
@@ -90,12 +136,11 @@ class CommandSpecificData:
         self.encapsulated_packet = encapsulated_packet
 
     def from_bytes(self, bytes_command_specific_data: bytes):
-        self.interface_handle = bytes_command_specific_data[0:4]
-        self.timeout = bytes_command_specific_data[4:6]
-        self.encapsulated_packet = bytes_command_specific_data[6:]
+        self.interface_handle, self.timeout = self.HEADER.unpack_from(bytes_command_specific_data, 0)
+        self.encapsulated_packet = memoryview(bytes_command_specific_data)[6:]
 
     def bytes(self):
-        return self.interface_handle + self.timeout + self.encapsulated_packet
+        return b''.join((self.interface_handle, self.timeout, self.encapsulated_packet))
 
 
 class EIPMessage:
@@ -108,7 +153,15 @@ class EIPMessage:
             |-Data And Address Item
               |-CIP Message
                 |-Route Path
+
+    The command data of a parsed message is a memoryview over the received frame, so the layers below it are
+    parsed without copying the frame again
     """
+    __slots__ = ('command', 'length', 'session_handle_id', 'status', 'sender_context_data', 'command_options',
+                 'command_data')
+    HEADER_LENGTH = 24
+    # Command, length, session handle, status, sender context and options
+    HEADER = struct.Struct('<2s2s4s4s8s4s')
 
     def __init__(self, command=b'\x00\x00', command_data=b'', session_handle_id=b'\x00\x00\x00\x00',
                  status=b'\x00\x00\x00\x00', sender_context_data=b'\x00\x00\x00\x00\x00\x00\x00\x00',
@@ -131,27 +184,139 @@ class EIPMessage:
         self.command_data = command_data
 
     def bytes(self) -> bytes:
-        return \
-            self.command + self.length + self.session_handle_id + self.status + \
-            self.sender_context_data + self.command_options + self.command_data
+        return self.HEADER.pack(self.command, self.length, self.session_handle_id, self.status,
+                                self.sender_context_data, self.command_options) + self.command_data
 
     def from_bytes(self, eip_message_bytes: bytes):
-        self.command = eip_message_bytes[0:2]
-        self.length = eip_message_bytes[2:4]
-        self.session_handle_id = eip_message_bytes[4:8]
-        self.status = eip_message_bytes[8:12]
-        self.sender_context_data = eip_message_bytes[12:20]
-        self.command_options = eip_message_bytes[20:24]
-        self.command_data = eip_message_bytes[24:]
+        message_view = memoryview(eip_message_bytes)
+        self.from_header(message_view, message_view[self.HEADER_LENGTH:])
+
+    def from_header(self, header: bytes, command_data: bytes):
+        """
+        Parse a message whose header and command data were received separately
+        :param header:
+        :param command_data:
+        :return:
+        """
+        (self.command, self.length, self.session_handle_id, self.status, self.sender_context_data,
+         self.command_options) = self.HEADER.unpack_from(header, 0)
+        self.command_data = command_data
 
     def context_integer(self):
         return struct.unpack('<Q', self.sender_context_data)[0]
 
+    def response_key(self):
+        """
+        The key that pairs a request with its reply. Send unit data (connected) messages are paired by the
+        sequence count of the connected data item, all other messages by their sender context. A send unit data
+        reply too short to hold the sequence count, such as an encapsulation error, has no key
+        :return:
+        """
+        if self.command == b'\x70\x00':
+            # Interface handle, timeout, item count and the connected address item precede the connected
+            # data item, whose data starts with the sequence count
+            if len(self.command_data) < 22:
+                return None
+            return 'sequence_count', struct.unpack_from('<H', self.command_data, 20)[0]
+        return self.context_integer()
+
     def set_context(self, value: int):
         self.sender_context_data = struct.pack('<Q', value)
 
     def total_length(self):
-        return struct.unpack('<H', self.length)[0] + 24
+        return struct.unpack('<H', self.length)[0] + self.HEADER_LENGTH
+
+    @classmethod
+    def frame_length(cls, buffer, offset: int = 0) -> int:
+        """
+        The total length of the message whose header starts at offset in buffer, read without slicing the buffer
+        :param buffer:
+        :param offset:
+        :return:
+        """
+        return struct.unpack_from('<H', buffer, offset + 2)[0] + cls.HEADER_LENGTH
+
+
+class EIPRequestFrame:
+    """
+    A request frame filled in from an EIPRequestTemplate. It is sent like an EIPMessage, the dispatchers only
+    set its sender context, read its response key and write its bytes
+    """
+    __slots__ = ('frame',)
+
+    def __init__(self, frame: bytearray):
+        self.frame = frame
+
+    @property
+    def command(self) -> bytes:
+        return bytes(self.frame[0:2])
+
+    def set_context(self, value: int):
+        struct.pack_into('<Q', self.frame, 12, value)
+
+    def context_integer(self):
+        return struct.unpack_from('<Q', self.frame, 12)[0]
+
+    def response_key(self):
+        if self.frame[0:2] == b'\x70\x00':
+            sequence_count_offset = EIPRequestTemplate.UNIT_DATA_PREFIX_LENGTH - 2
+            return 'sequence_count', struct.unpack_from('<H', self.frame, sequence_count_offset)[0]
+        return self.context_integer()
+
+    def bytes(self) -> bytearray:
+        return self.frame
+
+
+class EIPRequestTemplate:
+    """
+    Precomputed bytes of send_rr_data (UCMM) or send_unit_data (connected) requests for one session. Everything
+    up to the CIP request is the same for every request of a session: the encapsulation header with the
+    session handle, the interface handle and timeout, the item count, the address item and the type of the
+    data item. Only the lengths, the sender context and the sequence count are packed into a copy of it
+    """
+    __slots__ = ('command', 'prefix')
+    SEND_RR_DATA = b'\x6f\x00'
+    SEND_UNIT_DATA = b'\x70\x00'
+    # Header, interface handle, timeout, item count, null address item and the unconnected data item header
+    RR_DATA_PREFIX_LENGTH = 40
+    # Header, interface handle, timeout, item count, connected address item, connected data item header and
+    # the sequence count
+    UNIT_DATA_PREFIX_LENGTH = 46
+
+    def __init__(self, command: bytes, session_handle_id: bytes, connection_id: bytes = b''):
+        """
+        :param command: SEND_RR_DATA or SEND_UNIT_DATA
+        :param session_handle_id:
+        :param connection_id: O->T connection id of the class 3 connection for SEND_UNIT_DATA
+        """
+        self.command = command
+        if command == self.SEND_UNIT_DATA:
+            packets = [DataAndAddressItem(DataAndAddressItem.CONNECTED_ADDRESS_ITEM, connection_id),
+                       DataAndAddressItem(DataAndAddressItem.CONNECTED_TRANSPORT_PACKET, b'\x00\x00')]
+            # The timeout of send unit data shall be zero, connections have their own timeout
+            command_specific_data = CommandSpecificData(timeout=b'\x00\x00',
+                                                        encapsulated_packet=CommonPacketFormat(packets).bytes())
+        else:
+            packets = [DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, b'')]
+            command_specific_data = CommandSpecificData(encapsulated_packet=CommonPacketFormat(packets).bytes())
+        self.prefix = bytes(EIPMessage(command, command_specific_data.bytes(), session_handle_id).bytes())
+
+    def request(self, cip_request: bytes, sequence_count: int = 0) -> EIPRequestFrame:
+        """
+        Fill in a copy of the template. Every request gets its own bytearray as the frame may still be queued
+        for writing while the next request is built
+        :param cip_request:
+        :param sequence_count: Sequence count of the connected data item for SEND_UNIT_DATA
+        :return:
+        """
+        frame = bytearray(self.prefix)
+        frame += cip_request
+        struct.pack_into('<H', frame, 2, len(frame) - EIPMessage.HEADER_LENGTH)
+        if self.command == self.SEND_UNIT_DATA:
+            struct.pack_into('<HH', frame, self.UNIT_DATA_PREFIX_LENGTH - 4, len(cip_request) + 2, sequence_count)
+        else:
+            struct.pack_into('<H', frame, self.RR_DATA_PREFIX_LENGTH - 2, len(cip_request))
+        return EIPRequestFrame(frame)
 
 
 class EIPDispatcher(ABC):
@@ -173,7 +338,7 @@ class EIPDispatcher(ABC):
         :return:
         """
         eip_message = EIPMessage(b'\x63\x00')
-        return self.send_command(eip_message, host).command_data
+        return bytes(self.send_command(eip_message, host).command_data)
 
     def list_services(self, host=''):
         """
@@ -181,7 +346,7 @@ class EIPDispatcher(ABC):
         :return:
         """
         eip_message = EIPMessage(b'\x04\x00')
-        return self.send_command(eip_message, host).command_data
+        return bytes(self.send_command(eip_message, host).command_data)
 
     def list_interfaces(self, host=''):
         """
@@ -189,7 +354,7 @@ class EIPDispatcher(ABC):
         :return:
         """
         eip_message = EIPMessage(b'\x64\x00')
-        return self.send_command(eip_message, host).command_data
+        return bytes(self.send_command(eip_message, host).command_data)
 
 
 class AsyncEIPDispatcher(ABC):
@@ -211,7 +376,7 @@ class AsyncEIPDispatcher(ABC):
         :return:
         """
         eip_message = EIPMessage(b'\x63\x00')
-        return await self.send_command(eip_message, host).command_data
+        return bytes((await self.send_command(eip_message, host)).command_data)
 
     async def list_services(self, host=''):
         """
@@ -219,7 +384,7 @@ class AsyncEIPDispatcher(ABC):
         :return:
         """
         eip_message = EIPMessage(b'\x04\x00')
-        return await self.send_command(eip_message, host).command_data
+        return bytes((await self.send_command(eip_message, host)).command_data)
 
     async def list_interfaces(self, host=''):
         """
@@ -227,11 +392,17 @@ class AsyncEIPDispatcher(ABC):
         :return:
         """
         eip_message = EIPMessage(b'\x64\x00')
-        return await self.send_command(eip_message, host).command_data
+        return bytes((await self.send_command(eip_message, host)).command_data)
 
 
 class AsyncEIPConnectedCommandMixin(AsyncEIPDispatcher):
-    lock = asyncio.Lock()
+    """
+    Explicit Ethernet/IP messaging over a single TCP session. A single reader task per connection parses
+    reply frames and resolves the Future waiting on the matching sender context, so many requests can be
+    in flight on the same session at once. maximum_outstanding_requests sets the size of that window.
+    """
+    MAXIMUM_OUTSTANDING_REQUESTS = 8
+
     def __init__(self):
         super().__init__()
         self.explicit_message_socket = None
@@ -242,45 +413,86 @@ class AsyncEIPConnectedCommandMixin(AsyncEIPDispatcher):
         self.has_session_handle = False
         self.BUFFER_SIZE = 4096
         self.host = None
+        self._pending_responses = {}
+        self._reader_task = None
+        self._outstanding_requests = None
+        self.maximum_outstanding_requests = self.MAXIMUM_OUTSTANDING_REQUESTS
 
-    async def get_response(self, eip_message: EIPMessage):
-        if eip_message.context_integer() in self.eip_responses.keys():
-            result = self.eip_responses.pop(eip_message.context_integer())
-            return result
-        else:
-            self.stream_writer.write(eip_message.bytes())
-            await self.stream_writer.drain()
-            async with AsyncEIPConnectedCommandMixin.lock:
-                received_data = await self.stream_reader.readexactly(n=24)
-                received_data += await self.stream_reader.readexactly(n=struct.unpack('<H',received_data[2:4])[0])
-            length = struct.unpack('<H',received_data[2:4])[0] + 24
-            received_eip_message = EIPMessage()
-            received_eip_message.from_bytes(received_data[0:length])
-            # Below recreates the extraction of a CIP reply that normally occurs in execute_cip_command and
-            # send_rr_data, but we want to check for x02 resource unavailable response
-            reply_command_specific_data = CommandSpecificData()
-            reply_command_specific_data.from_bytes(received_eip_message.command_data)
-            reply_packet = CommonPacketFormat([])
-            reply_packet.from_bytes(reply_command_specific_data.encapsulated_packet)
-            response = reply_packet.packets[1].bytes()
-            reply_data_and_address_item = DataAndAddressItem('', b'')
-            reply_data_and_address_item.from_bytes(response)
-            cip_reply = CIPReply(reply_data_and_address_item.data)
-            if cip_reply.general_status == b'\x02':
-                # Don't add the response to the eip_responses dictionary if it is "resource unavailable"
-                # because we should try again because the resource was flooded
-                pass
-            else:
-                self.eip_responses[received_eip_message.context_integer()] = received_eip_message
+    @property
+    def maximum_outstanding_requests(self) -> int:
+        """
+        The number of requests that may be waiting on a reply at the same time. Too large a window can exhaust
+        the Ethernet/IP resources of the target, which will then reply with resource unavailable (0x02)
+        :return:
+        """
+        return self._maximum_outstanding_requests
+
+    @maximum_outstanding_requests.setter
+    def maximum_outstanding_requests(self, value: int):
+        if value < 1:
+            raise ValueError('At least one request must be allowed to wait on a reply')
+        self._maximum_outstanding_requests = value
+        self._outstanding_requests = asyncio.Semaphore(value)
+
+    async def get_response(self, eip_message: EIPMessage) -> EIPMessage:
+        """
+        Write the Ethernet/IP message and wait for the reply that carries the same sender context
+        :param eip_message:
+        :return:
+        """
+        context = eip_message.response_key()
+        async with self._outstanding_requests:
+            self._start_response_reader()
+            future = asyncio.get_running_loop().create_future()
+            self._pending_responses[context] = future
             try:
-                response = await self.get_response(eip_message)
-            except RecursionError as e:
-                if cip_reply.general_status == b'\x02':
-                    raise CIPException(b'\x02', b'')
-                else:
-                    raise e
-            return response
+                self.stream_writer.write(eip_message.bytes())
+                await self.stream_writer.drain()
+                return await future
+            finally:
+                self._pending_responses.pop(context, None)
 
+    def _start_response_reader(self):
+        if self._reader_task is None or self._reader_task.done():
+            self._reader_task = asyncio.get_running_loop().create_task(self._read_responses())
+
+    async def _read_responses(self):
+        """
+        Read reply frames for as long as the connection is open, handing each one to the request waiting on it
+        :return:
+        """
+        try:
+            while True:
+                header = await self.stream_reader.readexactly(EIPMessage.HEADER_LENGTH)
+                command_data = await self.stream_reader.readexactly(struct.unpack('<H', header[2:4])[0])
+                received_eip_message = EIPMessage()
+                received_eip_message.from_header(header, command_data)
+                response_key = received_eip_message.response_key()
+                if response_key is None:
+                    # A reply without a key can not be matched, so it is taken to answer the oldest request
+                    response_key = next(iter(self._pending_responses), None)
+                future = self._pending_responses.pop(response_key, None)
+                if future is None or future.done():
+                    continue
+                if received_eip_message.status != b'\x00\x00\x00\x00':
+                    future.set_exception(EIPException(received_eip_message.status, received_eip_message))
+                else:
+                    future.set_result(received_eip_message)
+        except (asyncio.IncompleteReadError, OSError) as err:
+            self._fail_pending_responses(ConnectionError(f'Ethernet/IP connection to {self.host} lost: {err}'))
+        except asyncio.CancelledError:
+            self._fail_pending_responses(ConnectionError(f'Ethernet/IP connection to {self.host} closed'))
+            raise
+        except Exception as err:
+            # Nothing else will read from the connection, so no waiting request would ever get its reply
+            self._fail_pending_responses(ConnectionError(f'Ethernet/IP reply from {self.host} not understood: {err}'))
+            raise
+
+    def _fail_pending_responses(self, error: Exception):
+        for future in self._pending_responses.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending_responses.clear()
 
     async def send_command(self, eip_command: EIPMessage, host) -> EIPMessage:
         """
@@ -321,8 +533,17 @@ class AsyncEIPConnectedCommandMixin(AsyncEIPDispatcher):
         self.is_connected_explicit = False
         self.has_session_handle = False
         self.host = None
-        if self.explicit_message_socket:
-            await self.explicit_message_socket.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        self._fail_pending_responses(ConnectionError('Ethernet/IP connection closed'))
+        if self.stream_writer is not None:
+            self.stream_writer.close()
+            try:
+                await self.stream_writer.wait_closed()
+            except OSError:
+                pass
+            self.stream_writer = None
 
     async def register_session(self, command_data=b'\x01\x00\x00\x00'):
         """
@@ -346,30 +567,88 @@ class EIPConnectedCommandMixin(EIPDispatcher):
         self.has_session_handle = False
         self.BUFFER_SIZE = 4096
         self.host = None
+        self._receive_buffer = bytearray(self.BUFFER_SIZE)
+        self._receive_view = memoryview(self._receive_buffer)
+        self._receive_start = 0
+        self._receive_end = 0
 
     def __del__(self):
         self.close_explicit()
 
-    def get_response(self, eip_message: EIPMessage):
-        if eip_message.context_integer() in self.eip_responses.keys():
-            result = self.eip_responses.pop(eip_message.context_integer())
-            return result
-        else:
-            self.explicit_message_socket.send(eip_message.bytes())
-            received_data = self.explicit_message_socket.recv(self.BUFFER_SIZE)
-            length = struct.unpack('<H',received_data[2:4])[0] + 24
+    def get_response(self, eip_message: EIPMessage) -> EIPMessage:
+        """
+        Send the Ethernet/IP message and receive until the reply with the same sender context has arrived.
+        Replies to other requests that arrive first are kept in eip_responses
+        :param eip_message:
+        :return:
+        """
+        context = eip_message.response_key()
+        if context not in self.eip_responses:
+            self.explicit_message_socket.sendall(eip_message.bytes())
+        while context not in self.eip_responses and None not in self.eip_responses:
+            self._receive_into_buffer()
+            self._dispatch_received_frames()
+        reply = self.eip_responses.pop(context, None)
+        if reply is None:
+            # A reply without a key can only answer the request that is waiting
+            reply = self.eip_responses.pop(None)
+        if reply.status != b'\x00\x00\x00\x00':
+            raise EIPException(reply.status, reply)
+        return reply
+
+    def _receive_into_buffer(self):
+        """
+        Receive from the socket into the free space at the end of the receive buffer
+        :return:
+        """
+        if self._receive_end == len(self._receive_buffer):
+            self._reserve_receive_buffer(self._receive_end - self._receive_start + 1)
+        received = self.explicit_message_socket.recv_into(self._receive_view[self._receive_end:])
+        if received == 0:
+            raise ConnectionError(f'Ethernet/IP connection to {self.host} was closed by the target')
+        self._receive_end += received
+
+    def _dispatch_received_frames(self):
+        """
+        Hand every complete frame in the receive buffer to eip_responses. A partial frame is left in place
+        until the rest of it has been received
+        :return:
+        """
+        while self._receive_end - self._receive_start >= EIPMessage.HEADER_LENGTH:
+            frame_length = EIPMessage.frame_length(self._receive_buffer, self._receive_start)
+            if self._receive_end - self._receive_start < frame_length:
+                self._reserve_receive_buffer(frame_length)
+                return
+            frame_end = self._receive_start + frame_length
             received_eip_message = EIPMessage()
-            while len(received_data) > length:
-                received_eip_message.from_bytes(received_data[0:length])
-                received_data = received_data[length:]
-                length = struct.unpack('<H', received_data[2:4])[0] + 24
-                self.eip_responses[received_eip_message.context_integer()] = received_eip_message
-            received_eip_message.from_bytes(received_data[0:length])
-            if len(received_data) > 0:
-                received_eip_message.from_bytes(received_data)
-            self.eip_responses[received_eip_message.context_integer()] = received_eip_message
-            return self.get_response(eip_message)
-
+            # The frame is copied out once as the buffer is reused by the next receive
+            received_eip_message.from_bytes(bytes(self._receive_view[self._receive_start:frame_end]))
+            self.eip_responses[received_eip_message.response_key()] = received_eip_message
+            self._receive_start = frame_end
+        if self._receive_start == self._receive_end:
+            self._receive_start = 0
+            self._receive_end = 0
+
+    def _reserve_receive_buffer(self, frame_length: int):
+        """
+        Make room for a frame of frame_length bytes at the start of the unprocessed data, moving the
+        unprocessed data to the front of the buffer and growing the buffer if the frame will not fit
+        :param frame_length:
+        :return:
+        """
+        unprocessed = self._receive_end - self._receive_start
+        if frame_length > len(self._receive_buffer):
+            receive_buffer = bytearray(max(frame_length, 2 * len(self._receive_buffer)))
+            receive_buffer[0:unprocessed] = self._receive_view[self._receive_start:self._receive_end]
+            self._receive_view.release()
+            self._receive_buffer = receive_buffer
+            self._receive_view = memoryview(self._receive_buffer)
+        elif self._receive_start + frame_length > len(self._receive_buffer):
+            self._receive_buffer[0:unprocessed] = self._receive_view[self._receive_start:self._receive_end]
+        else:
+            return
+        self._receive_start = 0
+        self._receive_end = unprocessed
 
     def send_command(self, eip_command: EIPMessage, host) -> EIPMessage:
         """
@@ -415,6 +694,8 @@ class EIPConnectedCommandMixin(EIPDispatcher):
         self.is_connected_explicit = False
         self.has_session_handle = False
         self.host = None
+        self._receive_start = 0
+        self._receive_end = 0
         if self.explicit_message_socket:
             self.explicit_message_socket.close()
 
@@ -433,7 +714,7 @@ class EIPConnectedCommandMixin(EIPDispatcher):
 
 class EIPUnconnectedCommandMixin(EIPDispatcher):
     """
-    ToDo add broadcast_command to return a List of EIPMessages (List Service to a full domain)
+    Single unconnected command over UDP. EIPDiscovery in discovery.py broadcasts ListIdentity and sweeps subnets
     """
     def __init__(self):
         super().__init__()
@@ -464,13 +745,136 @@ class EIPUnconnectedCommandMixin(EIPDispatcher):
         return received_eip_message
 
 
-class AsyncEIPConnectedCIPDispatcher(AsyncEIPConnectedCommandMixin, AsyncCIPDispatcher):
+class ConnectedMessagingMixin:
+    """
+    State and packet formatting shared by the synchronous and asynchronous dispatchers for class 3 connected
+    explicit messaging. Until a connection is opened with Forward Open, requests are sent unconnected (UCMM)
+    with send_rr_data. Once it is open, they are sent with send_unit_data using sequenced connected data items,
+    and may be as large as the negotiated connection size
+    """
+    UCMM_MAXIMUM_LENGTH = 502
+    # Connection sizes include the two byte sequence count of the connected data item
+    CONNECTION_SIZE = 504
+    LARGE_CONNECTION_SIZE = 4002
+
+    def __init__(self):
+        super().__init__()
+        self.forward_open_request = None
+        self.forward_open_reply = None
+        self.sequence_count = 0
+        self._request_templates = {}
+
+    @property
+    def is_connected_class_3(self) -> bool:
+        return self.forward_open_reply is not None
+
+    @property
+    def maximum_message_length(self) -> int:
+        """
+        Largest CIP message that can be sent or received, 502 bytes for unconnected messages or the negotiated
+        connection size for connected messages
+        :return:
+        """
+        if self.is_connected_class_3:
+            return min(self.forward_open_request.connection_size,
+                       self.forward_open_request.t_o_connection_size) - 2
+        return self.UCMM_MAXIMUM_LENGTH
+
+    def _forward_open_request(self, large: bool) -> ForwardOpenRequest:
+        connection_size = self.LARGE_CONNECTION_SIZE if large else self.CONNECTION_SIZE
+        return ForwardOpenRequest(connection_size, large=large)
+
+    def _connection_opened(self, forward_open_request: ForwardOpenRequest, reply: CIPReply):
+        self.forward_open_request = forward_open_request
+        self.forward_open_reply = ForwardOpenReply(reply.bytes)
+        self.sequence_count = 0
+        self._request_templates.clear()
+
+    def _connection_closed(self):
+        self.forward_open_request = None
+        self.forward_open_reply = None
+        self._request_templates.clear()
+
+    def _request_template(self, command: bytes) -> EIPRequestTemplate:
+        """
+        The cached template for the command and the current session handle
+        :param command:
+        :return:
+        """
+        key = (self.session_handle_id, command)
+        template = self._request_templates.get(key)
+        if template is None:
+            connection_id = self.forward_open_reply.o_t_connection_id if self.is_connected_class_3 else b''
+            template = EIPRequestTemplate(command, self.session_handle_id, connection_id)
+            self._request_templates[key] = template
+        return template
+
+    def _request_frame(self, request: CIPRequest) -> EIPRequestFrame:
+        """
+        The send_unit_data frame for the request when a class 3 connection is open, otherwise the
+        send_rr_data frame
+        :param request:
+        :return:
+        """
+        if self.is_connected_class_3:
+            self.sequence_count = (self.sequence_count + 1) % 65536
+            return self._request_template(EIPRequestTemplate.SEND_UNIT_DATA).request(request.bytes,
+                                                                                    self.sequence_count)
+        return self._request_template(EIPRequestTemplate.SEND_RR_DATA).request(request.bytes)
+
+    @staticmethod
+    def _unconnected_command_specific_data(request: CIPRequest) -> bytes:
+        data_address_item = DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, request.bytes)
+        packets = [data_address_item]
+        # ToDo add interface handle to track responses?
+        common_packet_format = CommonPacketFormat(packets)
+        command_specific_data = CommandSpecificData(encapsulated_packet=common_packet_format.bytes())
+        return command_specific_data.bytes()
+
+    def _unit_data_command_specific_data(self, cip_request: bytes) -> bytes:
+        """
+        Command specific data for send_unit_data carrying the CIP request on the open connection with the
+        next sequence count
+        :param cip_request:
+        :return:
+        """
+        self.sequence_count = (self.sequence_count + 1) % 65536
+        packets = [DataAndAddressItem(DataAndAddressItem.CONNECTED_ADDRESS_ITEM,
+                                      self.forward_open_reply.o_t_connection_id),
+                   DataAndAddressItem(DataAndAddressItem.CONNECTED_TRANSPORT_PACKET,
+                                      self.sequence_count.to_bytes(2, 'little') + cip_request)]
+        common_packet_format = CommonPacketFormat(packets)
+        # The timeout of send unit data shall be zero, connections have their own timeout
+        command_specific_data = CommandSpecificData(timeout=b'\x00\x00',
+                                                    encapsulated_packet=common_packet_format.bytes())
+        return command_specific_data.bytes()
+
+    @staticmethod
+    def _common_packet_format_from_reply(reply: EIPMessage) -> CommonPacketFormat:
+        reply_command_specific_data = CommandSpecificData()
+        reply_command_specific_data.from_bytes(reply.command_data)
+        return CommonPacketFormat.parse(reply_command_specific_data.encapsulated_packet)
+
+    @staticmethod
+    def _cip_reply_from_packet(reply_packet: CommonPacketFormat) -> CIPReply:
+        reply_data_and_address_item = reply_packet.packets[1]
+        if reply_data_and_address_item.type_id == DataAndAddressItem.CONNECTED_TRANSPORT_PACKET:
+            # Connected data items start with the sequence count
+            return CIPReply(reply_data_and_address_item.data[2:])
+        return CIPReply(reply_data_and_address_item.data)
+
+
+class AsyncEIPConnectedCIPDispatcher(ConnectedMessagingMixin, AsyncEIPConnectedCommandMixin, AsyncCIPDispatcher):
     """
     EIP is an encapsulation protocol for CIP (common industrial protocol) messages
     """
 
     null_address_item = b'\x00\x00\x00\x00'
     cip_handle = b'\x00\x00\x00\x00'
+    # Number of times a request is sent again when the target replies that it is out of resources
+    RESOURCE_UNAVAILABLE_RETRIES = 100
+    # Seconds to wait for the reply to Forward Close when the connection is closed
+    FORWARD_CLOSE_TIMEOUT = 1.0
 
     def __init__(self):
         super().__init__()
@@ -481,22 +885,16 @@ class AsyncEIPConnectedCIPDispatcher(AsyncEIPConnectedCommandMixin, AsyncCIPDisp
         :param request:
         :return:
         """
-        data_address_item = DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, request.bytes)
-        packets = [data_address_item]
-        # ToDo add interface handle to track responses?
-        common_packet_format = CommonPacketFormat(packets)
-        command_specific_data = CommandSpecificData(encapsulated_packet=common_packet_format.bytes())
-        response = await self.send_rr_data(command_specific_data.bytes())
-        response = response.packets[1].bytes()
-        reply_data_and_address_item = DataAndAddressItem('', b'')
-        # ToDo is this removing error data?
-        reply_data_and_address_item.from_bytes(response)
-        cip_reply = CIPReply(reply_data_and_address_item.data)
+        for _ in range(self.RESOURCE_UNAVAILABLE_RETRIES + 1):
+            reply = await self.send_command(self._request_frame(request), self.host)
+            cip_reply = self._cip_reply_from_packet(self._common_packet_format_from_reply(reply))
+            if cip_reply.general_status != b'\x02':
+                # Resource unavailable means the target was flooded, so the request is sent again
+                break
         if cip_reply.general_status != b'\x00':
-            raise CIPException(cip_reply.general_status, cip_reply.extended_status)
+            raise CIPException(cip_reply.general_status, cip_reply.extended_status, cip_reply)
         return cip_reply
 
-
     async def send_rr_data(self, command_specific_data: bytes) -> CommonPacketFormat:
         """
         Ethernet/IP command to send an encapsulated request and reply packet between originator and target
@@ -505,14 +903,58 @@ class AsyncEIPConnectedCIPDispatcher(AsyncEIPConnectedCommandMixin, AsyncCIPDisp
         """
         eip_message = EIPMessage(b'\x6f\x00', command_specific_data, self.session_handle_id)
         reply = await self.send_command(eip_message, self.host)
-        reply_command_specific_data = CommandSpecificData()
-        reply_command_specific_data.from_bytes(reply.command_data)
-        reply_packet = CommonPacketFormat([])
-        reply_packet.from_bytes(reply_command_specific_data.encapsulated_packet)
-        return reply_packet
+        return self._common_packet_format_from_reply(reply)
 
+    async def send_unit_data(self, cip_request: bytes) -> CommonPacketFormat:
+        """
+        Ethernet/IP command to send a CIP request on the open class 3 connection
+        :param cip_request:
+        :return:
+        """
+        eip_message = EIPMessage(b'\x70\x00', self._unit_data_command_specific_data(cip_request),
+                                 self.session_handle_id)
+        reply = await self.send_command(eip_message, self.host)
+        return self._common_packet_format_from_reply(reply)
+
+    async def forward_open(self, large: bool = True) -> ForwardOpenReply:
+        """
+        Open a class 3 connection to the message router so that requests are sent as connected messages.
+        Large Forward Open is tried first when large is True, falling back to Forward Open if the target
+        does not support it
+        :param large:
+        :return:
+        """
+        forward_open_request = self._forward_open_request(large)
+        try:
+            reply = await self.execute_cip_command(forward_open_request.cip_request())
+        except CIPException as err:
+            if large and err.status == b'\x08':
+                return await self.forward_open(large=False)
+            raise err
+        self._connection_opened(forward_open_request, reply)
+        return self.forward_open_reply
 
-class EIPConnectedCIPDispatcher(EIPConnectedCommandMixin, CIPDispatcher):
+    async def forward_close(self):
+        """
+        Close the class 3 connection, later requests are sent as unconnected messages
+        :return:
+        """
+        if self.forward_open_request is not None:
+            forward_close_request = self.forward_open_request.forward_close_request()
+            self._connection_closed()
+            await self.execute_cip_command(forward_close_request)
+
+    async def close_explicit(self):
+        if self.is_connected_class_3 and self.is_connected_explicit:
+            try:
+                await asyncio.wait_for(self.forward_close(), self.FORWARD_CLOSE_TIMEOUT)
+            except (CIPException, ConnectionError, asyncio.TimeoutError):
+                pass
+        self._connection_closed()
+        await super().close_explicit()
+
+
+class EIPConnectedCIPDispatcher(ConnectedMessagingMixin, EIPConnectedCommandMixin, CIPDispatcher):
     """
     EIP is an encapsulation protocol for CIP (common industrial protocol) messages
     """
@@ -529,18 +971,10 @@ class EIPConnectedCIPDispatcher(EIPConnectedCommandMixin, CIPDispatcher):
         :param request:
         :return:
         """
-        data_address_item = DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, request.bytes)
-        packets = [data_address_item]
-        # ToDo add interface handle to track responses?
-        common_packet_format = CommonPacketFormat(packets)
-        command_specific_data = CommandSpecificData(encapsulated_packet=common_packet_format.bytes())
-        response = self.send_rr_data(command_specific_data.bytes()).packets[1].bytes()
-        reply_data_and_address_item = DataAndAddressItem('', b'')
-        # ToDo is this removing error data?
-        reply_data_and_address_item.from_bytes(response)
-        cip_reply = CIPReply(reply_data_and_address_item.data)
+        reply = self.send_command(self._request_frame(request), self.host)
+        cip_reply = self._cip_reply_from_packet(self._common_packet_format_from_reply(reply))
         if cip_reply.general_status != b'\x00':
-            raise CIPException(cip_reply.general_status, cip_reply.extended_status)
+            raise CIPException(cip_reply.general_status, cip_reply.extended_status, cip_reply)
         return cip_reply
 
     # @staticmethod
@@ -573,11 +1007,55 @@ class EIPConnectedCIPDispatcher(EIPConnectedCommandMixin, CIPDispatcher):
         """
         eip_message = EIPMessage(b'\x6f\x00', command_specific_data, self.session_handle_id)
         reply = self.send_command(eip_message, self.host)
-        reply_command_specific_data = CommandSpecificData()
-        reply_command_specific_data.from_bytes(reply.command_data)
-        reply_packet = CommonPacketFormat([])
-        reply_packet.from_bytes(reply_command_specific_data.encapsulated_packet)
-        return reply_packet
+        return self._common_packet_format_from_reply(reply)
+
+    def send_unit_data(self, cip_request: bytes) -> CommonPacketFormat:
+        """
+        Ethernet/IP command to send a CIP request on the open class 3 connection
+        :param cip_request:
+        :return:
+        """
+        eip_message = EIPMessage(b'\x70\x00', self._unit_data_command_specific_data(cip_request),
+                                 self.session_handle_id)
+        reply = self.send_command(eip_message, self.host)
+        return self._common_packet_format_from_reply(reply)
+
+    def forward_open(self, large: bool = True) -> ForwardOpenReply:
+        """
+        Open a class 3 connection to the message router so that requests are sent as connected messages.
+        Large Forward Open is tried first when large is True, falling back to Forward Open if the target
+        does not support it
+        :param large:
+        :return:
+        """
+        forward_open_request = self._forward_open_request(large)
+        try:
+            reply = self.execute_cip_command(forward_open_request.cip_request())
+        except CIPException as err:
+            if large and err.status == b'\x08':
+                return self.forward_open(large=False)
+            raise err
+        self._connection_opened(forward_open_request, reply)
+        return self.forward_open_reply
+
+    def forward_close(self):
+        """
+        Close the class 3 connection, later requests are sent as unconnected messages
+        :return:
+        """
+        if self.forward_open_request is not None:
+            forward_close_request = self.forward_open_request.forward_close_request()
+            self._connection_closed()
+            self.execute_cip_command(forward_close_request)
+
+    def close_explicit(self):
+        if self.is_connected_class_3 and self.is_connected_explicit:
+            try:
+                self.forward_close()
+            except (CIPException, OSError):
+                pass
+        self._connection_closed()
+        super().close_explicit()
 
     # def get_attribute_all_service(self, tag_request_path):
     #     get_attribute_all_request = CIPRequest(CIPService.GET_ATTRIBUTE_ALL, tag_request_path)
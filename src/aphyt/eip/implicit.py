@@ -0,0 +1,269 @@
+__author__ = 'Joseph Ryan'
+__license__ = "GPLv2"
+__maintainer__ = "Joseph Ryan"
+__email__ = "jr@aphyt.com"
+
+import asyncio
+import struct
+from typing import Tuple
+from aphyt.cip.cip import CIPException, ForwardOpenRequest, ForwardOpenReply, variable_request_path_segment
+from aphyt.cip.cip_datatypes import CIPDataType
+from aphyt.eip.eip import DataAndAddressItem, AsyncEIPConnectedCIPDispatcher
+
+
+def implicit_packet_bytes(connection_id: bytes, sequence_number: int, cip_sequence_count: int,
+                          data: bytes = b'') -> bytes:
+    """
+    Format a class 1 I/O packet: a sequenced address item followed by a connected data item that starts with
+    the CIP sequence count
+    :param connection_id:
+    :param sequence_number: 32-bit encapsulation sequence number
+    :param cip_sequence_count: 16-bit CIP sequence count
+    :param data:
+    :return:
+    """
+    return \
+        b'\x02\x00' + \
+        DataAndAddressItem.SEQUENCED_ADDRESS_ITEM + b'\x08\x00' + connection_id + \
+        struct.pack('<L', sequence_number & 0xffffffff) + \
+        DataAndAddressItem.CONNECTED_TRANSPORT_PACKET + struct.pack('<H', len(data) + 2) + \
+        struct.pack('<H', cip_sequence_count & 0xffff) + data
+
+
+class ImplicitDataPacket:
+    """
+    Class for parsing class 1 I/O packets received over UDP
+
+    I/O Packet::
+        |-Item Count
+        |-Sequenced Address Item
+          |-Connection ID
+          |-Encapsulation Sequence Number
+        |-Connected Data Item
+          |-CIP Sequence Count
+          |-Data
+    """
+
+    def __init__(self, packet_bytes: bytes):
+        self.connection_id = b''
+        self.sequence_number = None
+        self.cip_sequence_count = None
+        self.data = b''
+        item_count = struct.unpack_from('<H', packet_bytes, 0)[0]
+        offset = 2
+        for _ in range(item_count):
+            type_id = packet_bytes[offset:offset + 2]
+            length = struct.unpack_from('<H', packet_bytes, offset + 2)[0]
+            item_data = packet_bytes[offset + 4:offset + 4 + length]
+            if type_id == DataAndAddressItem.SEQUENCED_ADDRESS_ITEM:
+                self.connection_id = item_data[0:4]
+                self.sequence_number = struct.unpack('<L', item_data[4:8])[0]
+            elif type_id == DataAndAddressItem.CONNECTED_TRANSPORT_PACKET:
+                self.cip_sequence_count = struct.unpack('<H', item_data[0:2])[0]
+                self.data = item_data[2:]
+            offset = offset + 4 + length
+
+
+class ImplicitConsumerProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol that hands every received I/O packet to its consumer
+    """
+
+    def __init__(self, consumer: "AsyncImplicitConsumer"):
+        self.consumer = consumer
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.consumer.packet_received(data, addr)
+
+
+class AsyncImplicitConsumer:
+    """
+    Class 1 (implicit) consumer of cyclic data, for example an N-Series tag data link tag set. Every packet
+    is decoded into data_type, which can be a CIPStructure or CIPArray describing the layout of the tag set,
+    and observers are called when the data changes.
+
+    Packets are checked against the 32-bit encapsulation sequence number, packets that are older than the last
+    one are dropped and skipped sequence numbers are counted in missed_packets
+    """
+    IMPLICIT_MESSAGE_PORT = 2222
+
+    def __init__(self, data_type: CIPDataType, rpi: float = 0.01, port: int = IMPLICIT_MESSAGE_PORT):
+        """
+        :param data_type: CIP data type instance the packet data is decoded into
+        :param rpi: Requested packet interval in seconds
+        :param port: UDP port the packets are received on
+        """
+        self.data_type = data_type
+        self.rpi = rpi
+        self.port = port
+        self.connection_id = None
+        self.host = None
+        self.forward_open_request = None
+        self.forward_open_reply = None
+        self.transport = None
+        self.protocol = None
+        self.last_sequence_number = None
+        self.last_cip_sequence_count = None
+        self.last_packet_time = None
+        self.received_packets = 0
+        self.missed_packets = 0
+        self.stale_packets = 0
+        self._observers = []
+        self._heartbeat_task = None
+        self._heartbeat_sequence_number = 0
+
+    def bind_to_data(self, callback):
+        """
+        Observer Pattern: Allow a callback function to act on newly received data
+        :param callback:
+        :return:
+        """
+        self._observers.append(callback)
+
+    def value(self):
+        return self.data_type.value()
+
+    @property
+    def is_timed_out(self) -> bool:
+        """
+        True when no packet has been received for the connection timeout, which is the RPI multiplied by
+        the connection timeout multiplier
+        :return:
+        """
+        if self.last_packet_time is None:
+            return False
+        multiplier = 4 << (self.forward_open_request.connection_timeout_multiplier
+                           if self.forward_open_request is not None else 0)
+        return asyncio.get_running_loop().time() - self.last_packet_time > self.rpi * multiplier
+
+    def _data_size(self) -> int:
+        # Structures only track their size through their data
+        return max(self.data_type.size, len(self.data_type.data))
+
+    async def start(self, local_address: str = '0.0.0.0'):
+        """
+        Start receiving I/O packets
+        :param local_address:
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        self.transport, self.protocol = await loop.create_datagram_endpoint(
+            lambda: ImplicitConsumerProtocol(self), local_addr=(local_address, self.port))
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def open(self, cip_dispatcher: AsyncEIPConnectedCIPDispatcher, connection_path: bytes,
+                   heartbeat_size: int = 0, multicast: bool = False) -> ForwardOpenReply:
+        """
+        Open a class 1 connection with the target of cip_dispatcher, receive its packets and send the
+        originator to target heartbeat that keeps the connection alive
+        :param cip_dispatcher: Dispatcher with a registered session to the target
+        :param connection_path: Padded EPATH of the connection point, for example a tag set name
+        :param heartbeat_size: Size of the originator to target data
+        :param multicast: Ask the target to multicast its packets instead of sending them point to point
+        :return:
+        """
+        rpi = int(self.rpi * 1000000)
+        # Class 1 connection sizes include the 16-bit CIP sequence count
+        t_o_size = self._data_size() + 2
+        forward_open_request = ForwardOpenRequest(
+            heartbeat_size + 2, large=t_o_size > 0x1ff, connection_path=connection_path,
+            transport_class_trigger=ForwardOpenRequest.CLASS_1_CYCLIC, o_t_rpi=rpi, t_o_rpi=rpi,
+            t_o_connection_type=ForwardOpenRequest.MULTICAST if multicast else ForwardOpenRequest.POINT_TO_POINT,
+            priority=ForwardOpenRequest.SCHEDULED_PRIORITY, variable_size=False, t_o_connection_size=t_o_size,
+            connection_timeout_multiplier=2)
+        started = self.transport is None
+        if started:
+            await self.start()
+        try:
+            reply = await cip_dispatcher.execute_cip_command(forward_open_request.cip_request())
+            forward_open_reply = ForwardOpenReply(reply.bytes)
+        except BaseException:
+            # Do not leave the port bound when the target refuses the connection
+            if started:
+                await self.stop()
+            raise
+        self.forward_open_request = forward_open_request
+        self.forward_open_reply = forward_open_reply
+        self.connection_id = self.forward_open_reply.t_o_connection_id
+        self.host = cip_dispatcher.host
+        self._heartbeat_task = asyncio.get_running_loop().create_task(self._send_heartbeat(heartbeat_size))
+        return self.forward_open_reply
+
+    async def close(self, cip_dispatcher: AsyncEIPConnectedCIPDispatcher):
+        """
+        Close the class 1 connection and stop receiving packets
+        :param cip_dispatcher:
+        :return:
+        """
+        await self.stop()
+        if self.forward_open_request is not None:
+            forward_close_request = self.forward_open_request.forward_close_request()
+            self.forward_open_request = None
+            self.forward_open_reply = None
+            try:
+                await cip_dispatcher.execute_cip_command(forward_close_request)
+            except CIPException:
+                pass
+
+    async def _send_heartbeat(self, heartbeat_size: int):
+        """
+        Send originator to target packets at the RPI so the target does not time out the connection
+        :param heartbeat_size:
+        :return:
+        """
+        while True:
+            self._heartbeat_sequence_number = (self._heartbeat_sequence_number + 1) & 0xffffffff
+            self.transport.sendto(
+                implicit_packet_bytes(self.forward_open_reply.o_t_connection_id, self._heartbeat_sequence_number,
+                                      self._heartbeat_sequence_number, bytes(heartbeat_size)),
+                (self.host, self.IMPLICIT_MESSAGE_PORT))
+            await asyncio.sleep(self.rpi)
+
+    def packet_received(self, packet_bytes: bytes, addr: Tuple[str, int]):
+        try:
+            packet = ImplicitDataPacket(packet_bytes)
+        except struct.error:
+            return
+        if packet.sequence_number is None or packet.cip_sequence_count is None:
+            return
+        if self.connection_id is not None and packet.connection_id != self.connection_id:
+            return
+        if self.last_sequence_number is not None:
+            difference = (packet.sequence_number - self.last_sequence_number) & 0xffffffff
+            if difference == 0 or difference > 0x7fffffff:
+                # Duplicate or out of order packet
+                self.stale_packets += 1
+                return
+            self.missed_packets += difference - 1
+        self.last_sequence_number = packet.sequence_number
+        self.last_packet_time = asyncio.get_running_loop().time()
+        self.received_packets += 1
+        if packet.cip_sequence_count == self.last_cip_sequence_count:
+            # The producer only changes the CIP sequence count when it sends new data
+            return
+        self.last_cip_sequence_count = packet.cip_sequence_count
+        data_size = self._data_size()
+        self.data_type.data = packet.data[0:data_size] if data_size else packet.data
+        self.data_type.value()
+        for callback in self._observers:
+            callback()
+
+
+def tag_set_connection_path(tag_set_name: str) -> bytes:
+    """
+    Connection path to a produced tag set, addressed by name as an ANSI extended symbol segment
+    :param tag_set_name:
+    :return:
+    """
+    return variable_request_path_segment(tag_set_name)
@@ -0,0 +1,180 @@
+__author__ = 'Joseph Ryan'
+__license__ = "GPLv2"
+__maintainer__ = "Joseph Ryan"
+__email__ = "jr@aphyt.com"
+
+import asyncio
+import contextlib
+import contextvars
+from typing import List
+from aphyt.cip.cip import CIPReply, CIPRequest, AsyncCIPDispatcher, ForwardOpenReply
+from aphyt.eip.eip import AsyncEIPConnectedCIPDispatcher
+
+_priority_request = contextvars.ContextVar('priority_request', default=False)
+
+
+class EIPSessionPool(AsyncCIPDispatcher):
+    """
+    Several registered Ethernet/IP sessions to the same host used as a single CIP dispatcher. Each request goes
+    to the session with the fewest outstanding requests, so one large read does not hold up the others.
+
+    Requests made inside ``async with pool.priority():`` use a session of their own that bulk traffic never
+    uses. All sessions share the variable and data type dictionaries of the pool, and a session that loses its
+    connection is reconnected in the background while the other sessions keep serving requests.
+    """
+    explicit_message_port = 44818
+    DEFAULT_SESSIONS = 4
+    # Seconds between attempts to reconnect a session that lost its connection
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, sessions: int = DEFAULT_SESSIONS, priority_session: bool = True):
+        """
+        :param sessions: Number of sessions shared by ordinary requests
+        :param priority_session: Open an additional session reserved for priority requests
+        """
+        if sessions < 1:
+            raise ValueError('An EIPSessionPool needs at least one session')
+        super().__init__()
+        self.host = None
+        self.connection_timeout = None
+        self.members = [AsyncEIPConnectedCIPDispatcher() for _ in range(sessions)]
+        self.priority_member = AsyncEIPConnectedCIPDispatcher() if priority_session else None
+        for member in self.all_members:
+            member.variables = self.variables
+            member.user_variables = self.user_variables
+            member.system_variables = self.system_variables
+            member.data_type_dictionary = self.data_type_dictionary
+        self._outstanding = {id(member): 0 for member in self.all_members}
+        self._reconnect_tasks = {}
+        self._forward_open_large = None
+
+    @property
+    def all_members(self) -> List[AsyncEIPConnectedCIPDispatcher]:
+        if self.priority_member is None:
+            return list(self.members)
+        return self.members + [self.priority_member]
+
+    @property
+    def is_connected_explicit(self) -> bool:
+        return any(member.is_connected_explicit for member in self.all_members)
+
+    @property
+    def has_session_handle(self) -> bool:
+        return any(member.has_session_handle for member in self.all_members)
+
+    @property
+    def session_handle_id(self) -> bytes:
+        return self.members[0].session_handle_id
+
+    @property
+    def is_connected_class_3(self) -> bool:
+        return all(member.is_connected_class_3 for member in self.all_members)
+
+    @property
+    def maximum_message_length(self) -> int:
+        return min(member.maximum_message_length for member in self.all_members)
+
+    def outstanding_requests(self, member: AsyncEIPConnectedCIPDispatcher) -> int:
+        return self._outstanding[id(member)]
+
+    @contextlib.asynccontextmanager
+    async def priority(self):
+        """
+        Send the requests made in this context on the priority session
+        :return:
+        """
+        token = _priority_request.set(True)
+        try:
+            yield self
+        finally:
+            _priority_request.reset(token)
+
+    async def connect_explicit(self, host, connection_timeout: float = None):
+        self.host = host
+        self.connection_timeout = connection_timeout
+        for member in self.all_members:
+            member.explicit_message_port = self.explicit_message_port
+        await asyncio.gather(*[member.connect_explicit(host, connection_timeout) for member in self.all_members])
+
+    async def register_session(self):
+        replies = await asyncio.gather(*[member.register_session() for member in self.all_members])
+        return replies[0]
+
+    async def close_explicit(self):
+        for task in self._reconnect_tasks.values():
+            task.cancel()
+        self._reconnect_tasks = {}
+        self._forward_open_large = None
+        await asyncio.gather(*[member.close_explicit() for member in self.all_members])
+        self.host = None
+
+    async def forward_open(self, large: bool = True) -> ForwardOpenReply:
+        """
+        Open a class 3 connection on every session
+        :param large:
+        :return:
+        """
+        replies = await asyncio.gather(*[member.forward_open(large) for member in self.all_members])
+        self._forward_open_large = large
+        return replies[0]
+
+    async def forward_close(self):
+        self._forward_open_large = None
+        await asyncio.gather(*[member.forward_close() for member in self.all_members])
+
+    async def list_services(self, host=''):
+        return await self._select_member().list_services(host)
+
+    def _is_available(self, member: AsyncEIPConnectedCIPDispatcher) -> bool:
+        return member.has_session_handle and id(member) not in self._reconnect_tasks
+
+    def _select_member(self) -> AsyncEIPConnectedCIPDispatcher:
+        """
+        The priority session for priority requests, otherwise the available session with the fewest
+        outstanding requests
+        :return:
+        """
+        if _priority_request.get() and self.priority_member is not None and \
+                self._is_available(self.priority_member):
+            return self.priority_member
+        available = [member for member in self.members if self._is_available(member)]
+        if not available:
+            if self.priority_member is not None and self._is_available(self.priority_member):
+                return self.priority_member
+            raise ConnectionError(f'No Ethernet/IP session to {self.host} is available')
+        return min(available, key=self.outstanding_requests)
+
+    async def execute_cip_command(self, request: CIPRequest) -> CIPReply:
+        member = self._select_member()
+        self._outstanding[id(member)] += 1
+        try:
+            return await member.execute_cip_command(request)
+        except (ConnectionError, OSError) as err:
+            self._start_reconnect(member)
+            raise err
+        finally:
+            self._outstanding[id(member)] -= 1
+
+    def _start_reconnect(self, member: AsyncEIPConnectedCIPDispatcher):
+        if id(member) not in self._reconnect_tasks and self.host is not None:
+            self._reconnect_tasks[id(member)] = asyncio.get_running_loop().create_task(self._reconnect(member))
+
+    async def _reconnect(self, member: AsyncEIPConnectedCIPDispatcher):
+        """
+        Reopen the connection, session and class 3 connection of a member until it succeeds
+        :param member:
+        :return:
+        """
+        try:
+            while True:
+                await member.close_explicit()
+                try:
+                    await member.connect_explicit(self.host, self.connection_timeout)
+                    await member.register_session()
+                    if self._forward_open_large is not None:
+                        await member.forward_open(self._forward_open_large)
+                    return
+                except (ConnectionError, OSError):
+                    await asyncio.sleep(self.RECONNECT_DELAY)
+        finally:
+            self._reconnect_tasks.pop(id(member), None)
@@ -6,7 +6,10 @@ __email__ = "jr@aphyt.com"
 import asyncio
 import binascii
 import concurrent.futures
+import contextlib
+import functools
 import pickle
+import re
 import socket
 import struct
 import sys
@@ -18,6 +21,7 @@ from aphyt.cip.cip_datatypes import *
 from aphyt.cip.cip import *
 import logging
 from threading import Thread
+from typing import List
 
 
 class VariableTypeObjectReply(CIPReply):
@@ -25,13 +29,14 @@ class VariableTypeObjectReply(CIPReply):
     CIP Reply from the Get Attribute All service to Variable Type Object Class Code 0x6C adding descriptive properties
     Omron Vendor specific
     """
+    __slots__ = ()
 
     def __init__(self, reply_bytes: bytes):
         super().__init__(reply_bytes=reply_bytes)
 
     @property
     def size_in_memory(self):
-        return struct.unpack("<L", self.reply_data[0:4])[0]
+        return self._unpack_reply_data(self.UDINT, 0)
 
     @property
     def size(self):
@@ -39,36 +44,36 @@ class VariableTypeObjectReply(CIPReply):
 
     @property
     def cip_data_type(self):
-        return self.reply_data[5:6]
+        return self._reply_data_bytes(5, 6)
 
     @property
     def cip_data_type_of_array(self):
-        return self.reply_data[6:7]
+        return self._reply_data_bytes(6, 7)
 
     @property
     def array_dimension(self):
-        return struct.unpack("<B", self.reply_data[7:8])[0]
+        return self._unpack_reply_data(self.USINT, 7)
 
     @property
     def number_of_elements(self):
         """Number of elements in each dimension of  the array"""
         dimension_size_list = []
         for i in range(self.array_dimension):
-            dimension_size = struct.unpack("<L", self.reply_data[8 + i * 4:8 + i * 4 + 4])[0]
+            dimension_size = self._unpack_reply_data(self.UDINT, 8 + i * 4)
             dimension_size_list.append(dimension_size)
         return dimension_size_list
 
     @property
     def number_of_members(self):
-        return struct.unpack("<H", self.reply_data[8 + self.array_dimension * 4:10 + self.array_dimension * 4])[0]
+        return self._unpack_reply_data(self.UINT, 8 + self.array_dimension * 4)
 
     @property
     def crc_code(self):
-        return struct.unpack("<H", self.reply_data[14 + self.array_dimension * 4:16 + self.array_dimension * 4])[0]
+        return self._unpack_reply_data(self.UINT, 14 + self.array_dimension * 4)
 
     @property
     def variable_type_name_length(self):
-        return struct.unpack("<B", self.reply_data[16 + self.array_dimension * 4:17 + self.array_dimension * 4])[0]
+        return self._unpack_reply_data(self.USINT, 16 + self.array_dimension * 4)
 
     @property
     def padding(self):
@@ -79,35 +84,26 @@ class VariableTypeObjectReply(CIPReply):
 
     @property
     def variable_type_name(self):
-        return \
-            self.reply_data[17 + self.array_dimension * 4:
-                            17 + self.array_dimension * 4 + self.variable_type_name_length]
+        name_offset = 17 + self.array_dimension * 4
+        return self._reply_data_bytes(name_offset, name_offset + self.variable_type_name_length)
 
     @property
     def next_instance_id(self):
-        return \
-            self.reply_data[self.padding + 17 + self.array_dimension * 4 + self.variable_type_name_length:
-                            self.padding + 17 + self.array_dimension * 4 + self.variable_type_name_length + 4]
+        instance_offset = self.padding + 17 + self.array_dimension * 4 + self.variable_type_name_length
+        return self._reply_data_bytes(instance_offset, instance_offset + 4)
 
     @property
     def nesting_variable_type_instance_id(self):
-        return \
-            self.reply_data[self.padding + 21 + self.array_dimension * 4 + self.variable_type_name_length:
-                            self.padding + 21 + self.array_dimension * 4 + self.variable_type_name_length + 4]
+        instance_offset = self.padding + 21 + self.array_dimension * 4 + self.variable_type_name_length
+        return self._reply_data_bytes(instance_offset, instance_offset + 4)
 
     @property
     def start_array_elements(self):
         """Number of elements in each dimension of  the array"""
         array_start_list = []
         for i in range(self.array_dimension):
-            array_start = \
-                struct.unpack("<L",
-                              self.reply_data[self.padding + 25 +
-                                              self.array_dimension * 4 +
-                                              self.variable_type_name_length:
-                                              self.padding + 25 +
-                                              self.array_dimension * 4 +
-                                              self.variable_type_name_length + 4])[0]
+            array_start = self._unpack_reply_data(
+                self.UDINT, self.padding + 25 + self.array_dimension * 4 + self.variable_type_name_length)
             array_start_list.append(array_start)
         return array_start_list
 
@@ -117,53 +113,51 @@ class VariableObjectReply(CIPReply):
     CIP Reply from the Get Attribute All service to Variable Object Class Code 0x6B adding descriptive properties
     Omron Vendor specific
     """
+    __slots__ = ()
 
     def __init__(self, reply_bytes: bytes):
         super().__init__(reply_bytes=reply_bytes)
 
     @property
     def size(self):
-        return struct.unpack("<L", self.reply_data[0:4])[0]
+        return self._unpack_reply_data(self.UDINT, 0)
 
     @property
     def cip_data_type(self):
-        return self.reply_data[4:5]
+        return self._reply_data_bytes(4, 5)
 
     @property
     def cip_data_type_of_array(self):
-        return self.reply_data[5:6]
+        return self._reply_data_bytes(5, 6)
 
     @property
     def array_dimension(self):
         # One byte of padding after this. Skip to byte 8
-        return struct.unpack("<B", self.reply_data[6:7])[0]
+        return self._unpack_reply_data(self.USINT, 6)
 
     @property
     def number_of_elements(self):
         """Number of elements in each dimension of  the array"""
         dimension_size_list = []
         for i in range(self.array_dimension):
-            dimension_size = struct.unpack("<L", self.reply_data[8 + i * 4:8 + i * 4 + 4])[0]
+            dimension_size = self._unpack_reply_data(self.UDINT, 8 + i * 4)
             dimension_size_list.append(dimension_size)
         return dimension_size_list
 
     @property
     def bit_number(self):
-        return struct.unpack("<B", self.reply_data[16 + self.array_dimension * 4:17 + self.array_dimension * 4])[0]
+        return self._unpack_reply_data(self.USINT, 16 + self.array_dimension * 4)
 
     @property
     def variable_type_instance_id(self):
-        return self.reply_data[20 + self.array_dimension * 4:24 + self.array_dimension * 4]
+        return self._reply_data_bytes(20 + self.array_dimension * 4, 24 + self.array_dimension * 4)
 
     @property
     def start_array_elements(self):
         """Number of elements in each dimension of  the array"""
         array_start_list = []
         for i in range(self.array_dimension):
-            array_start = \
-                struct.unpack("<L",
-                              self.reply_data[24 + self.array_dimension * 4:
-                                              24 + self.array_dimension * 4 + 4])[0]
+            array_start = self._unpack_reply_data(self.UDINT, 24 + self.array_dimension * 4)
             array_start_list.append(array_start)
         return array_start_list
 
@@ -196,13 +190,14 @@ class VariableNameAttributeAllReply(CIPReply):
     CIP Reply from the Get Attribute All service to Tag Name adding descriptive properties
     Omron Vendor specific
     """
+    __slots__ = ()
 
     def __init__(self, reply_bytes: bytes):
         super().__init__(reply_bytes=reply_bytes)
 
     @property
     def cip_data_type(self):
-        return self.reply_data[4:5]
+        return self._reply_data_bytes(4, 5)
 
     @property
     def instance_id(self):
@@ -210,11 +205,11 @@ class VariableNameAttributeAllReply(CIPReply):
         Instance ID will is where the
         :return:
         """
-        return self.reply_data[8:12]
+        return self._reply_data_bytes(8, 12)
 
     @property
     def variable_type_id(self):
-        return self.reply_data[12:16]
+        return self._reply_data_bytes(12, 16)
 
 
 class SimpleDataSegmentRequest:
@@ -223,6 +218,11 @@ class SimpleDataSegmentRequest:
     in a single CIP message. This is used for strings, arrays and structures
     """
 
+    # Simple data type code and segment length, which is fixed and in words
+    SEGMENT_HEADER = b'\x80\x03'
+    # Segment header, offset and size
+    SEGMENT = struct.Struct('<2sLH')
+
     def __init__(self, offset, size):
         self.simple_data_type_code = b'\x80'
         self.segment_length = b'\x03'  # Fixed and in words
@@ -230,9 +230,36 @@ class SimpleDataSegmentRequest:
         self.size = size
 
     def bytes(self):
-        return \
-                self.simple_data_type_code + self.segment_length + \
-                struct.pack("<L", self.offset) + struct.pack("<H", self.size)
+        return self.SEGMENT.pack(self.simple_data_type_code + self.segment_length, self.offset, self.size)
+
+    @classmethod
+    def request_path(cls, variable_name: str, offset: int, size: int, variable_path: bytes = None) -> bytes:
+        """
+        Request path of the variable, from the request path cache, followed by the simple data segment
+        :param variable_name:
+        :param offset:
+        :param size:
+        :param variable_path: Request path of the variable to use instead of its symbolic request path
+        :return:
+        """
+        if variable_path is None:
+            variable_path = variable_request_path_segment(variable_name)
+        return variable_path + cls.SEGMENT.pack(cls.SEGMENT_HEADER, offset, size)
+
+
+@functools.lru_cache(maxsize=REQUEST_PATH_CACHE_SIZE)
+def symbol_instance_request_path_segment(instance_id: int, member_name: str = '') -> bytes:
+    """
+    Request path that addresses a variable by its instance of the Variable Object class 0x6B instead of by name,
+    followed by the member and element segments of the rest of the variable name
+    :param instance_id: Instance ID of the variable from the Tag Name Server
+    :param member_name: Rest of the variable name, for example '.Station4.Axis[3].Status'
+    :return:
+    """
+    instance_id_length = 1 if instance_id <= 0xff else 2 if instance_id <= 0xffff else 4
+    return address_request_path_segment(class_id=b'\x6b',
+                                        instance_id=instance_id.to_bytes(instance_id_length, 'little')) + \
+        variable_request_path_segment(member_name)
 
 
 class NSeries:
@@ -244,10 +271,12 @@ class NSeries:
     AsyncNSeries class running an event loop so that the asynchronous code can be executed in a synchronous
     program.
     """
-    def __init__(self, host=None, timeout=None):
+    def __init__(self, host=None, timeout=None, sessions: int = 1, use_numpy: bool = False,
+                 lazy_arrays: bool = False, element_cache_size: int = 0):
         super().__init__()
         self.derived_data_type_dictionary = {}
-        self._instance = AsyncNSeries()
+        self._instance = AsyncNSeries(sessions=sessions, use_numpy=use_numpy, lazy_arrays=lazy_arrays,
+                                      element_cache_size=element_cache_size)
         self.host = host
         self.timeout = timeout
         update_data_type_dictionary(self._instance.connected_cip_dispatcher.data_type_dictionary)
@@ -280,6 +309,16 @@ class NSeries:
         # No longer required, but put in for backwards compatibility
         pass
 
+    def forward_open(self, large: bool = True):
+        future = asyncio.run_coroutine_threadsafe(
+            self._instance.forward_open(large), self._instance.loop)
+        return future.result()
+
+    def forward_close(self):
+        future = asyncio.run_coroutine_threadsafe(
+            self._instance.forward_close(), self._instance.loop)
+        return future.result()
+
     def update_variable_dictionary(self):
         future = asyncio.run_coroutine_threadsafe(
             self._instance.update_variable_dictionary(), self._instance.loop)
@@ -314,6 +353,11 @@ class NSeries:
             self._instance.read_variable(variable_name), self._instance.loop)
         return future.result()
 
+    def read_variables(self, variable_names: List[str]) -> list:
+        future = asyncio.run_coroutine_threadsafe(
+            self._instance.read_variables(variable_names), self._instance.loop)
+        return future.result()
+
     def write_variable(self, variable_name: str, data):
         future = asyncio.run_coroutine_threadsafe(
             self._instance.write_variable(variable_name, data), self._instance.loop)
@@ -324,6 +368,18 @@ class NSeries:
             self._instance.verified_write_variable(variable_name, data, retry_count), self._instance.loop)
         return future.result()
 
+    def set_bit(self, variable_name: str, bit: int):
+        future = asyncio.run_coroutine_threadsafe(self._instance.set_bit(variable_name, bit), self._instance.loop)
+        return future.result()
+
+    def clear_bit(self, variable_name: str, bit: int):
+        future = asyncio.run_coroutine_threadsafe(self._instance.clear_bit(variable_name, bit), self._instance.loop)
+        return future.result()
+
+    def toggle_bit(self, variable_name: str, bit: int):
+        future = asyncio.run_coroutine_threadsafe(self._instance.toggle_bit(variable_name, bit), self._instance.loop)
+        return future.result()
+
 
 class AsyncNSeries:
     """
@@ -334,11 +390,30 @@ class AsyncNSeries:
     and CIP services common to most Ethernet/IP devices
     """
     MAXIMUM_LENGTH = 502  # UCMM maximum length is 502 bytes
+    # Segment requests of a large variable that are sent before waiting for their replies
+    PIPELINE_WINDOW = 16
 
-    def __init__(self, host=None, timeout=None):
+    def __init__(self, host=None, timeout=None, sessions: int = 1, use_numpy: bool = False,
+                 lazy_arrays: bool = False, element_cache_size: int = 0):
+        """
+        :param host:
+        :param timeout:
+        :param sessions: Number of Ethernet/IP sessions to open, more than one uses an EIPSessionPool
+        :param use_numpy: Build the arrays that are read from the controller in the NumPy mode of CIPArray
+        :param lazy_arrays: Build the arrays that are read from the controller in the lazy mode of CIPArray
+        :param element_cache_size: Number of decoded elements each lazy array keeps until its data changes
+        """
         super().__init__()
+        if use_numpy and numpy is None:
+            raise ImportError('NumPy mode of CIPArray requires numpy, install aphyt[numpy]')
+        self.use_numpy = use_numpy
+        self.lazy_arrays = lazy_arrays
+        self.element_cache_size = element_cache_size
         self.derived_data_type_dictionary = {}
-        self.connected_cip_dispatcher = AsyncEIPConnectedCIPDispatcher()
+        if sessions > 1:
+            self.connected_cip_dispatcher = EIPSessionPool(sessions)
+        else:
+            self.connected_cip_dispatcher = AsyncEIPConnectedCIPDispatcher()
         self.host = host
         self.timeout = timeout
         update_data_type_dictionary(self.connected_cip_dispatcher.data_type_dictionary)
@@ -348,6 +423,14 @@ class AsyncNSeries:
         self.instances = []
         self.user_instances = []
         self.system_instances = []
+        self.read_coalescer = None
+        self.instance_addressing = False
+        self.instance_ids = {}
+        self.pipeline_window = self.PIPELINE_WINDOW
+        # Variable Type Objects and the structure types built from them, by instance ID, so every type is read
+        # and built once and variables of the same structure type share it
+        self.variable_type_objects = {}
+        self.structure_prototypes = {}
 
     def start_loop(self):
         asyncio.set_event_loop(self.loop)
@@ -390,6 +473,106 @@ class AsyncNSeries:
     async def register_session(self):
         await self.connected_cip_dispatcher.register_session()
 
+    async def forward_open(self, large: bool = True):
+        """
+        Switch to class 3 connected messaging. Large Forward Open allows messages of up to 4000 bytes
+        instead of the 502 byte UCMM limit, so large variables are read and written in fewer messages
+        :param large:
+        :return:
+        """
+        return await self.connected_cip_dispatcher.forward_open(large)
+
+    async def forward_close(self):
+        """
+        Close the class 3 connection and return to unconnected messaging
+        :return:
+        """
+        await self.connected_cip_dispatcher.forward_close()
+
+    async def consume_tag_set(self, tag_set_name: str, data_type: CIPDataType, rpi: float = 0.01,
+                              port: int = AsyncImplicitConsumer.IMPLICIT_MESSAGE_PORT,
+                              multicast: bool = False) -> AsyncImplicitConsumer:
+        """
+        Receive a produced tag set cyclically over a class 1 connection instead of polling it with explicit
+        messages. The packets are decoded into data_type, a CIPStructure or CIPArray matching the tag set layout
+        :param tag_set_name:
+        :param data_type:
+        :param rpi: Requested packet interval in seconds
+        :param port:
+        :param multicast:
+        :return:
+        """
+        consumer = AsyncImplicitConsumer(data_type, rpi, port)
+        await consumer.open(self.connected_cip_dispatcher, tag_set_connection_path(tag_set_name),
+                            multicast=multicast)
+        return consumer
+
+    def priority(self):
+        """
+        Context manager for latency sensitive requests, which use the dedicated session of an EIPSessionPool
+        so they are not queued behind bulk traffic
+        :return:
+        """
+        if isinstance(self.connected_cip_dispatcher, EIPSessionPool):
+            return self.connected_cip_dispatcher.priority()
+        return contextlib.nullcontext(self)
+
+    def enable_read_coalescing(self, window: float = AsyncReadTagCoalescer.DEFAULT_WINDOW):
+        """
+        Send the scalar reads that coroutines make within window seconds of each other in one Multiple Service
+        Packet instead of one message each
+        :param window:
+        :return:
+        """
+        self.read_coalescer = AsyncReadTagCoalescer(self.connected_cip_dispatcher, window)
+
+    def disable_read_coalescing(self):
+        if self.read_coalescer is not None:
+            self.read_coalescer.flush()
+        self.read_coalescer = None
+
+    async def enable_instance_addressing(self):
+        """
+        Address variables by their Variable Object instance, resolved once from the Tag Name Server, instead of
+        sending the whole name in every request. Members and elements of a variable are still addressed by name
+        after the instance. Variables that are not in the Tag Name Server listing keep their symbolic path
+        :return:
+        """
+        if not self.instances:
+            self.user_instances = await self._get_instance_list_subset(True)
+            self.system_instances = await self._get_instance_list_subset(False)
+            self.instances = self.user_instances + self.system_instances
+        self._update_instance_ids()
+        self.instance_addressing = True
+
+    def disable_instance_addressing(self):
+        self.instance_addressing = False
+
+    def _update_instance_ids(self):
+        self.instance_ids = {instance.tag_name(): int.from_bytes(instance.instance_id, 'little')
+                             for instance in self.instances}
+
+    def _request_path(self, variable_name: str) -> bytes:
+        """
+        Request path of a variable, by instance when instance addressing is enabled and by name otherwise
+        :param variable_name:
+        :return:
+        """
+        if self.instance_addressing:
+            variable = re.match(r'[^.\[]*', variable_name).group()
+            instance_id = self.instance_ids.get(variable)
+            if instance_id is not None:
+                return symbol_instance_request_path_segment(instance_id, variable_name[len(variable):])
+        return variable_request_path_segment(variable_name)
+
+    @property
+    def maximum_length(self) -> int:
+        """
+        Largest CIP message that the current connection allows
+        :return:
+        """
+        return self.connected_cip_dispatcher.maximum_message_length
+
     async def get_instance_list_service(self, tag_request_path: bytes, data: bytes):
         """
         Omron specific CIP service
@@ -440,12 +623,15 @@ class AsyncNSeries:
         :return:
         """
         update_data_type_dictionary(self.connected_cip_dispatcher.data_type_dictionary)
+        self.clear_variable_type_cache()
         self.user_instances = []
         self.system_instances = []
         self.instances = []
         self.user_instances = await self._get_instance_list_subset(True)
         self.system_instances = await self._get_instance_list_subset(False)
         self.instances = self.user_instances + self.system_instances
+        if self.instance_addressing:
+            self._update_instance_ids()
         for instance in self.user_instances:
             variable = instance.tag_name()
             variable_cip_datatype = await self._get_instance_from_variable_name(variable)
@@ -460,6 +646,15 @@ class AsyncNSeries:
             self.connected_cip_dispatcher.variables.update({variable: variable_cip_datatype})
             self.connected_cip_dispatcher.system_variables.update({variable: variable_cip_datatype})
 
+    def clear_variable_type_cache(self):
+        """
+        Forget the Variable Type Objects and structure types read from the controller, so they are read again
+        after the data types in the controller are changed
+        :return:
+        """
+        self.variable_type_objects = {}
+        self.structure_prototypes = {}
+
     async def variable_list(self):
         """
         Return list of variables in the variable dictionary. It will be empty unless the
@@ -556,12 +751,16 @@ class AsyncNSeries:
             self, variable_type_object: VariableTypeObjectReply) -> CIPStructure:
         """
         This method recursively builds a CIP Structure from a Variable Type Object that represents a
-        structure definition
+        structure definition. Each structure type is built once, structures of a type that was already built
+        are new instances of it
         :param variable_type_object:
         :return:
         """
         nesting_id = variable_type_object.nesting_variable_type_instance_id
         nesting_id = int.from_bytes(nesting_id, 'little')
+        prototype = self.structure_prototypes.get(nesting_id)
+        if prototype is not None:
+            return prototype.new_instance()
         nested_variable_type_object = await self._get_variable_type_object(nesting_id)
         cip_datatype_instance = CIPStructure()
         cip_datatype_instance.instance_id = nesting_id
@@ -572,6 +771,7 @@ class AsyncNSeries:
         else:
             cip_datatype_instance.variable_type_name = str(variable_type_object.variable_type_name, 'utf-8')
         cip_datatype_instance.size = variable_type_object.size_in_memory
+        cip_datatype_instance.crc_code = variable_type_object.crc_code.to_bytes(2, 'little')
         nest_id = variable_type_object.nesting_variable_type_instance_id
         member_instance_id = int.from_bytes(nest_id, 'little')
         while member_instance_id != 0:
@@ -586,7 +786,15 @@ class AsyncNSeries:
             cip_datatype_instance.members[member_name] = member_cip_datatype_instance
             member_instance_id = \
                 int.from_bytes(variable_type_object_reply.next_instance_id, 'little')
-        return cip_datatype_instance
+        self.structure_prototypes[nesting_id] = cip_datatype_instance
+        return cip_datatype_instance.new_instance()
+
+    def _new_array(self) -> CIPArray:
+        """
+        Every array the driver builds is made here so that it uses the array options of this instance
+        :return:
+        """
+        return CIPArray(use_numpy=self.use_numpy, lazy=self.lazy_arrays, element_cache_size=self.element_cache_size)
 
     async def _array_instance_from_variable_name(self, variable_name: str) -> CIPArray:
         """
@@ -595,7 +803,7 @@ class AsyncNSeries:
         :param variable_name:
         :return:
         """
-        cip_array_instance = CIPArray()
+        cip_array_instance = self._new_array()
         request_path = variable_request_path_segment(variable_name)
         response = await self.connected_cip_dispatcher.get_attribute_all_service(request_path)
         # Not actually a VariableObjectReply, but the data aligns the same
@@ -631,7 +839,7 @@ class AsyncNSeries:
         :param variable_type_object:
         :return:
         """
-        cip_array_instance = CIPArray()
+        cip_array_instance = self._new_array()
         # Not actually a VariableObjectReply, but the data aligns the same
         instance_id = variable_type_object.nesting_variable_type_instance_id
         if type(instance_id) is bytes:
@@ -748,7 +956,7 @@ class AsyncNSeries:
 
     async def _array_instance_from_variable_object(
             self, variable_object: (VariableObjectReply, VariableTypeObjectReply)) -> CIPArray:
-        cip_array_instance = CIPArray()
+        cip_array_instance = self._new_array()
         variable_type_instance_id = b'\x00\x00\x00\x00'
         if isinstance(variable_object, VariableObjectReply):
             variable_type_instance_id = variable_object.variable_type_instance_id
@@ -772,7 +980,7 @@ class AsyncNSeries:
         :param variable_name:
         :return:
         """
-        request_path = variable_request_path_segment(variable_name)
+        request_path = self._request_path(variable_name)
         cip_data_type_instance = self.connected_cip_dispatcher.variables.get(variable_name)
         if cip_data_type_instance is None:
             cip_data_type_instance = await self._get_instance_from_variable_name(variable_name)
@@ -789,11 +997,45 @@ class AsyncNSeries:
             else:
                 return await self._multi_message_variable_read(cip_data_type_instance)
         else:
-            response = await self.connected_cip_dispatcher.read_tag_service(request_path)
+            if self.read_coalescer is not None:
+                response = await self.read_coalescer.read_tag_service(
+                    request_path, reply_length=cip_data_type_instance.size + 2)
+            else:
+                response = await self.connected_cip_dispatcher.read_tag_service(request_path)
             cip_data_type_instance.from_bytes(response.reply_data)
             cip_data_type_instance.variable_name = variable_name
             return cip_data_type_instance.value()
 
+    async def read_variables(self, variable_names: List[str]) -> list:
+        """
+        Read several variables and return their values in the same order. Scalar variables are read together
+        in Multiple Service Packets, other variables are read one at a time with read_variable
+        :param variable_names:
+        :return:
+        """
+        values = [None] * len(variable_names)
+        scalar_indexes = []
+        scalar_instances = []
+        for index, variable_name in enumerate(variable_names):
+            cip_data_type_instance = self.connected_cip_dispatcher.variables.get(variable_name)
+            if cip_data_type_instance is None:
+                cip_data_type_instance = await self._get_instance_from_variable_name(variable_name)
+            if isinstance(cip_data_type_instance, (CIPString, CIPArray, CIPStructure, CIPAbbreviatedStructure)):
+                values[index] = await self.read_variable(variable_name)
+            else:
+                scalar_indexes.append(index)
+                scalar_instances.append(cip_data_type_instance)
+        replies = await self.connected_cip_dispatcher.read_tags(
+            [self._request_path(variable_names[index]) for index in scalar_indexes],
+            reply_lengths=[cip_data_type_instance.size + 2 for cip_data_type_instance in scalar_instances])
+        for index, cip_data_type_instance, reply in zip(scalar_indexes, scalar_instances, replies):
+            if reply.general_status != b'\x00':
+                raise CIPException(reply.general_status, reply.extended_status, reply)
+            cip_data_type_instance.from_bytes(reply.reply_data)
+            cip_data_type_instance.variable_name = variable_names[index]
+            values[index] = cip_data_type_instance.value()
+        return values
+
     async def write_variable(self, variable_name: str, data):
         """
         This method takes a variable name and formats the Python datatype into the correct CIP datatype
@@ -802,7 +1044,7 @@ class AsyncNSeries:
         :param data:
         :return:
         """
-        request_path = variable_request_path_segment(variable_name)
+        request_path = self._request_path(variable_name)
         cip_data_type_instance = self.connected_cip_dispatcher.variables.get(variable_name)
         if cip_data_type_instance is None:
             cip_data_type_instance = await self._get_instance_from_variable_name(variable_name)
@@ -822,6 +1064,8 @@ class AsyncNSeries:
         else:
             request_data = CIPCommonFormat(cip_data_type_instance.data_type_code(), data=cip_data_type_instance.data)
             await self.connected_cip_dispatcher.write_tag_service(request_path, request_data)
+            if self.read_coalescer is not None:
+                self.read_coalescer.invalidate(request_path)
 
     async def verified_write_variable(self, variable_name: str, data, retry_count: int = 2):
         remaining_retry = retry_count
@@ -834,57 +1078,134 @@ class AsyncNSeries:
             logging.warning('Write Operation could not be completed within specified retry count')
             raise IOError('Write Operation could not be completed within specified retry count')
 
+    async def read_modify_write_variable(self, variable_name: str, or_mask: int, and_mask: int):
+        """
+        Change bits of an integer variable in the controller in one request, without reading it first. Bits that
+        are 1 in or_mask are set and bits that are 0 in and_mask are cleared. Other bits are left as they are
+        even when the controller program changes them at the same time
+        :param variable_name:
+        :param or_mask:
+        :param and_mask:
+        :return:
+        """
+        cip_data_type_instance = self.connected_cip_dispatcher.variables.get(variable_name)
+        if cip_data_type_instance is None:
+            cip_data_type_instance = await self._get_instance_from_variable_name(variable_name)
+        mask_size = cip_data_type_instance.size
+        request_path = self._request_path(variable_name)
+        reply = await self.connected_cip_dispatcher.read_modify_write_tag_service(
+            request_path, or_mask.to_bytes(mask_size, 'little'),
+            (and_mask & ((1 << mask_size * 8) - 1)).to_bytes(mask_size, 'little'))
+        if self.read_coalescer is not None:
+            self.read_coalescer.invalidate(request_path)
+        return reply
+
+    async def set_bit(self, variable_name: str, bit: int):
+        """
+        Set one bit of an integer variable without changing the others
+        :param variable_name:
+        :param bit: Bit number, 0 is the least significant bit
+        :return:
+        """
+        return await self.read_modify_write_variable(variable_name, 1 << bit, -1)
+
+    async def clear_bit(self, variable_name: str, bit: int):
+        """
+        Clear one bit of an integer variable without changing the others
+        :param variable_name:
+        :param bit: Bit number, 0 is the least significant bit
+        :return:
+        """
+        return await self.read_modify_write_variable(variable_name, 0, ~(1 << bit))
+
+    async def toggle_bit(self, variable_name: str, bit: int):
+        """
+        Invert one bit of an integer variable. The masks can only set or clear bits, so the bit is read first,
+        but the write still leaves the other bits as they are in the controller
+        :param variable_name:
+        :param bit: Bit number, 0 is the least significant bit
+        :return:
+        """
+        value = await self.read_variable(variable_name)
+        if isinstance(value, (bytes, bytearray)):
+            # Bit strings like WORD read as bytes
+            value = int.from_bytes(value, 'little')
+        if int(value) >> bit & 1:
+            return await self.clear_bit(variable_name, bit)
+        return await self.set_bit(variable_name, bit)
+
     async def _multi_message_variable_read(self, cip_datatype_object: CIPDataType, offset=0) -> CIPDataType:
         """
-        This method is to read data that does not fit into a single CIP message
+        This method is to read data that does not fit into a single CIP message. The segments are requested
+        together, at most pipeline_window at a time, and each reply is copied to its offset as it arrives
         :param cip_datatype_object:
         :param offset:
         :return:
         """
-        max_read_size = self.MAXIMUM_LENGTH - 8
-        data = b''
-        while offset < cip_datatype_object.size:
-            if cip_datatype_object.size - offset > max_read_size:
-                read_size = max_read_size
-            else:
-                read_size = cip_datatype_object.size - offset
-            response = await self._simple_data_segment_read(cip_datatype_object, offset, read_size)
-            reply_bytes = response.reply_data
+        max_read_size = self.maximum_length - 8
+        start_offset = offset
+        data = bytearray(max(cip_datatype_object.size - start_offset, 0))
+        string_segments = {}
+        window = asyncio.Semaphore(self.pipeline_window)
+
+        async def read_segment(segment_offset: int):
+            read_size = min(max_read_size, cip_datatype_object.size - segment_offset)
+            async with window:
+                response = await self._simple_data_segment_read(cip_datatype_object, segment_offset, read_size)
             cip_common_format = CIPCommonFormat()
-            cip_common_format.from_bytes(reply_bytes)
+            cip_common_format.from_bytes(response.reply_data)
             if isinstance(cip_datatype_object, CIPString):
                 # First two characters of the string seem to be how many characters were read
-                data = data + cip_common_format.data[2:]
-            elif isinstance(cip_datatype_object, CIPStructure):
+                string_segments[segment_offset] = cip_common_format.data[2:]
+                return
+            if isinstance(cip_datatype_object, CIPStructure):
                 cip_datatype_object.crc_code = cip_common_format.additional_info
-                data = data + cip_common_format.data
-            else:
-                data = data + cip_common_format.data
-            offset = offset + max_read_size
-        cip_datatype_object.data = data
+            segment = cip_common_format.data[0:read_size]
+            position = segment_offset - start_offset
+            data[position:position + len(segment)] = segment
+
+        await asyncio.gather(*[read_segment(segment_offset) for segment_offset in
+                               range(start_offset, cip_datatype_object.size, max_read_size)])
+        if isinstance(cip_datatype_object, CIPString):
+            cip_datatype_object.data = b''.join(string_segments[segment_offset]
+                                                for segment_offset in sorted(string_segments))
+        else:
+            cip_datatype_object.data = bytes(data)
+        if isinstance(cip_datatype_object, CIPStructure):
+            # The data is now what the controller has
+            cip_datatype_object.clear_dirty_ranges()
         # cip_datatype_object.size = len(data) # Removed Why did it exist? If weird stuff breaks revisit
         cip_datatype_object.value()
         return cip_datatype_object
 
     async def _multi_message_variable_write(self, cip_datatype_object: CIPDataType, offset=0) -> CIPReply:
         """
-        This method is to write data that does not fit into a single CIP message
+        This method is to write data that does not fit into a single CIP message. The segments are written
+        together, at most pipeline_window at a time. Of a structure that was read or written before only the
+        changed byte ranges are written, so members the controller changed in the meantime are left alone
         :param cip_datatype_object:
         :param offset:
         :return:
         """
-        max_write_size = 400
-        response = CIPReply
-        while offset < cip_datatype_object.size:
-            if cip_datatype_object.size - offset > max_write_size:
-                write_size = max_write_size
-            else:
-                write_size = cip_datatype_object.size - offset
-            response = await self._simple_data_segment_write(
-                cip_datatype_object, offset, write_size,
-                cip_datatype_object.data[offset:offset + write_size])
-            offset = offset + max_write_size
-        return response
+        max_write_size = await self._maximum_write_size(cip_datatype_object)
+        window = asyncio.Semaphore(self.pipeline_window)
+        write_ranges = [(offset, cip_datatype_object.size)]
+        if isinstance(cip_datatype_object, CIPStructure) and offset == 0:
+            write_ranges = cip_datatype_object.write_ranges()
+
+        async def write_segment(segment_offset: int, end_offset: int) -> CIPReply:
+            write_size = min(max_write_size, end_offset - segment_offset)
+            async with window:
+                return await self._simple_data_segment_write(
+                    cip_datatype_object, segment_offset, write_size,
+                    cip_datatype_object.data[segment_offset:segment_offset + write_size])
+
+        responses = await asyncio.gather(*[write_segment(segment_offset, end_offset)
+                                           for start_offset, end_offset in write_ranges
+                                           for segment_offset in range(start_offset, end_offset, max_write_size)])
+        if isinstance(cip_datatype_object, CIPStructure):
+            cip_datatype_object.clear_dirty_ranges()
+        return responses[-1]
 
     async def _simple_data_segment_read(self, cip_datatype_object: CIPDataType, offset, read_size) -> CIPReply:
         """
@@ -894,9 +1215,8 @@ class AsyncNSeries:
         :param read_size:
         :return:
         """
-        request_path = variable_request_path_segment(cip_datatype_object.variable_name)
-        simple_data_request_path = SimpleDataSegmentRequest(offset, read_size)
-        request_path = request_path + simple_data_request_path.bytes()
+        request_path = SimpleDataSegmentRequest.request_path(
+            cip_datatype_object.variable_name, offset, read_size, self._request_path(cip_datatype_object.variable_name))
         response = await self.connected_cip_dispatcher.read_tag_service(request_path)
         return response
 
@@ -909,30 +1229,51 @@ class AsyncNSeries:
         :param data:
         :return:
         """
-        request_path = variable_request_path_segment(cip_datatype_object.variable_name)
-        simple_data_request_path = SimpleDataSegmentRequest(offset, write_size)
-        request_path = request_path + simple_data_request_path.bytes()
-        response = None
+        request_path = SimpleDataSegmentRequest.request_path(
+            cip_datatype_object.variable_name, offset, write_size,
+            self._request_path(cip_datatype_object.variable_name))
+        request_data = await self._simple_data_segment_write_data(cip_datatype_object, data)
+        if request_data is None:
+            return None
+        return await self.connected_cip_dispatcher.write_tag_service(request_path, request_data)
+
+    async def _simple_data_segment_write_data(self, cip_datatype_object: CIPDataType, data) -> CIPCommonFormat:
+        """
+        The Write Tag data of one segment of a string, array or structure
+        :param cip_datatype_object:
+        :param data:
+        :return:
+        """
         if cip_datatype_object.data_type_code() == CIPString.data_type_code():
             data = struct.pack("<H", len(data)) + data
-            request_data = CIPCommonFormat(cip_datatype_object.data_type_code(), data=data)
-            response = await self.connected_cip_dispatcher.write_tag_service(request_path, request_data)
+            return CIPCommonFormat(cip_datatype_object.data_type_code(), data=data)
         elif cip_datatype_object.data_type_code() == CIPArray.data_type_code():
             if cip_datatype_object.array_data_type == CIPStructure.data_type_code():
                 structure_variable_type_object = \
                     await self._get_variable_type_object(cip_datatype_object.instance_id)
                 crc_code = structure_variable_type_object.crc_code.to_bytes(2, 'little')
-                request_data = CIPCommonFormat(CIPAbbreviatedStructure.data_type_code(), additional_info_length=2,
-                                               additional_info=crc_code,
-                                               data=data)
-            else:
-                request_data = CIPCommonFormat(cip_datatype_object.array_data_type, data=data)
-            response = await self.connected_cip_dispatcher.write_tag_service(request_path, request_data)
+                return CIPCommonFormat(CIPAbbreviatedStructure.data_type_code(), additional_info_length=2,
+                                       additional_info=crc_code,
+                                       data=data)
+            return CIPCommonFormat(cip_datatype_object.array_data_type, data=data)
         elif cip_datatype_object.data_type_code() == CIPStructure.data_type_code():
-            request_data = CIPCommonFormat(CIPAbbreviatedStructure.data_type_code(), additional_info_length=2,
-                                           additional_info=cip_datatype_object.crc_code, data=data)
-            response = await self.connected_cip_dispatcher.write_tag_service(request_path, request_data)
-        return response
+            return CIPCommonFormat(CIPAbbreviatedStructure.data_type_code(), additional_info_length=2,
+                                   additional_info=cip_datatype_object.crc_code, data=data)
+        return None
+
+    async def _maximum_write_size(self, cip_datatype_object: CIPDataType) -> int:
+        """
+        The largest segment of the data that fits in one Write Tag request, the maximum length less the
+        service, the request path with its simple data segment and the Write Tag data without the segment
+        :param cip_datatype_object:
+        :return:
+        """
+        request_path = SimpleDataSegmentRequest.request_path(
+            cip_datatype_object.variable_name, 0, 0, self._request_path(cip_datatype_object.variable_name))
+        request_data = await self._simple_data_segment_write_data(cip_datatype_object, b'')
+        if request_data is None:
+            request_data = CIPCommonFormat(cip_datatype_object.data_type_code())
+        return self.maximum_length - len(write_tag_request(request_path, request_data).bytes)
 
     async def _get_variable_object(self, instance_id: int) -> VariableObjectReply:
         """
@@ -950,14 +1291,18 @@ class AsyncNSeries:
     async def _get_variable_type_object(self, instance_id: int) -> VariableTypeObjectReply:
         """
         Omron specific CIP class that is used to describe variable types. This is where derived data types
-        will have their member definitions
+        will have their member definitions. Each instance is only read once
         :param instance_id:
         :return:
         """
+        variable_type_object_reply = self.variable_type_objects.get(instance_id)
+        if variable_type_object_reply is not None:
+            return variable_type_object_reply
         request_path = address_request_path_segment(
             class_id=b'\x6c', instance_id=instance_id.to_bytes(2, 'little'))
         variable_type_object_reply_value = await self.connected_cip_dispatcher.get_attribute_all_service(request_path)
         variable_type_object_reply = VariableTypeObjectReply(variable_type_object_reply_value.bytes)
+        self.variable_type_objects[instance_id] = variable_type_object_reply
         return variable_type_object_reply
 
     async def _get_number_of_derived_data_types(self) -> int:
@@ -1116,8 +1461,8 @@ class MonitoredVariable:
 
 class NSeriesThreadDispatcher:
     def __init__(self, host: str = None, connection_timeout: float = None,
-                 retry_time: float = 1.0, max_attempts: int = None):
-        self._instance = NSeries(host, connection_timeout)
+                 retry_time: float = 1.0, max_attempts: int = None, sessions: int = 1):
+        self._instance = NSeries(host, connection_timeout, sessions)
         self._host = None
         self.message_timeout = 0.5
         self.executor = None
@@ -1262,6 +1607,9 @@ class NSeriesThreadDispatcher:
         except struct.error as error:
             raise error
 
+    def read_variables(self, variable_names: List[str]) -> list:
+        return self._execute_eip_command(self._instance.read_variables, variable_names)
+
     def write_variable(self, variable_name: str, data):
         return self._execute_eip_command(self._instance.write_variable, variable_name, data)
 
@@ -1271,6 +1619,15 @@ class NSeriesThreadDispatcher:
         except struct.error as error:
             raise error
 
+    def set_bit(self, variable_name: str, bit: int):
+        return self._execute_eip_command(self._instance.set_bit, variable_name, bit)
+
+    def clear_bit(self, variable_name: str, bit: int):
+        return self._execute_eip_command(self._instance.clear_bit, variable_name, bit)
+
+    def toggle_bit(self, variable_name: str, bit: int):
+        return self._execute_eip_command(self._instance.toggle_bit, variable_name, bit)
+
     def close_explicit(self):
         self.connection_status.connected = False
         self.connection_status.has_session = False
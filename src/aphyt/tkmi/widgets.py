@@ -216,35 +216,64 @@ class MomentaryButtonMixin(DispatcherMixin):
 
 
 class SetButtonMixin(DispatcherMixin):
-    def __init__(self, variable_name: str = None, **kwargs):
+    def __init__(self, variable_name: str = None, bit: int = None, **kwargs):
+        """
+        :param variable_name:
+        :param bit: Bit of an integer variable to set instead of writing a BOOL variable
+        :param kwargs:
+        """
         super().__init__(**kwargs)
         self.variable_name = variable_name
+        self.bit = bit
 
     def _on_press(self, event):
-        self.dispatcher.verified_write_variable(self.variable_name, True)
+        if self.bit is not None:
+            self.dispatcher.set_bit(self.variable_name, self.bit)
+        else:
+            self.dispatcher.verified_write_variable(self.variable_name, True)
 
     def _on_release(self, event):
         pass
 
 
 class ResetButtonMixin(DispatcherMixin):
-    def __init__(self, variable_name: str = None, **kwargs):
+    def __init__(self, variable_name: str = None, bit: int = None, **kwargs):
+        """
+        :param variable_name:
+        :param bit: Bit of an integer variable to clear instead of writing a BOOL variable
+        :param kwargs:
+        """
         super().__init__(**kwargs)
         self.variable_name = variable_name
+        self.bit = bit
 
     def _on_press(self, event):
-        self.dispatcher.verified_write_variable(self.variable_name, False)
+        if self.bit is not None:
+            self.dispatcher.clear_bit(self.variable_name, self.bit)
+        else:
+            self.dispatcher.verified_write_variable(self.variable_name, False)
 
     def _on_release(self, event):
         pass
 
 
 class ToggleButtonMixin(DispatcherMixin):
-    def __init__(self, variable_name: str = None, dispatcher: NSeriesThreadDispatcher = None, **kwargs):
+    def __init__(self, variable_name: str = None, dispatcher: NSeriesThreadDispatcher = None, bit: int = None,
+                 **kwargs):
+        """
+        :param variable_name:
+        :param dispatcher:
+        :param bit: Bit of an integer variable to toggle instead of a BOOL variable
+        :param kwargs:
+        """
         super().__init__(dispatcher, **kwargs)
         self.variable_name = variable_name
+        self.bit = bit
 
     def _on_press(self, event):
+        if self.bit is not None:
+            self.dispatcher.toggle_bit(self.variable_name, self.bit)
+            return
         reply = self.dispatcher.read_variable(self.variable_name)
         if reply:
             self.dispatcher.verified_write_variable(self.variable_name, False)
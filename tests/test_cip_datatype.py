@@ -5,10 +5,19 @@ __email__ = "jr@aphyt.com"
 
 from aphyt.cip.cip_datatypes import *
 from aphyt.eip import *
+import copy
+import math
+import pickle
+import struct
 import unittest
 from unittest.mock import Mock
 from unittest.mock import patch
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class TestCipDataTypes(unittest.TestCase):
     def test_cip_boolean_true(self):
@@ -128,7 +137,7 @@ class TestCipDataTypes(unittest.TestCase):
 
     def test_eip_commands(self):
         eip_test = EIPConnectedCIPDispatcher()
-        eip_test.send_command = Mock()
+        eip_test.send_command = Mock(return_value=EIPMessage(b'\x04\x00'))
         eip_test.list_services('')
         args = eip_test.send_command.call_args
         self.assertEqual(args.args[0].bytes(),
@@ -232,3 +241,353 @@ class TestCipDataTypes(unittest.TestCase):
         cip_structure.from_value(cip_structure)  # are we supposed to do this to update cip_structure.data ?
 
         self.assertEqual(cip_structure.data, b'\x00\x00\x01\x00\x01\x00')  # This is the real test assert
+
+    def test_structure_layout(self):
+        cip_structure = CIPStructure()
+        cip_structure.add_member('bool_1', CIPBoolean())
+        cip_structure.add_member('lreal_member', CIPLongReal())
+        cip_structure.add_member('sint_member', CIPShortInteger())
+        cip_structure.add_member('int_member', CIPInteger())
+        self.assertEqual(cip_structure.layout().structure.format, '<2s6x8s1s1x2s')
+        cip_structure.data = b'\x01\x00' + bytes(6) + struct.pack('<d', 1.5) + b'\xff\x00' + struct.pack('<h', -2)
+        cip_structure.value()
+        self.assertEqual((cip_structure['bool_1'].value(), cip_structure['lreal_member'].value(),
+                          cip_structure['sint_member'].value(), cip_structure['int_member'].value()),
+                         (True, 1.5, -1, -2))
+        cip_structure['int_member'] = 7
+        self.assertEqual(cip_structure.data[-2:], b'\x07\x00')
+
+    def test_structure_layout_is_shared_by_crc_code(self):
+        structures = []
+        for _ in range(2):
+            cip_structure = CIPStructure()
+            cip_structure.variable_type_name = 'SharedType'
+            cip_structure.crc_code = b'\x01\x02'
+            cip_structure.add_member('dint_member', CIPDoubleInteger())
+            structures.append(cip_structure)
+        self.assertIs(structures[0].layout(), structures[1].layout())
+
+    def test_structure_copy_and_pickle(self):
+        cip_structure = CIPStructure()
+        cip_structure.add_member('real_member', CIPReal())
+        cip_structure['real_member'] = 2.5
+        for structure_copy in (copy.deepcopy(cip_structure), pickle.loads(pickle.dumps(cip_structure))):
+            structure_copy.value()
+            self.assertEqual(structure_copy['real_member'].value(), 2.5)
+
+    def test_new_instance_shares_type(self):
+        inner_structure = CIPStructure()
+        inner_structure.add_member('int_member', CIPInteger())
+        inner_structure.size = 2
+        prototype = CIPStructure()
+        prototype.variable_type_name = 'SharedType'
+        prototype.crc_code = b'\x03\x04'
+        prototype.add_member('real_member', CIPReal())
+        prototype.add_member('inner', inner_structure)
+        first, second = prototype.new_instance(), prototype.new_instance()
+        self.assertIs(first.layout(), prototype.layout())
+        self.assertIsNone(first._members)
+        first.data = struct.pack('<fh', 1.5, 3)
+        first.value()
+        self.assertEqual((first['real_member'].value(), first['inner']['int_member'].value()), (1.5, 3))
+        self.assertIsNot(first['real_member'], prototype['real_member'])
+        self.assertIsNone(second._members)
+        first['inner']['int_member'] = 4
+        self.assertEqual(first.data, struct.pack('<fh', 1.5, 4))
+        self.assertEqual(prototype['inner']['int_member'].value(), 0)
+        structure_copy = pickle.loads(pickle.dumps(second))
+        self.assertEqual(list(structure_copy.members), ['real_member', 'inner'])
+
+    def test_dirty_ranges(self):
+        inner_structure = CIPStructure()
+        inner_structure.add_member('int_member', CIPInteger())
+        inner_structure.add_member('bool_member', CIPBoolean())
+        inner_structure.size = 4
+        prototype = CIPStructure()
+        prototype.add_member('real_member', CIPReal())
+        prototype.add_member('inner', inner_structure)
+        prototype.add_member('lreal_member', CIPLongReal())
+        cip_structure = prototype.new_instance()
+        cip_structure['real_member'] = 1.0
+        cip_structure['inner']['bool_member'] = True
+        self.assertEqual(cip_structure.dirty_ranges(), [(0, 4), (6, 8)])
+        cip_structure['inner']['int_member'] = 2
+        self.assertEqual(cip_structure.dirty_ranges(), [(0, 8)])
+        cip_structure.from_value(prototype)
+        self.assertEqual(cip_structure.dirty_ranges(), [])
+
+    def test_members_are_decoded_when_used(self):
+        inner_structure = CIPStructure()
+        inner_structure.add_member('int_member', CIPInteger())
+        inner_structure.add_member('dint_member', CIPDoubleInteger())
+        inner_structure.size = 8
+        prototype = CIPStructure()
+        prototype.add_member('real_member', CIPReal())
+        prototype.add_member('inner', inner_structure)
+        prototype.size = 12
+        # Members of a new instance have not been handed out, so they are decoded only when used
+        cip_structure = prototype.new_instance()
+        cip_structure.data = struct.pack('<fh2xl', 1.5, 3, -4)
+        cip_structure.value()
+        self.assertEqual(cip_structure.member_types()['real_member'].data, b'\x00\x00\x00\x00')
+        self.assertEqual(cip_structure['inner']['dint_member'].value(), -4)
+        self.assertIsInstance(cip_structure['inner'].data, memoryview)
+        self.assertEqual(cip_structure.member_types()['real_member'].data, b'\x00\x00\x00\x00')
+        self.assertEqual(cip_structure['real_member'].value(), 1.5)
+        cip_structure.data = struct.pack('<fh2xl', 2.5, 5, 6)
+        cip_structure.value()
+        self.assertEqual([member.data for member in cip_structure.members.values()][0], struct.pack('<f', 2.5))
+        structure_copy = pickle.loads(pickle.dumps(cip_structure))
+        self.assertEqual(structure_copy['inner']['int_member'].value(), 5)
+        cip_structure['inner']['int_member'] = 7
+        self.assertEqual(cip_structure.data, struct.pack('<fh2xl', 2.5, 7, 6))
+
+    def test_kept_nested_structure_follows_reads(self):
+        inner_structure = CIPStructure()
+        inner_structure.add_member('int_member', CIPInteger())
+        inner_structure.size = 2
+        cip_structure = CIPStructure()
+        cip_structure.add_member('dint_member', CIPDoubleInteger())
+        cip_structure.add_member('inner', inner_structure)
+        inner_structure.callback = cip_structure.from_value
+        inner_structure.callback_arg = cip_structure
+        cip_structure.data = struct.pack('<lh', 1, 2)
+        cip_structure.value()
+        inner = cip_structure['inner']
+        cip_structure.data = struct.pack('<lh', 3, 5)
+        cip_structure.value()
+        self.assertEqual(inner['int_member'].value(), 5)
+        inner['int_member'] = 99
+        self.assertEqual(cip_structure.data, struct.pack('<lh', 3, 99))
+        self.assertEqual(cip_structure['inner']['int_member'].value(), 99)
+        self.assertEqual(cip_structure.dirty_ranges(), [(4, 6)])
+
+    def test_kept_members_follow_reads(self):
+        prototype = CIPStructure()
+        prototype.add_member('a', CIPDoubleInteger())
+        prototype.add_member('b', CIPDoubleInteger())
+        prototype.size = 8
+        cip_structure = prototype.new_instance()
+        cip_structure.data = struct.pack('<ll', 1, 2)
+        cip_structure.value()
+        a = cip_structure['a']
+        cip_structure.data = struct.pack('<ll', 7, 8)
+        cip_structure.value()
+        self.assertEqual(a.value(), 7)
+        self.assertEqual(cip_structure['a'].value(), 7)
+        # Members that were never handed out are still decoded when used
+        self.assertEqual(cip_structure.member_types()['b'].data, b'\x00\x00\x00\x00')
+        members = cip_structure.members
+        cip_structure.data = struct.pack('<ll', 9, 10)
+        cip_structure.value()
+        self.assertEqual([member.value() for member in members.values()], [9, 10])
+
+    def test_layout_of_same_type_with_other_members(self):
+        layouts = []
+        for member in (CIPInteger(), CIPDoubleInteger()):
+            cip_structure = CIPStructure()
+            cip_structure.variable_type_name = 'Recipe'
+            cip_structure.crc_code = b'\x12\x34'
+            cip_structure.add_member('count', member)
+            cip_structure.add_member('level', CIPReal())
+            layouts.append(cip_structure.layout())
+        self.assertEqual([layout.size for layout in layouts], [8, 8])
+        self.assertEqual([layout.member_offsets['level'] for layout in layouts], [4, 4])
+        self.assertEqual([layout.structure.format for layout in layouts], ['<2s2x4s', '<4s4s'])
+
+    def test_members_past_short_data_keep_their_data(self):
+        cip_structure = CIPStructure()
+        cip_structure.add_member('int_member', CIPInteger())
+        cip_structure.add_member('dint_member', CIPDoubleInteger())
+        cip_structure.add_member('real_member', CIPReal())
+        cip_structure['real_member'] = 1.5
+        cip_structure.data = struct.pack('<h2xl', 3, 4)
+        cip_structure.value()
+        self.assertEqual(cip_structure['int_member'].value(), 3)
+        self.assertEqual(cip_structure['dint_member'].value(), 4)
+        self.assertEqual(cip_structure['real_member'].value(), 1.5)
+
+
+class TestCIPBooleanArray(unittest.TestCase):
+    def boolean_array(self, number_of_elements: list, use_numpy: bool = False) -> CIPArray:
+        cip_array = CIPArray(use_numpy=use_numpy)
+        cip_array.from_items(b'\xc1', 2, len(number_of_elements), number_of_elements, [0] * len(number_of_elements))
+        return cip_array
+
+    def test_decode(self):
+        cip_array = self.boolean_array([20])
+        cip_array.data = b'\x05\x80\x08\x00'
+        expected = [offset in (0, 2, 15, 19) for offset in range(20)]
+        self.assertEqual(cip_array.value(), expected)
+        with patch('aphyt.cip.cip_datatypes.numpy', None):
+            self.assertEqual(cip_array.value(), expected)
+
+    def test_encode_pads_to_size(self):
+        cip_array = self.boolean_array([20])
+        values = [offset in (0, 2, 15, 19) for offset in range(20)]
+        cip_array.from_value(values)
+        self.assertEqual(cip_array.data, b'\x05\x80\x08\x00')
+        with patch('aphyt.cip.cip_datatypes.numpy', None):
+            cip_array.from_value(values)
+            self.assertEqual(cip_array.data, b'\x05\x80\x08\x00')
+            self.assertEqual(cip_array.value(), values)
+
+    def test_multiple_dimensions(self):
+        cip_array = self.boolean_array([3, 16])
+        values = [[(row + column) % 3 == 0 for column in range(16)] for row in range(3)]
+        cip_array.from_value(values)
+        self.assertEqual(len(cip_array.data), cip_array.size)
+        self.assertEqual(cip_array.value(), values)
+
+    def test_too_many_values(self):
+        with self.assertRaises(ValueError):
+            pack_bits([True] * 17, 2)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        cip_array = self.boolean_array([2, 16], use_numpy=True)
+        cip_array.data = b'\x01\x00\x00\x80'
+        values = cip_array.value()
+        self.assertEqual(values.dtype, numpy.dtype(bool))
+        self.assertEqual(values.shape, (2, 16))
+        self.assertTrue(values[0][0] and values[1][15])
+        self.assertEqual(int(values.sum()), 2)
+        cip_array.from_value(numpy.logical_not(values))
+        self.assertEqual(cip_array.data, b'\xfe\xff\xff\x7f')
+
+
+class TestLazyCIPArray(unittest.TestCase):
+    def dint_array(self, number_of_elements: list, element_cache_size: int = 0) -> CIPArray:
+        cip_array = CIPArray(lazy=True, element_cache_size=element_cache_size)
+        cip_array.from_items(b'\xc4', 4, len(number_of_elements), number_of_elements, [0] * len(number_of_elements))
+        cip_array.data = struct.pack('<%dl' % math.prod(number_of_elements), *range(math.prod(number_of_elements)))
+        return cip_array
+
+    def test_elements_are_decoded_when_used(self):
+        cip_array = self.dint_array([1000])
+        self.assertIs(cip_array.value(), cip_array)
+        self.assertEqual(cip_array.list_representation, [])
+        self.assertEqual((cip_array[5], cip_array[-1], len(cip_array)), (5, 999, 1000))
+        self.assertEqual(cip_array[10:13], [10, 11, 12])
+        self.assertEqual(sum(cip_array), sum(range(1000)))
+        with self.assertRaises(IndexError):
+            cip_array[1000]
+        self.assertEqual(cip_array.materialize(), list(range(1000)))
+
+    def test_set_element_encodes_into_data(self):
+        cip_array = self.dint_array([10])
+        cip_array[3] = -7
+        cip_array[8:10] = [1, 2]
+        self.assertIsInstance(cip_array.data, bytearray)
+        self.assertEqual(cip_array.data[12:16], struct.pack('<l', -7))
+        self.assertEqual(cip_array, [0, 1, 2, -7, 4, 5, 6, 7, 1, 2])
+        data = bytes(cip_array.data)
+        cip_array.from_value(cip_array)
+        self.assertEqual(cip_array.data, data)
+        with self.assertRaises(ValueError):
+            cip_array[0:2] = [1]
+
+    def test_multiple_dimensions(self):
+        cip_array = self.dint_array([3, 4])
+        self.assertEqual(cip_array[1], [4, 5, 6, 7])
+        cip_array[2] = [0, 0, 0, 1]
+        self.assertEqual(cip_array.data[32:48], struct.pack('<4l', 0, 0, 0, 1))
+
+    def test_boolean_elements(self):
+        cip_array = CIPArray(lazy=True)
+        cip_array.from_items(b'\xc1', 2, 1, [20], [0])
+        cip_array.data = b'\x05\x80\x08\x00'
+        self.assertEqual([index for index, bit in enumerate(cip_array) if bit], [0, 2, 15, 19])
+        cip_array[2] = False
+        cip_array[16] = True
+        self.assertEqual(cip_array.data, b'\x01\x80\x09\x00')
+
+    def test_element_cache(self):
+        cip_array = self.dint_array([10], element_cache_size=2)
+        for index in (1, 2, 3):
+            cip_array[index]
+        self.assertEqual(list(cip_array._element_cache), [2, 3])
+        cip_array.value()
+        self.assertEqual(cip_array._element_cache, {})
+
+    def test_arrays_pickled_before_lazy_mode(self):
+        cip_array = self.dint_array([4])
+        state = cip_array.__dict__.copy()
+        for attribute in ('use_numpy', 'lazy', 'element_cache_size', '_element_cache'):
+            del state[attribute]
+        restored_array = CIPArray.__new__(CIPArray)
+        restored_array.__setstate__(state)
+        self.assertEqual(restored_array.value(), [0, 1, 2, 3])
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestCIPArrayNumpy(unittest.TestCase):
+    def real_array(self, use_numpy: bool) -> CIPArray:
+        cip_array = CIPArray(use_numpy=use_numpy)
+        cip_array.from_items(b'\xca', 4, 2, [3, 4], [0, 0])
+        cip_array.data = struct.pack('<12f', *range(12))
+        return cip_array
+
+    def test_decode(self):
+        values = self.real_array(True).value()
+        self.assertIsInstance(values, numpy.ndarray)
+        self.assertEqual(values.dtype, numpy.dtype('<f4'))
+        self.assertEqual(values.shape, (3, 4))
+        self.assertEqual(values.tolist(), self.real_array(False).value())
+
+    def test_list_is_default(self):
+        self.assertIsInstance(self.real_array(False).value(), list)
+
+    def test_bit_strings_stay_bytes(self):
+        cip_array = CIPArray(use_numpy=True)
+        cip_array.from_items(b'\xd2', 2, 1, [3], [0])
+        cip_array.data = b'\x01\x00\x02\x00\x03\x00'
+        self.assertEqual(cip_array.value(), [b'\x01\x00', b'\x02\x00', b'\x03\x00'])
+
+    def structure_array(self, use_numpy: bool) -> CIPArray:
+        values = CIPArray()
+        values.from_items(b'\xc3', 2, 1, [2], [0])
+        cip_structure = CIPStructure()
+        cip_structure.add_member('Count', CIPDoubleInteger())
+        cip_structure.add_member('Running', CIPBoolean())
+        cip_structure.add_member('Speed', CIPReal())
+        cip_structure.add_member('Values', values)
+        cip_structure.size = 16
+        cip_array = CIPArray(use_numpy=use_numpy)
+        cip_array.from_instance(cip_structure, 16, 1, [3], [0])
+        cip_array.data = b''.join(struct.pack('<l?xxxfhh', index, index % 2 == 1, index / 2, index, -index)
+                                  for index in range(3))
+        return cip_array
+
+    def test_structure_dtype(self):
+        dtype = self.structure_array(True).local_cip_data_type_object.numpy_dtype()
+        self.assertEqual(dtype.names, ('Count', 'Running', 'Speed', 'Values'))
+        self.assertEqual([dtype.fields[name][1] for name in dtype.names], [0, 4, 8, 12])
+        self.assertEqual((dtype['Speed'], dtype['Values'].shape, dtype.itemsize), (numpy.dtype('<f4'), (2,), 16))
+
+    def test_decode_structures(self):
+        values = self.structure_array(True).value()
+        self.assertEqual(values.shape, (3,))
+        self.assertEqual(values['Count'].tolist(), [0, 1, 2])
+        self.assertEqual(values['Running'].tolist(), [False, True, False])
+        self.assertEqual(values['Values'][2].tolist(), [2, -2])
+        self.assertTrue(numpy.shares_memory(values['Speed'], values))
+        structures = self.structure_array(False).value()
+        self.assertEqual(values['Speed'].tolist(), [structure['Speed'].value() for structure in structures])
+
+    def test_encode_structures(self):
+        cip_array = self.structure_array(True)
+        data = cip_array.data
+        values = cip_array.value()
+        cip_array.from_value(values)
+        self.assertEqual(cip_array.data, data)
+        values['Speed'] = 4.0
+        cip_array.from_value(values)
+        self.assertEqual(struct.unpack_from('<f', cip_array.data, 40)[0], 4.0)
+
+    def test_encode(self):
+        cip_array = self.real_array(False)
+        cip_array.from_value(numpy.arange(12, 0, -1).reshape(3, 4))
+        self.assertEqual(cip_array.data, struct.pack('<12f', *range(12, 0, -1)))
+        with self.assertRaises(ValueError):
+            cip_array.from_value(numpy.zeros(5))
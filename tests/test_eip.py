@@ -0,0 +1,1275 @@
+__author__ = 'Joseph Ryan'
+__license__ = "GPLv2"
+__maintainer__ = "Joseph Ryan"
+__email__ = "jr@aphyt.com"
+
+import asyncio
+import pickle
+import socket
+import struct
+import unittest
+from unittest.mock import patch
+from aphyt.eip import *
+from aphyt.omron.n_series import SimpleDataSegmentRequest, AsyncNSeries, InstanceIDAttributes, \
+    symbol_instance_request_path_segment, VariableObjectReply
+from aphyt.cip.cip_datatypes import CIPStructure, CIPDoubleInteger, CIPReal, CIPWord, CIPArray, \
+    update_data_type_dictionary
+from aphyt.cip.cip import CIPReply, CIPRequest, CIPService, CIPException, ForwardOpenRequest, MultipleServicePacket, \
+    CIPCommonFormat, AsyncReadTagCoalescer, address_request_path_segment, variable_request_path_segment, \
+    CIPCRC16, cip_crc16, AsyncCIPDispatcher, read_modify_write_tag_request, \
+    GetAttributeList
+from aphyt.eip.cip_objects.tcp_interface import TCPInterfaceObject
+from aphyt.eip.cip_objects.identity import IdentityObject
+from aphyt.eip.cip_objects.ethernet_link import EthernetLinkObject
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def cip_reply_bytes(request_bytes: bytes, general_status: bytes = b'\x00', reply_data: bytes = b'') -> bytes:
+    """Build the CIP reply a target would send for a request"""
+    reply_service = (request_bytes[0] | 0x80).to_bytes(1, 'little')
+    return reply_service + b'\x00' + general_status + b'\x00' + reply_data
+
+
+def eip_reply_bytes(request: EIPMessage, cip_reply: bytes) -> bytes:
+    """Wrap a CIP reply in the send_rr_data reply a target would send for an Ethernet/IP request"""
+    common_packet_format = CommonPacketFormat([DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, cip_reply)])
+    command_specific_data = CommandSpecificData(encapsulated_packet=common_packet_format.bytes())
+    reply = EIPMessage(request.command, command_specific_data.bytes(), b'\x01\x02\x03\x04',
+                       sender_context_data=request.sender_context_data)
+    return reply.bytes()
+
+
+def unit_data_reply_bytes(request: EIPMessage, cip_reply: bytes, connection_id: bytes) -> bytes:
+    """Wrap a CIP reply in the send_unit_data reply a target would send on a class 3 connection"""
+    sequence_count = request.response_key()[1].to_bytes(2, 'little')
+    common_packet_format = CommonPacketFormat(
+        [DataAndAddressItem(DataAndAddressItem.CONNECTED_ADDRESS_ITEM, connection_id),
+         DataAndAddressItem(DataAndAddressItem.CONNECTED_TRANSPORT_PACKET, sequence_count + cip_reply)])
+    command_specific_data = CommandSpecificData(timeout=b'\x00\x00', encapsulated_packet=common_packet_format.bytes())
+    reply = EIPMessage(request.command, command_specific_data.bytes(), b'\x01\x02\x03\x04')
+    return reply.bytes()
+
+
+def cip_request_from_eip_message(request: EIPMessage) -> bytes:
+    command_specific_data = CommandSpecificData()
+    command_specific_data.from_bytes(request.command_data)
+    common_packet_format = CommonPacketFormat([])
+    common_packet_format.from_bytes(command_specific_data.encapsulated_packet)
+    if request.command == b'\x70\x00':
+        # Skip the sequence count
+        return bytes(common_packet_format.packets[1].data[2:])
+    return bytes(common_packet_format.packets[1].data)
+
+
+class FakeEIPTarget:
+    """
+    Minimal Ethernet/IP target on the loopback interface. Replies to send_rr_data requests are held until
+    batch_size requests are queued and then sent in reverse order, so clients must match on sender context.
+    The reply data of each CIP reply is the request path of the request.
+    """
+
+    def __init__(self, batch_size: int = 1):
+        self.batch_size = batch_size
+        self.server = None
+        self.port = None
+        self.received_requests = 0
+        self.maximum_queued = 0
+        self.busy_replies = 0
+        self.supports_large_forward_open = True
+        self.connection_size = None
+        self.o_t_connection_id = b'\x11\x22\x33\x44'
+        self.t_o_connection_id = None
+        self.services = []
+        self.maximum_reply_length = 502
+        # General status to refuse Multiple Service Packets with, or None to answer them
+        self.multiple_service_status = None
+        # One Communications service that supports CIP over TCP and class 0/1 over UDP
+        self.list_services_data = b'\x01\x00\x00\x01\x14\x00\x01\x00\x20\x01' + b'Communications\x00\x00'
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_client, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queued = []
+        try:
+            while True:
+                header = await reader.readexactly(24)
+                data = await reader.readexactly(struct.unpack('<H', header[2:4])[0])
+                request = EIPMessage()
+                request.from_bytes(header + data)
+                self.received_requests += 1
+                if request.command == b'\x65\x00':
+                    reply = EIPMessage(request.command, request.command_data, b'\x01\x02\x03\x04',
+                                       sender_context_data=request.sender_context_data)
+                    writer.write(reply.bytes())
+                    continue
+                if request.command == b'\x04\x00':
+                    reply = EIPMessage(request.command, self.list_services_data, b'\x01\x02\x03\x04',
+                                       sender_context_data=request.sender_context_data)
+                    writer.write(reply.bytes())
+                    continue
+                queued.append(request)
+                self.maximum_queued = max(self.maximum_queued, len(queued))
+                if len(queued) >= self.batch_size:
+                    for queued_request in reversed(queued):
+                        cip_reply = self._cip_reply(queued_request)
+                        if queued_request.command == b'\x70\x00':
+                            writer.write(unit_data_reply_bytes(queued_request, cip_reply, self.t_o_connection_id))
+                        else:
+                            writer.write(eip_reply_bytes(queued_request, cip_reply))
+                    queued = []
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    def _cip_reply(self, request: EIPMessage) -> bytes:
+        cip_request = cip_request_from_eip_message(request)
+        self.services.append((request.command, cip_request[0:1]))
+        if cip_request[2:6] == ForwardOpenRequest.CONNECTION_MANAGER_PATH:
+            return self._connection_manager_reply(cip_request)
+        if self.busy_replies > 0:
+            self.busy_replies -= 1
+            return cip_reply_bytes(cip_request, b'\x02')
+        if cip_request[0:1] == CIPService.MULTIPLE_SERVICE_PACKET:
+            return self._multiple_service_reply(cip_request)
+        return self._service_reply(cip_request)
+
+    @staticmethod
+    def _service_reply(cip_request: bytes) -> bytes:
+        """Paths containing 'Bad' do not exist, other requests are answered with their request path"""
+        request_path = cip_request[2:2 + cip_request[1] * 2]
+        if b'Bad' in request_path:
+            return cip_reply_bytes(cip_request, b'\x04')
+        return cip_reply_bytes(cip_request, reply_data=request_path)
+
+    def _multiple_service_reply(self, cip_request: bytes) -> bytes:
+        if self.multiple_service_status is not None:
+            return cip_reply_bytes(cip_request, self.multiple_service_status)
+        request_data = cip_request[6:]
+        number_of_services = struct.unpack_from('<H', request_data, 0)[0]
+        offsets = list(struct.unpack_from('<%dH' % number_of_services, request_data, 2)) + [len(request_data)]
+        replies = [self._service_reply(request_data[offsets[index]:offsets[index + 1]])
+                   for index in range(number_of_services)]
+        reply_offsets = []
+        offset = 2 + 2 * number_of_services
+        for reply in replies:
+            reply_offsets.append(offset)
+            offset += len(reply)
+        reply_data = struct.pack('<%dH' % (number_of_services + 1), number_of_services, *reply_offsets) + \
+            b''.join(replies)
+        if len(reply_data) + 4 > self.maximum_reply_length:
+            return cip_reply_bytes(cip_request, b'\x11')
+        general_status = b'\x1e' if any(reply[2] != 0 for reply in replies) else b'\x00'
+        return cip_reply_bytes(cip_request, general_status, reply_data)
+
+    def _connection_manager_reply(self, cip_request: bytes) -> bytes:
+        service = cip_request[0:1]
+        request_data = cip_request[6:]
+        if service == CIPService.LARGE_FORWARD_OPEN and not self.supports_large_forward_open:
+            return cip_reply_bytes(cip_request, b'\x08')
+        if service == CIPService.FORWARD_CLOSE:
+            self.connection_size = None
+            return cip_reply_bytes(cip_request, reply_data=request_data[2:10] + b'\x00\x00')
+        if service == CIPService.LARGE_FORWARD_OPEN:
+            self.connection_size = struct.unpack('<L', request_data[26:30])[0] & 0xffff
+        else:
+            self.connection_size = struct.unpack('<H', request_data[26:28])[0] & 0x01ff
+        self.t_o_connection_id = request_data[6:10]
+        reply_data = self.o_t_connection_id + self.t_o_connection_id + request_data[10:18] + \
+            request_data[22:26] + request_data[22:26] + b'\x00\x00'
+        return cip_reply_bytes(cip_request, reply_data=reply_data)
+
+
+class TestAsyncEIPPipelining(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.target = FakeEIPTarget(batch_size=4)
+        await self.target.start()
+        self.dispatcher = AsyncEIPConnectedCIPDispatcher()
+        self.dispatcher.explicit_message_port = self.target.port
+        await self.dispatcher.connect_explicit('127.0.0.1')
+        await self.dispatcher.register_session()
+
+    async def asyncTearDown(self):
+        await self.dispatcher.close_explicit()
+        await self.target.stop()
+
+    async def test_register_session(self):
+        self.assertTrue(self.dispatcher.has_session_handle)
+        self.assertEqual(self.dispatcher.session_handle_id, b'\x01\x02\x03\x04')
+
+    async def test_list_services_returns_bytes(self):
+        services = await self.dispatcher.list_services()
+        self.assertIsInstance(services, bytes)
+        self.assertEqual(services, self.target.list_services_data)
+
+    async def test_out_of_order_replies_are_matched(self):
+        paths = [address_request_path_segment(b'\x6b', index.to_bytes(2, 'little')) for index in range(16)]
+        replies = await asyncio.gather(*[self.dispatcher.read_tag_service(path) for path in paths])
+        self.assertEqual([reply.reply_data for reply in replies], paths)
+        self.assertEqual(self.target.maximum_queued, 4)
+
+    async def test_outstanding_request_window(self):
+        self.dispatcher.maximum_outstanding_requests = 2
+        self.target.batch_size = 2
+        paths = [address_request_path_segment(b'\x6b', index.to_bytes(2, 'little')) for index in range(6)]
+        replies = await asyncio.gather(*[self.dispatcher.read_tag_service(path) for path in paths])
+        self.assertEqual([reply.reply_data for reply in replies], paths)
+        self.assertEqual(self.target.maximum_queued, 2)
+
+    def test_outstanding_request_window_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            self.dispatcher.maximum_outstanding_requests = 0
+
+    async def test_resource_unavailable_is_retried(self):
+        self.target.batch_size = 1
+        self.target.busy_replies = 3
+        path = address_request_path_segment(b'\x6b', b'\x01\x00')
+        reply = await self.dispatcher.read_tag_service(path)
+        self.assertEqual(reply.reply_data, path)
+
+    async def test_close_fails_pending_requests(self):
+        self.target.batch_size = 100
+        request = asyncio.ensure_future(self.dispatcher.read_tag_service(b'\x20\x6b\x24\x01'))
+        await asyncio.sleep(0.05)
+        await self.dispatcher.close_explicit()
+        with self.assertRaises(ConnectionError):
+            await request
+
+
+class ChunkedSocket:
+    """Socket stand in that returns the queued reply bytes in the chunk sizes given"""
+
+    def __init__(self, data: bytes, chunk_sizes):
+        self.data = data
+        self.chunk_sizes = list(chunk_sizes)
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+
+    def recv_into(self, buffer):
+        chunk_size = self.chunk_sizes.pop(0) if self.chunk_sizes else len(self.data)
+        chunk_size = min(chunk_size, len(buffer), len(self.data))
+        buffer[0:chunk_size] = self.data[0:chunk_size]
+        self.data = self.data[chunk_size:]
+        return chunk_size
+
+    def close(self):
+        pass
+
+
+class TestEIPFraming(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = EIPConnectedCIPDispatcher()
+        self.dispatcher.is_connected_explicit = True
+        self.dispatcher.message_number = 0
+
+    def _requests_and_replies(self, reply_data_sizes):
+        requests = []
+        replies = b''
+        for index, reply_data_size in enumerate(reply_data_sizes):
+            request = EIPMessage(b'\x6f\x00')
+            request.set_context(index)
+            requests.append(request)
+            cip_request = CIPRequest(CIPService.READ_TAG_SERVICE, b'\x20\x6b\x24\x01')
+            replies += eip_reply_bytes(request, cip_reply_bytes(cip_request.bytes, reply_data=bytes(reply_data_size)))
+        return requests, replies
+
+    def test_fragmented_reply(self):
+        requests, replies = self._requests_and_replies([10])
+        self.dispatcher.explicit_message_socket = ChunkedSocket(replies, [3, 20, 5])
+        reply = self.dispatcher.get_response(requests[0])
+        self.assertEqual(reply.bytes(), replies)
+
+    def test_back_to_back_replies(self):
+        requests, replies = self._requests_and_replies([4, 8, 12])
+        self.dispatcher.explicit_message_socket = ChunkedSocket(replies, [len(replies)])
+        first = self.dispatcher.get_response(requests[0])
+        self.assertEqual(first.context_integer(), 0)
+        self.assertIn(1, self.dispatcher.eip_responses)
+        self.assertIn(2, self.dispatcher.eip_responses)
+        self.assertEqual(self.dispatcher.get_response(requests[2]).context_integer(), 2)
+        self.assertEqual(self.dispatcher.get_response(requests[1]).context_integer(), 1)
+        self.assertEqual(len(self.dispatcher.explicit_message_socket.sent), 1)
+
+    def test_reply_larger_than_buffer(self):
+        requests, replies = self._requests_and_replies([10, 6000, 10])
+        self.dispatcher.explicit_message_socket = ChunkedSocket(replies, [1000] * 10)
+        for request in requests:
+            reply = self.dispatcher.get_response(request)
+            self.assertEqual(reply.context_integer(), request.context_integer())
+        self.assertEqual(self.dispatcher._receive_start, 0)
+        self.assertEqual(self.dispatcher._receive_end, 0)
+
+    def test_closed_connection(self):
+        requests, replies = self._requests_and_replies([10])
+        self.dispatcher.explicit_message_socket = ChunkedSocket(replies[:30], [30])
+        with self.assertRaises(ConnectionError):
+            self.dispatcher.get_response(requests[0])
+
+    def test_reply_without_sequence_count(self):
+        request = EIPMessage(b'\x70\x00', bytes(20) + b'\x07\x00')
+        reply = EIPMessage(b'\x70\x00', b'', status=b'\x64\x00\x00\x00')
+        self.dispatcher.explicit_message_socket = ChunkedSocket(reply.bytes(), [24])
+        with self.assertRaises(EIPException) as context:
+            self.dispatcher.get_response(request)
+        self.assertEqual(context.exception.status, b'\x64\x00\x00\x00')
+
+
+class TestAsyncResponseReader(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dispatcher = AsyncEIPConnectedCIPDispatcher()
+        self.dispatcher.stream_reader = asyncio.StreamReader()
+        self.future = asyncio.get_running_loop().create_future()
+        self.dispatcher._pending_responses[('sequence_count', 7)] = self.future
+        self.dispatcher._start_response_reader()
+
+    async def asyncTearDown(self):
+        self.dispatcher._reader_task.cancel()
+        await asyncio.gather(self.dispatcher._reader_task, return_exceptions=True)
+
+    async def test_short_unit_data_reply_answers_oldest_request(self):
+        reply = EIPMessage(b'\x70\x00', b'', status=b'\x64\x00\x00\x00')
+        self.dispatcher.stream_reader.feed_data(reply.bytes())
+        with self.assertRaises(EIPException) as context:
+            await asyncio.wait_for(self.future, 1)
+        self.assertEqual(context.exception.status, b'\x64\x00\x00\x00')
+        self.assertFalse(self.dispatcher._reader_task.done())
+
+    async def test_reader_error_fails_pending_requests(self):
+        with patch.object(EIPMessage, 'response_key', side_effect=ValueError('bad reply')):
+            self.dispatcher.stream_reader.feed_data(EIPMessage(b'\x70\x00', bytes(22)).bytes())
+            with self.assertRaises(ConnectionError):
+                await asyncio.wait_for(self.future, 1)
+        with self.assertRaises(ValueError):
+            await self.dispatcher._reader_task
+
+
+class TestAsyncConnectedMessaging(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.target = FakeEIPTarget(batch_size=1)
+        await self.target.start()
+        self.dispatcher = AsyncEIPConnectedCIPDispatcher()
+        self.dispatcher.explicit_message_port = self.target.port
+        await self.dispatcher.connect_explicit('127.0.0.1')
+        await self.dispatcher.register_session()
+
+    async def asyncTearDown(self):
+        await self.dispatcher.close_explicit()
+        await self.target.stop()
+
+    async def test_large_forward_open(self):
+        self.assertEqual(self.dispatcher.maximum_message_length, 502)
+        reply = await self.dispatcher.forward_open()
+        self.assertEqual(reply.o_t_connection_id, self.target.o_t_connection_id)
+        self.assertEqual(self.target.connection_size, 4002)
+        self.assertEqual(self.dispatcher.maximum_message_length, 4000)
+
+    async def test_forward_open_fallback(self):
+        self.target.supports_large_forward_open = False
+        await self.dispatcher.forward_open()
+        self.assertEqual(self.target.connection_size, 504)
+        self.assertEqual(self.dispatcher.maximum_message_length, 502)
+
+    async def test_connected_requests(self):
+        await self.dispatcher.forward_open()
+        self.target.batch_size = 3
+        paths = [address_request_path_segment(b'\x6b', index.to_bytes(2, 'little')) for index in range(6)]
+        replies = await asyncio.gather(*[self.dispatcher.read_tag_service(path) for path in paths])
+        self.assertEqual([reply.reply_data for reply in replies], paths)
+        self.assertEqual(self.target.services[-1], (b'\x70\x00', CIPService.READ_TAG_SERVICE))
+        self.target.batch_size = 1
+
+    async def test_forward_close(self):
+        await self.dispatcher.forward_open()
+        await self.dispatcher.forward_close()
+        self.assertIsNone(self.target.connection_size)
+        self.assertFalse(self.dispatcher.is_connected_class_3)
+        await self.dispatcher.read_tag_service(b'\x20\x6b\x24\x01')
+        self.assertEqual(self.target.services[-1], (b'\x6f\x00', CIPService.READ_TAG_SERVICE))
+
+    async def test_class_1_forward_open(self):
+        tag_set = CIPStructure()
+        tag_set.add_member('count', CIPDoubleInteger())
+        tag_set['count'] = 0
+        consumer = AsyncImplicitConsumer(tag_set, rpi=0.005, port=0)
+        await consumer.start('127.0.0.1')
+        await consumer.open(self.dispatcher, tag_set_connection_path('TagSet1'))
+        self.assertEqual(self.target.services[-1], (b'\x6f\x00', CIPService.FORWARD_OPEN))
+        self.assertEqual(self.target.connection_size, 2)
+        self.assertEqual(consumer.connection_id, self.target.t_o_connection_id)
+        await consumer.close(self.dispatcher)
+        self.assertEqual(self.target.services[-1], (b'\x6f\x00', CIPService.FORWARD_CLOSE))
+
+    async def test_refused_class_1_forward_open_releases_port(self):
+        tag_set = CIPStructure()
+        tag_set.add_member('count', CIPDoubleInteger())
+        tag_set['count'] = 0
+        consumer = AsyncImplicitConsumer(tag_set, rpi=0.005, port=0)
+        with self.assertRaises(CIPException):
+            await consumer.open(RefusingCIPDispatcher(), tag_set_connection_path('TagSet1'))
+        self.assertIsNone(consumer.transport)
+        self.assertIsNone(consumer.forward_open_request)
+        # A consumer that was started by the caller stays started
+        await consumer.start('127.0.0.1')
+        with self.assertRaises(CIPException):
+            await consumer.open(RefusingCIPDispatcher(), tag_set_connection_path('TagSet1'))
+        self.assertIsNotNone(consumer.transport)
+        await consumer.stop()
+
+
+class RefusingCIPDispatcher(AsyncCIPDispatcher):
+    """Refuses every request with a connection failure"""
+
+    async def execute_cip_command(self, request: CIPRequest) -> CIPReply:
+        reply = CIPReply(b'\xd4\x00\x01\x00')
+        raise CIPException(reply.general_status, reply.extended_status, reply)
+
+
+class TestForwardOpenRequest(unittest.TestCase):
+    def test_network_connection_parameters(self):
+        forward_open_request = ForwardOpenRequest(504)
+        self.assertEqual(forward_open_request.network_connection_parameters(504, ForwardOpenRequest.POINT_TO_POINT),
+                         0x43f8)
+        large_forward_open_request = ForwardOpenRequest(4002, large=True)
+        self.assertEqual(
+            large_forward_open_request.network_connection_parameters(4002, ForwardOpenRequest.POINT_TO_POINT),
+            0x42000fa2)
+
+    def test_request_length(self):
+        self.assertEqual(len(ForwardOpenRequest(504).bytes()), 36 + 4)
+        self.assertEqual(len(ForwardOpenRequest(4002, large=True).bytes()), 40 + 4)
+
+
+class TestAsyncImplicitConsumer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tag_set = CIPStructure()
+        tag_set.add_member('count', CIPDoubleInteger())
+        tag_set['count'] = 0
+        tag_set.add_member('level', CIPReal())
+        tag_set['level'] = 0.0
+        self.consumer = AsyncImplicitConsumer(tag_set, rpi=0.001, port=0)
+        await self.consumer.start('127.0.0.1')
+        self.consumer.connection_id = b'\x01\x00\x00\x80'
+        self.updates = 0
+        self.consumer.bind_to_data(self.count_update)
+        loop = asyncio.get_running_loop()
+        # Local UDP producer standing in for the controller
+        self.producer, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, remote_addr=self.consumer.transport.get_extra_info('sockname'))
+
+    async def asyncTearDown(self):
+        self.producer.close()
+        await self.consumer.stop()
+
+    def count_update(self):
+        self.updates += 1
+
+    async def produce(self, *packets):
+        for sequence_number, cip_sequence_count, count, level in packets:
+            self.producer.sendto(implicit_packet_bytes(
+                b'\x01\x00\x00\x80', sequence_number, cip_sequence_count, struct.pack('<lf', count, level)))
+        for _ in range(100):
+            await asyncio.sleep(0.001)
+            if self.consumer.received_packets + self.consumer.stale_packets >= len(packets):
+                break
+
+    async def test_packet_is_decoded_into_structure(self):
+        await self.produce((1, 1, 42, 1.5))
+        self.assertEqual(self.consumer.value()['count'].value(), 42)
+        self.assertEqual(self.consumer.value()['level'].value(), 1.5)
+        self.assertEqual(self.updates, 1)
+
+    async def test_sequence_gap_detection(self):
+        await self.produce((1, 1, 1, 0.0), (2, 2, 2, 0.0), (5, 3, 5, 0.0), (4, 4, 4, 0.0))
+        self.assertEqual(self.consumer.received_packets, 3)
+        self.assertEqual(self.consumer.missed_packets, 2)
+        self.assertEqual(self.consumer.stale_packets, 1)
+        self.assertEqual(self.consumer.value()['count'].value(), 5)
+
+    async def test_unchanged_data_is_not_reported(self):
+        await self.produce((1, 7, 3, 0.0), (2, 7, 3, 0.0))
+        self.assertEqual(self.consumer.received_packets, 2)
+        self.assertEqual(self.updates, 1)
+
+    async def test_other_connections_are_ignored(self):
+        self.producer.sendto(implicit_packet_bytes(b'\x02\x00\x00\x80', 1, 1, struct.pack('<lf', 9, 0.0)))
+        await self.produce((1, 1, 42, 0.0))
+        self.assertEqual(self.consumer.value()['count'].value(), 42)
+        self.assertEqual(self.updates, 1)
+
+    def test_packet_parsing(self):
+        packet = ImplicitDataPacket(implicit_packet_bytes(b'\x01\x02\x03\x04', 0x10000, 3, b'\xaa\xbb'))
+        self.assertEqual(packet.connection_id, b'\x01\x02\x03\x04')
+        self.assertEqual(packet.sequence_number, 0x10000)
+        self.assertEqual(packet.cip_sequence_count, 3)
+        self.assertEqual(packet.data, b'\xaa\xbb')
+
+
+
+class TestEIPSessionPool(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.target = FakeEIPTarget(batch_size=1)
+        await self.target.start()
+
+    async def asyncTearDown(self):
+        await self.pool.close_explicit()
+        await self.target.stop()
+
+    async def connect_pool(self, sessions: int, priority_session: bool = True):
+        self.pool = EIPSessionPool(sessions, priority_session)
+        self.pool.explicit_message_port = self.target.port
+        self.pool.RECONNECT_DELAY = 0.01
+        await self.pool.connect_explicit('127.0.0.1')
+        await self.pool.register_session()
+
+    async def wait_for_outstanding(self, total: int):
+        for _ in range(100):
+            if sum(self.pool.outstanding_requests(member) for member in self.pool.all_members) >= total:
+                break
+            await asyncio.sleep(0.001)
+
+    async def test_at_least_one_session(self):
+        await self.connect_pool(1, priority_session=False)
+        self.assertEqual(len(self.pool.all_members), 1)
+        with self.assertRaises(ValueError):
+            EIPSessionPool(0)
+
+    async def test_sessions_share_dictionaries(self):
+        await self.connect_pool(3)
+        self.assertEqual(len(self.pool.all_members), 4)
+        for member in self.pool.all_members:
+            self.assertTrue(member.has_session_handle)
+            self.assertIs(member.variables, self.pool.variables)
+            self.assertIs(member.data_type_dictionary, self.pool.data_type_dictionary)
+
+    async def test_least_outstanding_requests(self):
+        await self.connect_pool(3)
+        self.target.batch_size = 6
+        tasks = [asyncio.create_task(self.pool.read_tag_service(b'\x20\x6b\x24\x01')) for _ in range(6)]
+        await self.wait_for_outstanding(6)
+        self.assertEqual([self.pool.outstanding_requests(member) for member in self.pool.members], [2, 2, 2])
+        self.assertEqual(self.pool.outstanding_requests(self.pool.priority_member), 0)
+        await self.pool.close_explicit()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def test_priority_session(self):
+        await self.connect_pool(2)
+        self.target.batch_size = 3
+        tasks = [asyncio.create_task(self.pool.read_tag_service(b'\x20\x6b\x24\x01')) for _ in range(2)]
+        await self.wait_for_outstanding(2)
+        self.target.batch_size = 1
+        async with self.pool.priority():
+            reply = await self.pool.read_tag_service(b'\x20\x6b\x24\x02')
+        self.assertEqual(reply.reply_data, b'\x20\x6b\x24\x02')
+        self.assertFalse(any(task.done() for task in tasks))
+        await self.pool.close_explicit()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def test_member_reconnects(self):
+        await self.connect_pool(1, priority_session=False)
+        member = self.pool.members[0]
+        member.stream_writer.transport.abort()
+        with self.assertRaises(ConnectionError):
+            await self.pool.read_tag_service(b'\x20\x6b\x24\x01')
+        await asyncio.gather(*self.pool._reconnect_tasks.values())
+        reply = await self.pool.read_tag_service(b'\x20\x6b\x24\x01')
+        self.assertEqual(reply.reply_data, b'\x20\x6b\x24\x01')
+
+
+def identity_item_bytes(serial_number: int, product_name: bytes, ip_address: str = '0.0.0.0') -> bytes:
+    """Build the CIP Identity item of a ListIdentity reply"""
+    item_data = struct.pack('<H', 1) + struct.pack('>HH4s8x', 2, 44818, socket.inet_aton(ip_address)) + \
+        struct.pack('<HHHBBHLB', 47, 12, 1618, 1, 40, 0x0030, serial_number, len(product_name)) + \
+        product_name + b'\x03'
+    return b'\x0c\x00' + struct.pack('<H', len(item_data)) + item_data
+
+
+class ListIdentityResponder(asyncio.DatagramProtocol):
+    """Replies to ListIdentity like an Ethernet/IP device"""
+
+    def __init__(self, serial_number: int):
+        self.serial_number = serial_number
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        request = EIPMessage()
+        request.from_bytes(data)
+        reply = EIPMessage(b'\x63\x00', b'\x01\x00' + identity_item_bytes(self.serial_number, b'NX102-9000'),
+                           sender_context_data=request.sender_context_data)
+        self.transport.sendto(reply.bytes(), addr)
+
+
+class TestEIPDiscovery(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        loop = asyncio.get_running_loop()
+        self.responder, _ = await loop.create_datagram_endpoint(
+            lambda: ListIdentityResponder(0x12345678), local_addr=('127.0.0.1', 0))
+        self.discovery = EIPDiscovery(self.responder.get_extra_info('sockname')[1])
+
+    async def asyncTearDown(self):
+        self.responder.close()
+
+    def test_identity_record(self):
+        item = identity_item_bytes(0x01020304, b'NX1P2-9024DT', '192.168.250.1')
+        record = IdentityRecord.from_list_identity_reply(b'\x01\x00' + item)[0]
+        self.assertEqual(record.vendor_id, 47)
+        self.assertEqual(record.device_type, 12)
+        self.assertEqual(record.product_code, 1618)
+        self.assertEqual(record.revision, '1.40')
+        self.assertEqual(record.status, 0x0030)
+        self.assertEqual(record.serial_number, 0x01020304)
+        self.assertEqual(record.product_name, 'NX1P2-9024DT')
+        self.assertEqual(record.state, 3)
+        self.assertEqual(record.ip_address, '192.168.250.1')
+        self.assertEqual(record.port, 44818)
+
+    async def test_broadcast_list_identity(self):
+        records = await self.discovery.broadcast_list_identity('127.0.0.1', timeout=0.1, local_address='127.0.0.1')
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].serial_number, 0x12345678)
+        self.assertEqual(records[0].ip_address, '127.0.0.1')
+
+    async def test_sweep_list_identity(self):
+        records = await self.discovery.sweep_list_identity('127.0.0.0/29', timeout=0.1, maximum_concurrent_probes=2,
+                                                           local_address='127.0.0.1')
+        self.assertEqual([record.ip_address for record in records], ['127.0.0.1'])
+
+
+class TestEIPRequestTemplate(unittest.TestCase):
+    def setUp(self):
+        self.request = CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x04Test', b'\x01\x00')
+
+    def test_send_rr_data_frame(self):
+        template = EIPRequestTemplate(EIPRequestTemplate.SEND_RR_DATA, b'\x01\x02\x03\x04')
+        frame = template.request(self.request.bytes)
+        frame.set_context(7)
+        command_specific_data = ConnectedMessagingMixin._unconnected_command_specific_data(self.request)
+        eip_message = EIPMessage(b'\x6f\x00', command_specific_data, b'\x01\x02\x03\x04')
+        eip_message.set_context(7)
+        self.assertEqual(frame.bytes(), eip_message.bytes())
+        self.assertEqual(frame.response_key(), eip_message.response_key())
+
+    def test_send_unit_data_frame(self):
+        template = EIPRequestTemplate(EIPRequestTemplate.SEND_UNIT_DATA, b'\x01\x02\x03\x04', b'\x11\x22\x33\x44')
+        frame = template.request(self.request.bytes, 0x0102)
+        packets = [DataAndAddressItem(DataAndAddressItem.CONNECTED_ADDRESS_ITEM, b'\x11\x22\x33\x44'),
+                   DataAndAddressItem(DataAndAddressItem.CONNECTED_TRANSPORT_PACKET,
+                                      b'\x02\x01' + self.request.bytes)]
+        command_specific_data = CommandSpecificData(timeout=b'\x00\x00',
+                                                    encapsulated_packet=CommonPacketFormat(packets).bytes())
+        eip_message = EIPMessage(b'\x70\x00', command_specific_data.bytes(), b'\x01\x02\x03\x04')
+        self.assertEqual(frame.bytes(), eip_message.bytes())
+        self.assertEqual(frame.response_key(), ('sequence_count', 0x0102))
+
+    def test_templates_are_cached_per_session(self):
+        dispatcher = EIPConnectedCIPDispatcher()
+        dispatcher.session_handle_id = b'\x01\x00\x00\x00'
+        template = dispatcher._request_template(EIPRequestTemplate.SEND_RR_DATA)
+        self.assertIs(dispatcher._request_template(EIPRequestTemplate.SEND_RR_DATA), template)
+        dispatcher.session_handle_id = b'\x02\x00\x00\x00'
+        self.assertIsNot(dispatcher._request_template(EIPRequestTemplate.SEND_RR_DATA), template)
+
+
+class TestMultipleServicePacket(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.target = FakeEIPTarget(batch_size=1)
+        await self.target.start()
+        self.dispatcher = AsyncEIPConnectedCIPDispatcher()
+        self.dispatcher.explicit_message_port = self.target.port
+        await self.dispatcher.connect_explicit('127.0.0.1')
+        await self.dispatcher.register_session()
+
+    async def asyncTearDown(self):
+        await self.dispatcher.close_explicit()
+        await self.target.stop()
+
+    def multiple_service_packets_sent(self) -> int:
+        return len([service for service in self.target.services if service[1] == CIPService.MULTIPLE_SERVICE_PACKET])
+
+    async def test_read_tags(self):
+        paths = [variable_request_path_segment(f'Tag{index}') for index in range(300)]
+        replies = await self.dispatcher.read_tags(paths)
+        self.assertEqual([reply.reply_data for reply in replies], paths)
+        self.assertLessEqual(self.multiple_service_packets_sent(), 30)
+
+    async def test_per_item_status(self):
+        paths = [variable_request_path_segment(name) for name in ('Tag1', 'BadTag', 'Tag3')]
+        replies = await self.dispatcher.read_tags(paths)
+        self.assertEqual([reply.general_status for reply in replies], [b'\x00', b'\x04', b'\x00'])
+        self.assertEqual(replies[2].reply_data, paths[2])
+        self.assertEqual(self.multiple_service_packets_sent(), 1)
+
+    async def test_packet_is_split_when_reply_is_too_large(self):
+        self.target.maximum_reply_length = 120
+        paths = [variable_request_path_segment(f'Tag{index}') for index in range(20)]
+        replies = await self.dispatcher.read_tags(paths)
+        self.assertEqual([reply.reply_data for reply in replies], paths)
+
+    async def test_unsupported_packet_is_sent_as_single_requests(self):
+        self.target.multiple_service_status = b'\x08'
+        paths = [variable_request_path_segment(f'Tag{index}') for index in range(8)]
+        replies = await self.dispatcher.read_tags(paths)
+        self.assertEqual([reply.reply_data for reply in replies], paths)
+        self.assertEqual(self.multiple_service_packets_sent(), 1)
+        self.assertEqual(len(self.target.services), 9)
+
+    async def test_other_packet_errors_are_raised(self):
+        self.target.multiple_service_status = b'\x01'
+        paths = [variable_request_path_segment(f'Tag{index}') for index in range(8)]
+        with self.assertRaises(CIPException) as context:
+            await self.dispatcher.read_tags(paths)
+        self.assertEqual(context.exception.status, b'\x01')
+        self.assertEqual(len(self.target.services), 1)
+
+    async def test_reply_lengths_limit_packets(self):
+        paths = [variable_request_path_segment(f'Tag{index}') for index in range(20)]
+        await self.dispatcher.read_tags(paths, reply_lengths=[100] * 20)
+        self.assertEqual(self.multiple_service_packets_sent(), 5)
+
+    async def test_write_tags(self):
+        paths = [variable_request_path_segment(f'Tag{index}') for index in range(10)]
+        data = [CIPCommonFormat(b'\xc3', data=index.to_bytes(2, 'little')) for index in range(10)]
+        replies = await self.dispatcher.write_tags(paths, data)
+        self.assertTrue(all(reply.general_status == b'\x00' for reply in replies))
+        self.assertEqual(self.multiple_service_packets_sent(), 1)
+
+    def test_request_format(self):
+        requests = [CIPRequest(CIPService.READ_TAG_SERVICE, b'\x20\x6b\x24\x01', b'\x01\x00'),
+                    CIPRequest(CIPService.GET_ATTRIBUTE_ALL, b'\x20\x01\x24\x01')]
+        cip_request = MultipleServicePacket(requests).cip_request()
+        self.assertEqual(cip_request.bytes,
+                         b'\x0a\x02\x20\x02\x24\x01\x02\x00\x06\x00\x0e\x00' +
+                         b'\x4c\x02\x20\x6b\x24\x01\x01\x00\x01\x02\x20\x01\x24\x01')
+
+
+class TestAsyncReadTagCoalescer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.target = FakeEIPTarget(batch_size=1)
+        await self.target.start()
+        self.dispatcher = AsyncEIPConnectedCIPDispatcher()
+        self.dispatcher.explicit_message_port = self.target.port
+        await self.dispatcher.connect_explicit('127.0.0.1')
+        await self.dispatcher.register_session()
+        self.coalescer = AsyncReadTagCoalescer(self.dispatcher, window=0.005)
+
+    async def asyncTearDown(self):
+        await self.dispatcher.close_explicit()
+        await self.target.stop()
+
+    def multiple_service_packets_sent(self) -> int:
+        return len([service for service in self.target.services if service[1] == CIPService.MULTIPLE_SERVICE_PACKET])
+
+    async def test_concurrent_reads_share_a_packet(self):
+        paths = [variable_request_path_segment(f'Tag{index}') for index in range(20)]
+        replies = await asyncio.gather(*[self.coalescer.read_tag_service(path) for path in paths])
+        self.assertEqual([reply.reply_data for reply in replies], paths)
+        self.assertEqual(len(self.target.services), 1)
+        self.assertEqual(self.multiple_service_packets_sent(), 1)
+
+    async def test_identical_reads_share_a_request(self):
+        path = variable_request_path_segment('Tag1')
+        replies = await asyncio.gather(*[self.coalescer.read_tag_service(path) for _ in range(5)])
+        self.assertTrue(all(reply is replies[0] for reply in replies))
+        self.assertEqual(self.target.services, [(b'\x6f\x00', CIPService.READ_TAG_SERVICE)])
+
+    async def test_size_budget_sends_early(self):
+        paths = [variable_request_path_segment(f'Line1.Station{index}.Counter') for index in range(40)]
+        replies = await asyncio.gather(*[self.coalescer.read_tag_service(path) for path in paths])
+        self.assertEqual([reply.reply_data for reply in replies], paths)
+        self.assertGreater(self.multiple_service_packets_sent(), 1)
+
+    async def test_reply_budget_sends_early(self):
+        paths = [variable_request_path_segment(f'Tag{index}') for index in range(20)]
+        replies = await asyncio.gather(*[self.coalescer.read_tag_service(path, reply_length=100) for path in paths])
+        self.assertEqual([reply.reply_data for reply in replies], paths)
+        # Four 100 byte replies fit in a 502 byte message
+        self.assertEqual(self.multiple_service_packets_sent(), 5)
+
+    async def test_failed_read_raises(self):
+        good_path = variable_request_path_segment('Tag1')
+        results = await asyncio.gather(self.coalescer.read_tag_service(good_path),
+                                       self.coalescer.read_tag_service(variable_request_path_segment('BadTag')),
+                                       return_exceptions=True)
+        self.assertEqual(results[0].reply_data, good_path)
+        self.assertIsInstance(results[1], CIPException)
+        self.assertEqual(results[1].status, b'\x04')
+
+
+class TestRequestPaths(unittest.TestCase):
+    def test_request_path(self):
+        self.assertEqual(variable_request_path_segment('Line1.Counts[3]'),
+                         b'\x91\x05Line1\x00\x91\x06Counts\x2a\x00\x03\x00\x00\x00')
+
+    def test_request_paths_are_cached(self):
+        variable_request_path_segment('CachedVariable')
+        hits = variable_request_path_segment.cache_info().hits
+        self.assertIs(variable_request_path_segment('CachedVariable'), variable_request_path_segment('CachedVariable'))
+        self.assertEqual(variable_request_path_segment.cache_info().hits, hits + 2)
+
+    def test_simple_data_segment(self):
+        self.assertEqual(SimpleDataSegmentRequest(0x010203, 400).bytes(), b'\x80\x03\x03\x02\x01\x00\x90\x01')
+        self.assertEqual(SimpleDataSegmentRequest.request_path('Tag', 0x010203, 400),
+                         b'\x91\x03Tag\x00\x80\x03\x03\x02\x01\x00\x90\x01')
+
+
+class TestSymbolInstanceAddressing(unittest.TestCase):
+    @staticmethod
+    def instance(name: str, instance_id: int) -> InstanceIDAttributes:
+        data = b'\x6b\x00' + struct.pack('<LB', instance_id, len(name)) + name.encode('utf-8')
+        return InstanceIDAttributes(struct.pack('<H', len(data)) + data)
+
+    def setUp(self):
+        self.n_series = AsyncNSeries()
+        self.n_series.instances = [self.instance('Line1', 0x12), self.instance('Counter', 0x1234),
+                                   self.instance('Recipe', 0x123456)]
+        self.n_series._update_instance_ids()
+
+    def test_instance_segments(self):
+        self.assertEqual(symbol_instance_request_path_segment(0x12), b'\x20\x6b\x24\x12')
+        self.assertEqual(symbol_instance_request_path_segment(0x1234), b'\x20\x6b\x25\x00\x34\x12')
+        self.assertEqual(symbol_instance_request_path_segment(0x123456), b'\x20\x6b\x26\x00\x56\x34\x12\x00')
+
+    def test_symbolic_until_enabled(self):
+        self.assertEqual(self.n_series._request_path('Counter'), variable_request_path_segment('Counter'))
+
+    def test_member_and_element_segments(self):
+        self.n_series.instance_addressing = True
+        self.assertEqual(self.n_series._request_path('Line1.Station4.Axis[3]'),
+                         b'\x20\x6b\x24\x12' + variable_request_path_segment('Station4.Axis[3]'))
+        self.assertEqual(self.n_series._request_path('Counter[7]'),
+                         b'\x20\x6b\x25\x00\x34\x12\x2a\x00\x07\x00\x00\x00')
+        self.assertLess(len(self.n_series._request_path('Line1.Status')),
+                        len(variable_request_path_segment('Line1.Status')))
+
+    def test_unknown_variable_is_symbolic(self):
+        self.n_series.instance_addressing = True
+        self.assertEqual(self.n_series._request_path('Line10.Status'), variable_request_path_segment('Line10.Status'))
+
+
+class TestCIPCRC16(unittest.TestCase):
+    def test_check_value(self):
+        self.assertEqual(cip_crc16(b'123456789'), b'\x3d\xbb')
+        self.assertEqual(cip_crc16(b''), b'\x00\x00')
+
+    def test_incremental(self):
+        crc = CIPCRC16()
+        for chunk in (b'1', b'2345', b'', b'6789'):
+            crc.update(chunk)
+        self.assertEqual(crc.digest(), cip_crc16(b'123456789'))
+
+
+class TestCIPReply(unittest.TestCase):
+    def test_fields(self):
+        reply_bytes = b'\xcc\x00\x01\x01\x05\x01\x11\x22'
+        reply = CIPReply(memoryview(b'\x00\x00' + reply_bytes)[2:])
+        self.assertEqual((reply.reply_service, reply.reserved, reply.general_status, reply.extended_status_size),
+                         (b'\xcc', b'\x00', b'\x01', b'\x01'))
+        self.assertEqual(reply.extended_status, b'\x05\x01')
+        self.assertEqual(reply.reply_data, b'\x11\x22')
+        self.assertIsInstance(reply.reply_data, bytes)
+        self.assertEqual(reply.bytes, reply_bytes)
+
+    def test_bytes_is_original_buffer(self):
+        reply_bytes = b'\xcc\x00\x00\x00\x01\x02'
+        self.assertIs(CIPReply(reply_bytes).bytes, reply_bytes)
+
+    def test_pickle(self):
+        reply = VariableObjectReply(memoryview(b'\xc1\x00\x00\x00' + struct.pack('<LccB', 4, b'\xc4', b'\x00', 0)))
+        unpickled = pickle.loads(pickle.dumps(reply))
+        self.assertIsInstance(unpickled, VariableObjectReply)
+        self.assertEqual((unpickled.size, unpickled.cip_data_type, unpickled.array_dimension), (4, b'\xc4', 0))
+
+
+class RecordingCIPDispatcher(AsyncCIPDispatcher):
+    """Keeps every request and answers it with reply_data"""
+
+    def __init__(self, reply_data: bytes = b''):
+        super().__init__()
+        self.requests = []
+        self.reply_data = reply_data
+
+    async def execute_cip_command(self, request: CIPRequest) -> CIPReply:
+        self.requests.append(request)
+        return CIPReply(bytes([request.request_service[0] | 0x80]) + b'\x00\x00\x00' + self.reply_data)
+
+
+class TestReadModifyWriteTag(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.n_series = AsyncNSeries()
+        self.dispatcher = RecordingCIPDispatcher(b'\xd2\x00\x08\x00')
+        self.dispatcher.variables['Control'] = CIPWord()
+        self.n_series.connected_cip_dispatcher = self.dispatcher
+
+    def test_request_format(self):
+        request = read_modify_write_tag_request(b'\x91\x03Tag\x00', b'\x04\x00', b'\xff\xff')
+        self.assertEqual(request.bytes, b'\x4e\x03\x91\x03Tag\x00\x02\x00\x04\x00\xff\xff')
+        with self.assertRaises(ValueError):
+            read_modify_write_tag_request(b'\x91\x03Tag\x00', b'\x04', b'\xff\xff')
+
+    async def test_set_and_clear_bit(self):
+        await self.n_series.set_bit('Control', 9)
+        await self.n_series.clear_bit('Control', 0)
+        self.assertEqual([request.request_data for request in self.dispatcher.requests],
+                         [b'\x02\x00\x00\x02\xff\xff', b'\x02\x00\x00\x00\xfe\xff'])
+        self.assertEqual(len(self.dispatcher.requests), 2)
+
+    async def test_toggle_bit(self):
+        await self.n_series.toggle_bit('Control', 3)
+        await self.n_series.toggle_bit('Control', 4)
+        self.assertEqual([request.request_data for request in self.dispatcher.requests[1::2]],
+                         [b'\x02\x00\x00\x00\xf7\xff', b'\x02\x00\x10\x00\xff\xff'])
+
+
+class SimpleDataSegmentTarget(AsyncCIPDispatcher):
+    """Variable memory read and written with simple data segments, counting the requests in flight"""
+    maximum_message_length = 502
+
+    def __init__(self, memory: bytearray):
+        super().__init__()
+        self.memory = memory
+        self.in_flight = 0
+        self.maximum_in_flight = 0
+        self.segments = []
+        self.request_lengths = []
+
+    async def execute_cip_command(self, request: CIPRequest) -> CIPReply:
+        offset, size = struct.unpack('<LH', request.request_path[-6:])
+        self.segments.append((offset, size))
+        self.request_lengths.append(len(request.bytes))
+        self.in_flight += 1
+        self.maximum_in_flight = max(self.maximum_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        if request.request_service == CIPService.READ_TAG_SERVICE:
+            return CIPReply(b'\xcc\x00\x00\x00\xc3\x00' + bytes(self.memory[offset:offset + size]))
+        self.memory[offset:offset + size] = request.request_data[-size:]
+        return CIPReply(b'\xcd\x00\x00\x00')
+
+
+class TestPipelinedSegments(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.n_series = AsyncNSeries()
+        self.n_series.pipeline_window = 4
+        self.memory = bytearray(struct.pack('<2000H', *range(2000)))
+        self.target = SimpleDataSegmentTarget(self.memory)
+        self.n_series.connected_cip_dispatcher = self.target
+        self.array = CIPArray()
+        self.array.from_items(b'\xc3', 2, 1, [2000], [0])
+        self.array.variable_name = 'Recipe'
+
+    async def test_read(self):
+        await self.n_series._multi_message_variable_read(self.array)
+        self.assertEqual(self.array.data, bytes(self.memory))
+        self.assertEqual(len(self.target.segments), 9)
+        self.assertEqual(self.target.maximum_in_flight, 4)
+
+    async def test_write(self):
+        self.array.data = bytes(reversed(self.memory))
+        await self.n_series._multi_message_variable_write(self.array)
+        self.assertEqual(bytes(self.memory), self.array.data)
+        self.assertEqual(sum(size for _, size in self.target.segments), 4000)
+        self.assertEqual(self.target.maximum_in_flight, 4)
+
+    async def write_at_limit(self, maximum_message_length: int):
+        self.target.maximum_message_length = maximum_message_length
+        # Service, path size, the 8 byte symbolic path of Recipe, the simple data segment, then the data type,
+        # additional info length and number of elements of the Write Tag data
+        limit = maximum_message_length - 22
+        for size, segments in ((limit, 1), (limit + 2, 2)):
+            self.target.segments = []
+            self.target.request_lengths = []
+            cip_array = CIPArray()
+            cip_array.from_items(b'\xc7', 2, 1, [size // 2], [0])
+            cip_array.variable_name = 'Recipe'
+            cip_array.data = bytes(reversed(self.memory[:size]))
+            await self.n_series._multi_message_variable_write(cip_array)
+            self.assertEqual(len(self.target.segments), segments)
+            self.assertEqual(max(self.target.request_lengths), maximum_message_length)
+
+    async def test_write_at_unconnected_limit(self):
+        await self.write_at_limit(502)
+
+    async def test_write_at_connected_limit(self):
+        await self.write_at_limit(4000)
+
+
+class ArrayVariableTarget(SimpleDataSegmentTarget):
+    """A one dimensional UINT array variable answering Get Attribute All and simple data segment reads"""
+
+    async def execute_cip_command(self, request: CIPRequest) -> CIPReply:
+        if request.request_service == CIPService.GET_ATTRIBUTE_ALL:
+            number_of_elements = len(self.memory) // 2
+            reply_data = struct.pack('<L4sL8xB3xLL', 2, b'\xa3\xc7\x01\x00', number_of_elements, 0, 0, 0)
+            return CIPReply(b'\x81\x00\x00\x00' + reply_data)
+        return await super().execute_cip_command(request)
+
+
+class TestArrayOptions(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.memory = bytearray(struct.pack('<300H', *range(300)))
+        self.target = ArrayVariableTarget(self.memory)
+        update_data_type_dictionary(self.target.data_type_dictionary)
+
+    def n_series(self, **kwargs) -> AsyncNSeries:
+        n_series = AsyncNSeries(**kwargs)
+        n_series.connected_cip_dispatcher = self.target
+        return n_series
+
+    async def test_list_arrays_by_default(self):
+        cip_array = await self.n_series().read_variable('Recipe')
+        self.assertFalse(cip_array.use_numpy)
+        self.assertEqual(cip_array.value(), list(range(300)))
+
+    async def test_lazy_arrays(self):
+        cip_array = await self.n_series(lazy_arrays=True, element_cache_size=8).read_variable('Recipe')
+        self.assertTrue(cip_array.lazy)
+        self.assertEqual(cip_array.element_cache_size, 8)
+        self.assertIs(cip_array.value(), cip_array)
+        self.assertEqual(cip_array[299], 299)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    async def test_numpy_arrays(self):
+        cip_array = await self.n_series(use_numpy=True).read_variable('Recipe')
+        self.assertTrue(cip_array.use_numpy)
+        self.assertIsInstance(cip_array.value(), numpy.ndarray)
+        self.assertEqual(cip_array.value().tolist(), list(range(300)))
+
+
+class TestPartialStructureWrites(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.n_series = AsyncNSeries()
+        self.structure = CIPStructure()
+        values = CIPArray(lazy=True)
+        values.from_items(b'\xc3', 2, 1, [1000], [0])
+        self.structure.add_member('Values', values)
+        self.structure.add_member('Count', CIPDoubleInteger())
+        self.structure.add_member('Speed', CIPReal())
+        self.structure.crc_code = b'\x01\x02'
+        self.structure.from_value(self.structure)
+        self.structure.size = len(self.structure.data)
+        self.structure.variable_name = 'MachineState'
+        # As if the structure was read
+        self.structure.clear_dirty_ranges()
+        self.memory = bytearray(self.structure.size)
+        self.target = SimpleDataSegmentTarget(self.memory)
+        self.n_series.connected_cip_dispatcher = self.target
+
+    async def test_only_changed_members_are_written(self):
+        self.structure['Count'] = 7
+        self.structure['Speed'] = 1.5
+        # Changed by the controller after the structure was read
+        self.memory[0:2] = b'\x05\x00'
+        await self.n_series._multi_message_variable_write(self.structure)
+        self.assertEqual(self.target.segments, [(2000, 8)])
+        self.assertEqual(bytes(self.memory[2000:2008]), struct.pack('<lf', 7, 1.5))
+        self.assertEqual(self.memory[0:2], b'\x05\x00')
+        self.assertEqual(self.structure.dirty_ranges(), [])
+
+    async def test_members_changed_without_setitem_are_written(self):
+        self.structure['Count'] = 7
+        self.structure['Speed'].from_value(2.0)
+        self.structure.from_value(self.structure)
+        await self.n_series._multi_message_variable_write(self.structure)
+        self.assertEqual(self.target.segments, [(2000, 8)])
+        self.assertEqual(bytes(self.memory[2000:2008]), struct.pack('<lf', 7, 2.0))
+        self.structure['Values'][10] = 3
+        self.structure.from_value(self.structure)
+        self.assertEqual(self.structure.write_ranges(), [(0, 2000)])
+
+    async def test_structure_never_read_is_written_whole(self):
+        self.structure._synchronized_data = None
+        self.structure['Count'] = 7
+        await self.n_series._multi_message_variable_write(self.structure)
+        self.assertEqual(sum(size for _, size in self.target.segments), self.structure.size)
+
+    async def test_unchanged_structure_is_written_whole(self):
+        await self.n_series._multi_message_variable_write(self.structure)
+        self.assertEqual(sum(size for _, size in self.target.segments), self.structure.size)
+
+
+class AttributeTarget(AsyncCIPDispatcher):
+    """Answers Get Attribute List, Get Attribute Single and Multiple Service Packet requests from attributes"""
+
+    def __init__(self, attributes: dict, supports_get_attribute_list: bool = True):
+        super().__init__()
+        self.attributes = attributes
+        self.supports_get_attribute_list = supports_get_attribute_list
+        self.services = []
+
+    def _reply(self, request_bytes: bytes) -> CIPReply:
+        service = request_bytes[0:1]
+        request_path = request_bytes[2:2 + request_bytes[1] * 2]
+        request_data = request_bytes[2 + request_bytes[1] * 2:]
+        class_id, instance_id = request_path[1], request_path[3]
+        if service == CIPService.MULTIPLE_SERVICE_PACKET:
+            number_of_services = struct.unpack_from('<H', request_data, 0)[0]
+            offsets = list(struct.unpack_from('<%dH' % number_of_services, request_data, 2)) + [len(request_data)]
+            replies = [self._reply(request_data[offsets[index]:offsets[index + 1]]).bytes
+                       for index in range(number_of_services)]
+            reply_offsets = [2 + 2 * number_of_services + sum(len(reply) for reply in replies[:index])
+                             for index in range(number_of_services)]
+            return CIPReply(b'\x8a\x00\x00\x00' + struct.pack('<%dH' % (number_of_services + 1), number_of_services,
+                                                               *reply_offsets) + b''.join(replies))
+        if service == CIPService.GET_ATTRIBUTE_SINGLE:
+            value = self.attributes.get((class_id, instance_id, request_path[5]))
+            if value is None:
+                return CIPReply(b'\x8e\x00\x14\x00')
+            return CIPReply(b'\x8e\x00\x00\x00' + value)
+        if service == CIPService.GET_ATTRIBUTE_LIST and self.supports_get_attribute_list:
+            attribute_ids = struct.unpack_from('<%dH' % request_data[0], request_data, 2)
+            reply_data = struct.pack('<H', len(attribute_ids))
+            general_status = b'\x00'
+            for attribute_id in attribute_ids:
+                value = self.attributes.get((class_id, instance_id, attribute_id))
+                if value is None:
+                    general_status = b'\x0a'
+                    reply_data += struct.pack('<HH', attribute_id, 0x14)
+                else:
+                    reply_data += struct.pack('<HH', attribute_id, 0) + value
+            return CIPReply(b'\x83\x00' + general_status + b'\x00' + reply_data)
+        return CIPReply(bytes([service[0] | 0x80]) + b'\x00\x08\x00')
+
+    async def execute_cip_command(self, request: CIPRequest) -> CIPReply:
+        self.services.append(request.request_service)
+        reply = self._reply(request.bytes)
+        if reply.general_status != b'\x00':
+            raise CIPException(reply.general_status, reply.extended_status, reply)
+        return reply
+
+
+class TestGetAttributeList(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.attributes = {
+            (0xf5, 0, 1): struct.pack('<H', 4),
+            (0xf5, 1, 1): struct.pack('<L', 2),
+            (0xf5, 1, 2): struct.pack('<L', 0x94),
+            (0xf5, 1, 3): struct.pack('<L', 0),
+            (0xf5, 1, 4): struct.pack('<H', 2) + b'\x20\xf6\x24\x01',
+            (0xf5, 1, 5): struct.pack('<5L', 0xc0a8fa01, 0xffffff00, 0xc0a8fafe, 0, 0) + b'\x00\x00',
+            (0xf5, 1, 6): struct.pack('<L', 0),
+            (0xf5, 1, 13): struct.pack('<L', 120)}
+
+    async def test_one_request_per_instance(self):
+        target = AttributeTarget(self.attributes)
+        tcp_interface = TCPInterfaceObject(target)
+        await tcp_interface.get_attribute_list()
+        self.assertEqual(target.services, [CIPService.GET_ATTRIBUTE_LIST, CIPService.GET_ATTRIBUTE_LIST])
+        self.assertEqual(tcp_interface.revision.data_type.value(), 4)
+        self.assertEqual(tcp_interface.encapsulation_inactivity_timeout.data_type.data, struct.pack('<L', 120))
+        self.assertEqual(tcp_interface.interface_configuration.data_type['Subnet Mask'].value(), 0xffffff00)
+        self.assertEqual(tcp_interface.physical_link_object.data_type['Path2'].value(), b'\xf6')
+        self.assertEqual({cip_attribute.status for cip_attribute in tcp_interface.cip_attributes()}, {b'\x00'})
+
+    async def test_attribute_list_error(self):
+        del self.attributes[(0xf5, 1, 6)]
+        tcp_interface = TCPInterfaceObject(AttributeTarget(self.attributes))
+        await tcp_interface.get_attribute_list([tcp_interface.host_name,
+                                                tcp_interface.encapsulation_inactivity_timeout])
+        self.assertEqual(tcp_interface.host_name.status, b'\x14')
+        self.assertEqual(tcp_interface.encapsulation_inactivity_timeout.status, b'\x00')
+        self.assertEqual(tcp_interface.encapsulation_inactivity_timeout.data_type.data, struct.pack('<L', 120))
+
+    async def test_multiple_service_packet_fallback(self):
+        target = AttributeTarget(self.attributes, supports_get_attribute_list=False)
+        tcp_interface = TCPInterfaceObject(target)
+        await tcp_interface.get_attribute_list([tcp_interface.configuration_capability,
+                                                tcp_interface.interface_configuration])
+        self.assertEqual(target.services, [CIPService.GET_ATTRIBUTE_LIST, CIPService.MULTIPLE_SERVICE_PACKET])
+        self.assertEqual(tcp_interface.configuration_capability.data_type.data, struct.pack('<L', 0x94))
+        self.assertEqual(tcp_interface.interface_configuration.data_type['IP Address'].value(), 0xc0a8fa01)
+
+    async def test_device_sweep(self):
+        self.attributes.update({
+            (0x01, 1, 1): struct.pack('<H', 47),
+            (0x01, 1, 2): struct.pack('<H', 0x0c),
+            (0x01, 1, 3): struct.pack('<H', 1618),
+            (0x01, 1, 4): struct.pack('<BB', 1, 40),
+            (0x01, 1, 5): struct.pack('<H', 0x0030),
+            (0x01, 1, 6): struct.pack('<L', 0x12345678),
+            (0xf6, 1, 1): struct.pack('<L', 1000),
+            (0xf6, 1, 2): struct.pack('<L', 0x0f),
+            (0xf6, 1, 3): b'\x00\x00\x0a\x01\x02\x03'})
+        target = AttributeTarget(self.attributes)
+        identity = IdentityObject(target)
+        ethernet_link = EthernetLinkObject(target)
+        tcp_interface = TCPInterfaceObject(target)
+        for cip_object in (identity, ethernet_link, tcp_interface):
+            await cip_object.get_attribute_list()
+        self.assertEqual(identity.product_code.data_type.value(), 1618)
+        self.assertEqual(identity.revision.data_type['Minor Revision'].value(), 40)
+        self.assertEqual(identity.serial_number.data_type.value(), 0x12345678)
+        self.assertEqual(ethernet_link.interface_speed.data_type.value(), 1000)
+        self.assertEqual(ethernet_link.physical_address.data_type.value(), [0, 0, 10, 1, 2, 3])
+        self.assertEqual(tcp_interface.host_name.status, b'\x00')
+        self.assertEqual(target.services, [CIPService.GET_ATTRIBUTE_LIST] * 4)
+
+    def test_single_instance(self):
+        tcp_interface = TCPInterfaceObject(None)
+        with self.assertRaises(ValueError):
+            GetAttributeList([tcp_interface.revision, tcp_interface.host_name])
+
+
+def variable_type_object_data(size: int, cip_data_type: bytes, name: str, number_of_members: int = 0, crc: int = 0,
+                              next_instance_id: int = 0, nesting_instance_id: int = 0) -> bytes:
+    """Reply data of Get Attribute All to a Variable Type Object without array dimensions"""
+    name_bytes = name.encode('utf-8')
+    reply_data = struct.pack('<LBccBHLHB', size, 0, cip_data_type, b'\x00', 0, number_of_members, 0, crc,
+                             len(name_bytes)) + name_bytes
+    if len(name_bytes) % 2 == 0:
+        reply_data += b'\x00'
+    return reply_data + struct.pack('<LL', next_instance_id, nesting_instance_id)
+
+
+class VariableTypeTarget(AsyncCIPDispatcher):
+    """Answers Get Attribute All to Variable Type Objects, keeping the instance IDs that were requested"""
+
+    def __init__(self, variable_type_objects: dict):
+        super().__init__()
+        self.variable_type_objects = variable_type_objects
+        self.instance_ids = []
+
+    async def execute_cip_command(self, request: CIPRequest) -> CIPReply:
+        instance_id = struct.unpack('<H', request.request_path[-2:])[0]
+        self.instance_ids.append(instance_id)
+        return CIPReply(b'\x81\x00\x00\x00' + self.variable_type_objects[instance_id])
+
+
+class TestSharedStructureTypes(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.target = VariableTypeTarget({
+            10: variable_type_object_data(8, b'\xa2', 'MachineState', 2, 0x1234, 0, 11),
+            11: variable_type_object_data(4, b'\xc4', 'Count', next_instance_id=12),
+            12: variable_type_object_data(4, b'\xca', 'Speed')})
+        update_data_type_dictionary(self.target.data_type_dictionary)
+        self.n_series = AsyncNSeries()
+        self.n_series.connected_cip_dispatcher = self.target
+
+    async def test_type_is_built_once(self):
+        first = await self.n_series._get_member_instance(10)
+        second = await self.n_series._get_member_instance(10)
+        self.assertEqual(self.target.instance_ids, [10, 11, 12])
+        self.assertIs(first.layout(), second.layout())
+        self.assertEqual((first.variable_type_name, first.size, first.crc_code), ('MachineState', 8, b'\x34\x12'))
+        first['Count'] = 5
+        self.assertEqual(first.data, struct.pack('<l4x', 5))
+        self.assertEqual(second['Count'].value(), 0)
+        self.assertEqual(list(second.members), ['Count', 'Speed'])
+
+    async def test_clear_variable_type_cache(self):
+        await self.n_series._get_member_instance(10)
+        self.n_series.clear_variable_type_cache()
+        await self.n_series._get_member_instance(10)
+        self.assertEqual(self.target.instance_ids, [10, 11, 12] * 2)